@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+"""
+Benchmarks of the download pipeline against a local stand-in ESGF federation (see esgf_standin.py).
+
+Each benchmark downloads the same synthetic dataset from a freshly started federation, with a fresh data node
+scoreboard and circuit breaker, and reports the number of files downloaded per second, the throughput, the number
+of retries of the client and the requests served and failures injected by the data nodes:
+
+- download_file: cmip6_utils.file.download_file, trying the replicas of each file (urls known up front) in turn
+- search_and_download: cmip6_download_unsuccessful_files.search_and_download, one search request per file
+- cmip6_download_file: cmip6_download_file.cmip6_download_file with --search-node pointing at the stand-in
+
+Run from the root of the repository with cmip6_utils installed, e.g.
+
+python benchmarks/bench_downloads.py --files 20 --size 8388608 --error-rate 0.05 --truncate-rate 0.05 --dead-nodes 1
+"""
+import argparse
+import contextlib
+import logging
+import os
+import sys
+import tempfile
+import time
+from dataclasses import dataclass
+
+from esgf_standin import NodeConfig, StandInFederation, synthetic_files
+
+from cmip6_utils.download import DEFAULT_SEGMENT_SIZE, DownloadEngine
+from cmip6_utils.nodes import NodeScoreboard, set_scoreboard
+from cmip6_utils.retry import CircuitBreaker, set_circuit_breaker
+from cmip6_utils.scripts.cmip6_download_file import cmip6_download_file
+from cmip6_utils.scripts.cmip6_download_unsuccessful_files import search_and_download
+from cmip6_utils.session import set_pool_size
+
+LOGGER = logging.getLogger("MAIN")
+
+BENCHMARKS = ["download_file", "search_and_download", "cmip6_download_file"]
+
+
+class RetryCounter(logging.Handler):
+    """Counts the retries logged by download_file."""
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.retries = 0
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if "Retrying" in record.getMessage():
+            self.retries += 1
+
+
+@dataclass
+class Result:
+    name: str
+    files: int
+    ok: int
+    seconds: float
+    nbytes: int
+    retries: int
+    counters: dict
+
+    def report(self) -> str:
+        return (
+            f"{self.name:20s} {self.ok:4d}/{self.files:<4d} {self.seconds:8.2f} s "
+            f"{self.ok / self.seconds:8.2f} files/s {self.nbytes / self.seconds / 1e6:8.2f} MB/s "
+            f"{self.retries:6d} retries | data nodes: {self.counters['requests']} requests, "
+            f"{self.counters['errors']} errors, {self.counters['truncated']} truncated"
+        )
+
+
+def cli() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Benchmarks the download pipeline against a local stand-in ESGF federation.",
+    )
+    parser.add_argument("--benchmarks", nargs="+", choices=BENCHMARKS, default=BENCHMARKS, help="Benchmarks to run")
+    parser.add_argument("--files", type=int, default=20, help="Number of files in the dataset")
+    parser.add_argument("--size", type=int, default=4 * 1024 * 1024, help="Size of each file in bytes")
+    parser.add_argument("--data-nodes", type=int, default=3, help="Number of data nodes")
+    parser.add_argument("--replicas", type=int, default=2, help="Number of data nodes serving each file")
+    parser.add_argument("--dead-nodes", type=int, default=0, help="Number of data nodes that refuse connections")
+    parser.add_argument("--latency", type=float, default=0.0, help="Latency of the data nodes in seconds")
+    parser.add_argument("--search-latency", type=float, default=0.0, help="Latency of the search node in seconds")
+    parser.add_argument("--bandwidth", type=float, default=None, help="Bandwidth cap per response in bytes/s")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 503")
+    parser.add_argument("--truncate-rate", type=float, default=0.0, help="Fraction of responses cut off halfway")
+    parser.add_argument("--no-ranges", action="store_true", help="Data nodes ignore Range requests")
+    parser.add_argument("--jobs", "-j", type=int, default=4, help="Number of files to download concurrently")
+    parser.add_argument("--per-node", type=int, default=2, help="Maximum number of concurrent downloads per node")
+    parser.add_argument("--timeout", "-t", type=int, default=5, help="Socket read timeout in seconds")
+    parser.add_argument(
+        "--segments", type=int, default=0, help="Segmented download connections for cmip6_download_file"
+    )
+    parser.add_argument("--segment-size", type=int, default=DEFAULT_SEGMENT_SIZE, help="Size of the segments in bytes")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the injected failures")
+    parser.add_argument("--verbose", "-v", action="store_true", help="Show the log of the downloads")
+    return parser.parse_args()
+
+
+def bench_download_file(federation: StandInFederation, outdir: str, args: argparse.Namespace) -> list[bool]:
+    engine = DownloadEngine(args.jobs, args.per_node)
+
+    def fetch(f):
+        local_filename = os.path.join(outdir, f.filename)
+        for url in federation.replica_urls(f):
+            result = engine.download(url, local_filename, timeout=args.timeout, size=f.size, checksum_type="SHA256")
+            if result.ok and result.digest == f.checksum:
+                return True
+        return False
+
+    return [ok for _, ok in engine.run(fetch, ((f,) for f in federation.files))]
+
+
+def bench_search_and_download(federation: StandInFederation, outdir: str, args: argparse.Namespace) -> list[bool]:
+    engine = DownloadEngine(args.jobs, args.per_node)
+
+    def fetch(f):
+        return search_and_download(
+            federation.search_node.url, f.master_id, outdir, args.timeout, limiter=engine.limiter
+        )[0]
+
+    return [ok for _, ok in engine.run(fetch, ((f,) for f in federation.files))]
+
+
+def bench_cmip6_download_file(federation: StandInFederation, outdir: str, args: argparse.Namespace) -> list[bool]:
+    engine = DownloadEngine(args.jobs, args.per_node)
+
+    def fetch(f):
+        err = cmip6_download_file(
+            os.path.join(outdir, f.path),
+            args.timeout,
+            verbose=False,
+            segments=args.segments,
+            segment_size=args.segment_size,
+            search_node=federation.search_node.url,
+        )
+        return err == 0
+
+    out = sys.stdout if args.verbose else open(os.devnull, "w")
+    with contextlib.redirect_stdout(out):
+        return [ok for _, ok in engine.run(fetch, ((f,) for f in federation.files))]
+
+
+def run(name: str, args: argparse.Namespace, counter: RetryCounter) -> Result:
+    files = synthetic_files(args.files, args.size)
+    for f in files:
+        # generate the contents before the clock starts
+        f.checksum
+
+    config = NodeConfig(
+        latency=args.latency,
+        bandwidth=args.bandwidth,
+        error_rate=args.error_rate,
+        truncate_rate=args.truncate_rate,
+        ranges=not args.no_ranges,
+    )
+    data_nodes = [config] * (args.data_nodes - args.dead_nodes) + [NodeConfig(dead=True)] * args.dead_nodes
+    federation = StandInFederation(
+        files, data_nodes, search=NodeConfig(latency=args.search_latency), replicas=args.replicas, seed=args.seed
+    )
+
+    with tempfile.TemporaryDirectory() as tmpdir, federation:
+        set_scoreboard(NodeScoreboard(os.path.join(tmpdir, "nodes.sqlite")))
+        set_circuit_breaker(CircuitBreaker())
+        outdir = os.path.join(tmpdir, "data")
+        os.makedirs(outdir)
+        counter.retries = 0
+
+        start = time.perf_counter()
+        results = globals()[f"bench_{name}"](federation, outdir, args)
+        seconds = time.perf_counter() - start
+
+        ok = sum(results)
+        return Result(name, len(files), ok, seconds, ok * args.size, counter.retries, federation.data_counters())
+
+
+def main():
+    args = cli()
+    set_pool_size(max(args.jobs, 1))
+
+    counter = RetryCounter()
+    if not args.verbose:
+        # keep the counter only, the scripts add their own log handlers when imported
+        LOGGER.handlers = []
+        LOGGER.propagate = False
+    LOGGER.addHandler(counter)
+
+    print(
+        f"{args.files} files of {args.size / 1e6:.1f} MB, {args.data_nodes} data nodes ({args.dead_nodes} dead), "
+        f"{args.replicas} replicas per file, {args.jobs} jobs"
+    )
+    for name in args.benchmarks:
+        print(run(name, args, counter).report())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,393 @@
+"""
+Local stand-in for a small ESGF federation, for benchmarking the download pipeline without touching real nodes.
+
+A StandInFederation serves a synthetic set of CMIP6 files: a search node answers esg-search/search requests for File
+records (by master_id or by the facets of the dataset) in the XML format of the search API, and data nodes serve the
+files as HTTPServer urls (thredds/fileServer/...). Each file is replicated on several data nodes. Every node can be
+configured to answer slowly (latency), to cap the bandwidth of each response, to fail a fraction of the requests
+(503), to cut a fraction of the responses off halfway (truncated streams), to ignore Range requests, or to be dead
+(connections are refused). Each node counts the requests it served and the failures it injected.
+
+The contents of the files are pseudo-random bytes generated from a seed, so their checksums are known and the
+files do not need to exist on disk.
+"""
+import hashlib
+import random
+import socket
+import threading
+import time
+from dataclasses import dataclass
+from functools import cached_property
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+from xml.sax.saxutils import escape
+
+FILE_SERVER = "/thredds/fileServer/"
+
+SEARCH_API = "/esg-search/search"
+
+CHUNK_SIZE = 64 * 1024
+
+DRS_FACETS = [
+    "project",
+    "activity_id",
+    "institution_id",
+    "source_id",
+    "experiment_id",
+    "variant_label",
+    "table_id",
+    "variable_id",
+    "grid_label",
+    "version",
+]
+
+# Search parameters that are not facets
+SEARCH_PARAMS = {"type", "distrib", "fields", "limit", "offset", "format", "replica", "latest", "master_id"}
+
+
+@dataclass
+class NodeConfig:
+    """
+    Behaviour of a stand-in node.
+
+    :param latency: delay before the response headers are sent in seconds
+    :type latency: float
+    :param bandwidth: bandwidth cap of each response in bytes/s, None for no cap
+    :type bandwidth: float, optional
+    :param error_rate: fraction of the requests that are answered with 503 Service Unavailable
+    :type error_rate: float
+    :param truncate_rate: fraction of the responses that are cut off halfway, after the full length was announced
+    :type truncate_rate: float
+    :param dead: the node refuses all connections
+    :type dead: bool
+    :param ranges: the node honours Range requests
+    :type ranges: bool
+    """
+
+    latency: float = 0.0
+    bandwidth: Optional[float] = None
+    error_rate: float = 0.0
+    truncate_rate: float = 0.0
+    dead: bool = False
+    ranges: bool = True
+
+
+@dataclass
+class SyntheticFile:
+    dataset: str  # CMIP6/<activity>/.../<version>
+    filename: str
+    size: int
+    seed: int
+
+    @property
+    def master_id(self) -> str:
+        # as in ESGF, the master_id of a file does not include the version of its dataset (the instance_id does)
+        dataset = self.dataset.rpartition("/")[0]
+        return f"{dataset.replace('/', '.')}.{self.filename}"
+
+    @property
+    def path(self) -> str:
+        return f"{self.dataset}/{self.filename}"
+
+    @property
+    def facets(self) -> dict[str, str]:
+        facets = dict(zip(DRS_FACETS, self.dataset.split("/")))
+        facets["version"] = facets["version"].lstrip("v")
+        return facets
+
+    @cached_property
+    def content(self) -> bytes:
+        return random.Random(self.seed).randbytes(self.size)
+
+    @cached_property
+    def checksum(self) -> str:
+        return hashlib.sha256(self.content).hexdigest()
+
+
+def synthetic_files(
+    num_files: int,
+    size: int,
+    dataset: Optional[str] = "CMIP6/CMIP/STANDIN/STANDIN-1/historical/r1i1p1f1/Amon/tas/gn/v20200101",
+    start_year: Optional[int] = 1850,
+) -> list[SyntheticFile]:
+    """A dataset of num_files files of size bytes, one per year."""
+    parts = dataset.split("/")
+    source_id, experiment_id, variant_label, table_id, variable_id, grid_label = parts[3:9]
+    base = f"{variable_id}_{table_id}_{source_id}_{experiment_id}_{variant_label}_{grid_label}"
+    return [
+        SyntheticFile(dataset, f"{base}_{year}01-{year}12.nc", size, seed=year)
+        for year in range(start_year, start_year + num_files)
+    ]
+
+
+class NodeCounters:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.truncated = 0
+        self.nbytes = 0
+
+    def add(self, **counts) -> None:
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def asdict(self) -> dict:
+        with self._lock:
+            return {"requests": self.requests, "errors": self.errors, "truncated": self.truncated, "bytes": self.nbytes}
+
+
+class StandInNode:
+    """A node of the federation, listening on its own address so that it is a separate host for the clients."""
+
+    def __init__(self, federation: "StandInFederation", config: NodeConfig, address: str):
+        self.federation = federation
+        self.config = config
+        self.address = address
+        self.counters = NodeCounters()
+        self.server = None
+        self.port = None
+
+    @property
+    def host(self) -> str:
+        return f"{self.address}:{self.port}"
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}"
+
+    def start(self) -> None:
+        if self.config.dead:
+            # reserve a port nothing listens on, connections to it are refused
+            with socket.socket() as sock:
+                sock.bind((self.address, 0))
+                self.port = sock.getsockname()[1]
+            return
+
+        node = self
+
+        class Handler(StandInHandler):
+            pass
+
+        Handler.node = node
+        self.server = ThreadingHTTPServer((self.address, 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self) -> None:
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    node: StandInNode = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        node = self.node
+        node.counters.add(requests=1)
+        if node.config.latency:
+            time.sleep(node.config.latency)
+        if node.federation.chance(node.config.error_rate):
+            node.counters.add(errors=1)
+            self.send_error(503, "Injected error")
+            return
+
+        url = urlparse(self.path)
+        if url.path == SEARCH_API:
+            self.search(parse_qs(url.query))
+        elif url.path.startswith(FILE_SERVER):
+            self.serve_file(url.path[len(FILE_SERVER) :])
+        else:
+            self.send_error(404)
+
+    def search(self, params: dict) -> None:
+        if params.get("type", ["File"])[0] != "File":
+            self.send_error(400, "Only File searches are supported")
+            return
+        offset = int(params.get("offset", [0])[0])
+        limit = int(params.get("limit", [10])[0])
+
+        master_ids = set(params.get("master_id", []))
+        facets = {name: set(values) for name, values in params.items() if name not in SEARCH_PARAMS}
+        docs = [
+            (f, node)
+            for f in self.node.federation.files
+            if (not master_ids or f.master_id in master_ids)
+            and all(f.facets.get(name) in values for name, values in facets.items())
+            for node in self.node.federation.replica_nodes(f)
+        ]
+        body = [
+            '<?xml version="1.0" encoding="UTF-8"?>\n<response>\n'
+            f'<result name="response" numFound="{len(docs)}" start="{offset}">'
+        ]
+        for f, node in docs[offset : offset + limit]:
+            body.append(
+                "<doc>"
+                f'<str name="master_id">{escape(f.master_id)}</str>'
+                f'<arr name="url"><str>{escape(node.url + FILE_SERVER + f.path)}|application/netcdf|HTTPServer</str>'
+                "</arr>"
+                f'<arr name="checksum"><str>{f.checksum}</str></arr>'
+                '<arr name="checksum_type"><str>SHA256</str></arr>'
+                f'<long name="size">{f.size}</long>'
+                f'<str name="data_node">{node.address}</str>'
+                "</doc>"
+            )
+        body.append("</result>\n</response>\n")
+        self.send_body(200, "\n".join(body).encode(), {"Content-Type": "application/xml"})
+
+    def serve_file(self, path: str) -> None:
+        f = self.node.federation.file_by_path.get(path)
+        if f is None or self.node not in self.node.federation.replica_nodes(f):
+            self.send_error(404)
+            return
+
+        content = f.content
+        start, end = 0, f.size - 1
+        status = 200
+        headers = {"Content-Type": "application/netcdf", "ETag": f'"{f.checksum[:16]}"'}
+        byte_range = self.headers.get("Range")
+        if self.node.config.ranges:
+            headers["Accept-Ranges"] = "bytes"
+            if byte_range and byte_range.startswith("bytes="):
+                first, _, last = byte_range[6:].partition("-")
+                start = int(first)
+                end = min(int(last), f.size - 1) if last else f.size - 1
+                if start >= f.size:
+                    headers["Content-Range"] = f"bytes */{f.size}"
+                    self.send_body(416, b"", headers)
+                    return
+                status = 206
+                headers["Content-Range"] = f"bytes {start}-{end}/{f.size}"
+        self.send_body(status, memoryview(content)[start : end + 1], headers)
+
+    def send_body(self, status: int, body, headers: dict) -> None:
+        truncate = (
+            status in (200, 206) and len(body) > 1 and self.node.federation.chance(self.node.config.truncate_rate)
+        )
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        if truncate:
+            self.send_header("Connection", "close")
+        self.end_headers()
+
+        if truncate:
+            self.node.counters.add(truncated=1)
+            body = body[: len(body) // 2]
+            self.close_connection = True
+
+        bandwidth = self.node.config.bandwidth
+        started = time.monotonic()
+        sent = 0
+        try:
+            for i in range(0, len(body), CHUNK_SIZE):
+                chunk = body[i : i + CHUNK_SIZE]
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                if bandwidth:
+                    ahead = sent / bandwidth - (time.monotonic() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+        finally:
+            self.node.counters.add(nbytes=sent)
+
+
+class StandInFederation:
+    """
+    A search node and data nodes serving a set of synthetic files. Use as a context manager, or call start() and
+    stop().
+
+    :param files: files to serve (see synthetic_files)
+    :type files: list[SyntheticFile]
+    :param data_nodes: configuration of each data node
+    :type data_nodes: list[NodeConfig]
+    :param search: configuration of the search node, defaults to a well-behaved node
+    :type search: NodeConfig, optional
+    :param replicas: number of data nodes each file is served by, defaults to 2
+    :type replicas: int, optional
+    :param seed: seed of the injected failures, defaults to 0
+    :type seed: int, optional
+    """
+
+    def __init__(
+        self,
+        files: list[SyntheticFile],
+        data_nodes: list[NodeConfig],
+        search: Optional[NodeConfig] = None,
+        replicas: Optional[int] = 2,
+        seed: Optional[int] = 0,
+    ):
+        self.files = files
+        self.file_by_path = {f.path: f for f in files}
+        self.file_index = {f.master_id: i for i, f in enumerate(files)}
+        self.replicas = min(replicas, len(data_nodes))
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+        # every node gets its own loopback address, so that limits and statistics per host apply to it
+        addresses = [loopback_address(i + 2) for i in range(len(data_nodes) + 1)]
+        self.search_node = StandInNode(self, search or NodeConfig(), addresses[0])
+        self.data_nodes = [StandInNode(self, config, address) for config, address in zip(data_nodes, addresses[1:])]
+
+    def chance(self, rate: float) -> bool:
+        if rate <= 0:
+            return False
+        with self._lock:
+            return self._random.random() < rate
+
+    def replica_nodes(self, f: SyntheticFile) -> list[StandInNode]:
+        i = self.file_index[f.master_id]
+        return [self.data_nodes[(i + k) % len(self.data_nodes)] for k in range(self.replicas)]
+
+    def replica_urls(self, f: SyntheticFile) -> list[str]:
+        return [node.url + FILE_SERVER + f.path for node in self.replica_nodes(f)]
+
+    def start(self) -> "StandInFederation":
+        for node in [self.search_node] + self.data_nodes:
+            node.start()
+        return self
+
+    def stop(self) -> None:
+        for node in [self.search_node] + self.data_nodes:
+            node.stop()
+
+    def __enter__(self) -> "StandInFederation":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def counters(self) -> dict[str, dict]:
+        """Counters of the search node and the data nodes, by host."""
+        return {node.host: node.counters.asdict() for node in [self.search_node] + self.data_nodes}
+
+    def data_counters(self) -> dict:
+        """Counters summed over the data nodes."""
+        total = {}
+        for node in self.data_nodes:
+            for name, value in node.counters.asdict().items():
+                total[name] = total.get(name, 0) + value
+        return total
+
+
+def loopback_address(i: int) -> str:
+    """127.0.0.i if the system routes the whole loopback network (Linux does), 127.0.0.1 otherwise."""
+    address = f"127.0.0.{i}"
+    try:
+        with socket.socket() as sock:
+            sock.bind((address, 0))
+    except OSError:
+        return "127.0.0.1"
+    return address
@@ -0,0 +1,243 @@
+"""
+Streaming checksums of (potentially very large) data files.
+
+Files are hashed in fixed size blocks (or through a memory map), so memory usage does not depend on the size of
+the file. The checksum types are the ones reported by ESGF for CMIP6 files.
+
+Checksums can be remembered in a ChecksumCache, keyed by the identity of the file (path, inode, size and
+mtime), so that verifying a file that has not changed since it was last hashed only costs a stat call.
+"""
+import hashlib
+import mmap
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from typing import Iterable, Optional
+
+# ESGF checksum_type -> hashlib algorithm
+CHECKSUM_TYPES = {"SHA256": "sha256", "MD5": "md5"}
+
+DEFAULT_BLOCKSIZE = 4 * 1024 * 1024
+
+DEFAULT_CHECKSUM_CACHE = os.path.expanduser("~/.cmip6_utils/checksums.sqlite")
+
+_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS checksum (
+    path TEXT NOT NULL,
+    checksum_type TEXT NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    checksum TEXT NOT NULL,
+    PRIMARY KEY (path, checksum_type)
+);
+"""
+
+
+@dataclass
+class HashStats:
+    files: int = 0
+    nbytes: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def rate(self) -> float:
+        """Aggregate hashing rate in MB/s."""
+        return self.nbytes / 1e6 / self.elapsed if self.elapsed > 0 else 0.0
+
+    def report(self) -> str:
+        return f"Hashed {self.files} files ({self.nbytes / 1e9:.2f} GB) at {self.rate:.1f} MB/s"
+
+
+def new_hasher(checksum_type: Optional[str] = "SHA256"):
+    """Returns a new hashlib object for an ESGF checksum type (e.g. SHA256, MD5)."""
+    try:
+        return hashlib.new(CHECKSUM_TYPES[checksum_type.upper()])
+    except KeyError:
+        raise ValueError(f"Unsupported checksum type: {checksum_type}") from None
+
+
+def file_checksum(
+    fname: str,
+    checksum_type: Optional[str] = "SHA256",
+    blocksize: Optional[int] = DEFAULT_BLOCKSIZE,
+    use_mmap: Optional[bool] = False,
+) -> str:
+    """Computes the checksum of a file, reading it in blocks of blocksize bytes or through a memory map.
+
+    :param fname: name of the file
+    :type fname: str
+    :param checksum_type: ESGF checksum type, defaults to "SHA256"
+    :type checksum_type: str, optional
+    :param blocksize: size of the blocks in which the file is read, defaults to DEFAULT_BLOCKSIZE
+    :type blocksize: int, optional
+    :param use_mmap: hash the file through a read-only memory map instead of reading it, defaults to False
+    :type use_mmap: bool, optional
+    :return: hex digest of the file
+    :rtype: str
+    """
+    hasher = new_hasher(checksum_type)
+
+    with open(fname, "rb") as f:
+        if use_mmap and os.fstat(f.fileno()).st_size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                hasher.update(mm)
+        else:
+            buffer = bytearray(blocksize)
+            view = memoryview(buffer)
+            while True:
+                n = f.readinto(buffer)
+                if not n:
+                    break
+                hasher.update(view[:n])
+
+    return hasher.hexdigest()
+
+
+def _identity(st: os.stat_result) -> tuple[int, int, int]:
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+class ChecksumCache:
+    """
+    SQLite cache of file checksums keyed by the identity of the file: (path, inode, size, mtime_ns). An entry is
+    only used if the identity of the file still matches; stale entries are evicted when they are looked up.
+
+    The cache can be shared between threads (each thread uses its own connection).
+    """
+
+    def __init__(self, dbname: Optional[str] = DEFAULT_CHECKSUM_CACHE):
+        dirname = os.path.dirname(dbname)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.dbname = dbname
+        self._local = threading.local()
+        with self._connection() as con:
+            con.executescript(_CACHE_SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = sqlite3.connect(self.dbname, timeout=60)
+            self._local.con = con
+        return con
+
+    def lookup(self, fname: str, checksum_type: Optional[str] = "SHA256") -> Optional[str]:
+        """Returns the cached checksum of the file, or None if there is none or the file has changed since."""
+        path = os.path.abspath(fname)
+        checksum_type = checksum_type.upper()
+        try:
+            identity = _identity(os.stat(path))
+        except FileNotFoundError:
+            identity = None
+
+        with self._connection() as con:
+            row = con.execute(
+                "SELECT inode, size, mtime_ns, checksum FROM checksum WHERE path=? AND checksum_type=?",
+                (path, checksum_type),
+            ).fetchone()
+            if row is None:
+                return None
+            if tuple(row[:3]) != identity:
+                con.execute("DELETE FROM checksum WHERE path=?", (path,))
+                return None
+        return row[3]
+
+    def store(self, fname: str, checksum: str, checksum_type: Optional[str] = "SHA256", st=None) -> None:
+        """Records the checksum of the file. st is the stat result of the file at the time it was hashed."""
+        path = os.path.abspath(fname)
+        st = os.stat(path) if st is None else st
+        with self._connection() as con:
+            con.execute(
+                "INSERT OR REPLACE INTO checksum VALUES (?, ?, ?, ?, ?, ?)",
+                (path, checksum_type.upper(), *_identity(st), checksum.lower()),
+            )
+
+    def checksum(
+        self,
+        fname: str,
+        checksum_type: Optional[str] = "SHA256",
+        blocksize: Optional[int] = DEFAULT_BLOCKSIZE,
+    ) -> str:
+        """Returns the checksum of the file from the cache, hashing the file (and filling the cache) on a miss."""
+        checksum = self.lookup(fname, checksum_type)
+        if checksum is None:
+            st = os.stat(fname)
+            checksum = file_checksum(fname, checksum_type, blocksize)
+            # only remember the checksum if the file did not change while it was being hashed
+            if _identity(os.stat(fname)) == _identity(st):
+                self.store(fname, checksum, checksum_type, st)
+        return checksum
+
+    def prune(self) -> int:
+        """Removes the entries of files that no longer exist or have changed. Returns the number removed."""
+        with self._connection() as con:
+            rows = con.execute("SELECT path, inode, size, mtime_ns FROM checksum").fetchall()
+            stale = []
+            for path, *identity in rows:
+                try:
+                    if _identity(os.stat(path)) != tuple(identity):
+                        stale.append((path,))
+                except FileNotFoundError:
+                    stale.append((path,))
+            con.executemany("DELETE FROM checksum WHERE path=?", stale)
+        return len(stale)
+
+
+def bulk_checksums(
+    fnames: Iterable[str],
+    checksum_type: Optional[str] = "SHA256",
+    workers: Optional[int] = None,
+    use_threads: Optional[bool] = False,
+    blocksize: Optional[int] = DEFAULT_BLOCKSIZE,
+    use_mmap: Optional[bool] = False,
+    stats: Optional[HashStats] = None,
+    cache: Optional[ChecksumCache] = None,
+) -> dict[str, str]:
+    """Computes the checksums of many files in parallel.
+
+    By default the files are hashed on a pool of processes. Since hashlib releases the GIL while hashing large
+    buffers, a pool of threads (use_threads=True) works as well and avoids starting processes. If a cache is given,
+    only the files that are not in the cache (or have changed) are hashed, and the cache is filled with the results.
+
+    :param fnames: names of the files
+    :type fnames: Iterable[str]
+    :param workers: number of processes (or threads), defaults to the number of CPUs
+    :type workers: int, optional
+    :param stats: if given, the number of files and bytes hashed and the time taken are added to it
+    :type stats: HashStats, optional
+    :param cache: checksum cache to consult and fill, defaults to None
+    :type cache: ChecksumCache, optional
+    :return: mapping of file names to hex digests
+    :rtype: dict[str, str]
+    """
+    fnames = list(fnames)
+    start = time.perf_counter()
+
+    checksums = {}
+    if cache is not None:
+        for fname in fnames:
+            checksum = cache.lookup(fname, checksum_type)
+            if checksum is not None:
+                checksums[fname] = checksum
+    to_hash = [fname for fname in fnames if fname not in checksums]
+    identities = {fname: os.stat(fname) for fname in to_hash} if cache is not None else {}
+
+    executor = ThreadPoolExecutor if use_threads else ProcessPoolExecutor
+    func = partial(file_checksum, checksum_type=checksum_type, blocksize=blocksize, use_mmap=use_mmap)
+    with executor(max_workers=workers) as pool:
+        for fname, checksum in zip(to_hash, pool.map(func, to_hash)):
+            checksums[fname] = checksum
+            if cache is not None and _identity(os.stat(fname)) == _identity(identities[fname]):
+                cache.store(fname, checksum, checksum_type, identities[fname])
+
+    if stats is not None:
+        stats.files += len(to_hash)
+        stats.nbytes += sum(os.path.getsize(fname) for fname in to_hash)
+        stats.elapsed += time.perf_counter() - start
+
+    return checksums
@@ -3,10 +3,18 @@ from argparse import ArgumentParser, Namespace
 from typing import Optional
 
 from cmip6_utils.cmip6 import experiment_to_activity
+from cmip6_utils.download import DEFAULT_SEGMENT_SIZE
+from cmip6_utils.inventory import DEFAULT_INVENTORY, CMIPInventory
+from cmip6_utils.search_cache import DEFAULT_SEARCH_CACHE, DEFAULT_TTL, SearchCache
 
 
 def add_common_parser_args(
-    parser: ArgumentParser, exp: Optional[bool] = False, adir: Optional[bool] = True, dryrun: Optional[bool] = False
+    parser: ArgumentParser,
+    exp: Optional[bool] = False,
+    adir: Optional[bool] = True,
+    dryrun: Optional[bool] = False,
+    inventory: Optional[bool] = False,
+    walk: Optional[bool] = False,
 ) -> None:
     parser.add_argument(
         "variable",
@@ -38,7 +46,75 @@ def add_common_parser_args(
             ),
         )
 
+    if inventory:
+        parser.add_argument(
+            "--inventory",
+            "-I",
+            action="store_true",
+            help="Query the inventory (see cmip6_inventory) instead of walking the CMIP6 directory tree.",
+        )
+        parser.add_argument(
+            "--inventory-db", type=str, default=DEFAULT_INVENTORY, help="Path to the inventory database."
+        )
+
+    if walk:
+        parser.add_argument(
+            "--walk-threads",
+            type=int,
+            default=None,
+            help=(
+                "Number of threads with which to walk the CMIP6 directory tree in parallel. Useful on network "
+                "filesystems where the walk is limited by the latency of metadata operations."
+            ),
+        )
+
 
 def set_default_activitydir(args: Namespace):
     if not args.activitydir:
         args.activitydir = os.path.join("/data/Datasets/CMIP6", experiment_to_activity(args.experiment))
+
+
+def open_inventory(args: Namespace) -> Optional[CMIPInventory]:
+    """Returns the inventory to query if the user asked for it with --inventory, otherwise None."""
+    if getattr(args, "inventory", False):
+        if not os.path.exists(args.inventory_db):
+            raise ValueError(f"Inventory {args.inventory_db} does not exist. Run 'cmip6_inventory' first.")
+        return CMIPInventory(args.inventory_db)
+    return None
+
+
+def add_search_cache_args(parser: ArgumentParser) -> None:
+    parser.add_argument(
+        "--search-cache", type=str, default=DEFAULT_SEARCH_CACHE, help="Path to the cache of ESGF search results."
+    )
+    parser.add_argument(
+        "--search-cache-ttl",
+        type=float,
+        default=DEFAULT_TTL,
+        help="Time (in seconds) for which cached search results are used. 0 disables the cache.",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Only use cached search results, however old, and do not send any search requests.",
+    )
+
+
+def open_search_cache(args: Namespace) -> Optional[SearchCache]:
+    """Returns the search cache configured with add_search_cache_args, or None if it is disabled."""
+    if args.search_cache_ttl <= 0 and not args.offline:
+        return None
+    return SearchCache(args.search_cache, ttl=args.search_cache_ttl, offline=args.offline)
+
+
+def add_segment_args(parser: ArgumentParser, segments: Optional[int] = 4) -> None:
+    parser.add_argument(
+        "--segments",
+        type=int,
+        default=segments,
+        help=(
+            "Download files larger than --segment-size in segments over this many concurrent connections, "
+            "spread over all replicas of the file. 0 downloads from one replica at a time."
+        ),
+    )
+    parser.add_argument("--segment-size", type=int, default=DEFAULT_SEGMENT_SIZE, help="Size of the segments in bytes")
@@ -1,7 +1,12 @@
 import os
-from typing import Optional
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from fnmatch import fnmatchcase
+from typing import Optional, Union
 
 from cmip6_utils.cmip6 import cmip6_activities
+from cmip6_utils.inventory import CMIPInventory
 
 
 class CMIPDirLevels:
@@ -15,10 +20,144 @@ class CMIPDirLevels:
     version = 8
 
 
-def walk_cmip_directory(root_dir: str, level: Optional[int] = None) -> list[str]:
+@dataclass
+class WalkStats:
+    directories: int = 0
+    files: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def rate(self) -> float:
+        """Directories listed per second."""
+        return self.directories / self.elapsed if self.elapsed > 0 else 0.0
+
+    def report(self) -> str:
+        return f"Walked {self.directories} directories ({self.files} files) at {self.rate:.1f} directories/s"
+
+
+def is_hidden(name: str) -> bool:
+    """Whether a directory entry is hidden, e.g. the partial file of a download in progress (see
+    cmip6_utils.file.partial_filename). The walks of the CMIP6 directory tree skip hidden entries."""
+    return name.startswith(".")
+
+
+def _os_walk(top: str):
+    """os.walk, without hidden entries. As with os.walk, the caller can prune the walk through the list of
+    directories."""
+    for root, dirs, files in os.walk(top):
+        dirs[:] = [d for d in dirs if not is_hidden(d)]
+        yield root, dirs, [f for f in files if not is_hidden(f)]
+
+
+def _scan_directory(path: str) -> tuple[list[str], list[str], set[str]]:
+    """
+    Lists a directory with os.scandir. The file type of each entry comes from the cached DirEntry information
+    (d_type on most filesystems), so no additional stat call is made per entry. Like os.walk, symbolic links
+    to directories are reported as directories but are not descended into. Hidden entries are left out.
+    """
+    dirs = []
+    files = []
+    links = set()
+    with os.scandir(path) as it:
+        for entry in it:
+            if is_hidden(entry.name):
+                continue
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+
+            if is_dir:
+                dirs.append(entry.name)
+                if entry.is_symlink():
+                    links.add(entry.name)
+            else:
+                files.append(entry.name)
+
+    return dirs, files, links
+
+
+def scandir_walk(
+    top: str, max_depth: Optional[int] = None, threads: Optional[int] = 8, stats: Optional[WalkStats] = None
+):
+    """
+    A parallel version of os.walk (top-down). Directories are listed with os.scandir on a pool of threads, which
+    hides the latency of metadata round-trips on network filesystems. Results are yielded in the order in which
+    the listings complete, not in directory order. Hidden entries are skipped.
+
+    As with os.walk, the caller can prune the walk by removing entries from the returned list of directories:
+    sub-directories are only queued after the caller has received their parent. Directories deeper than
+    max_depth (relative to top) are not listed. If stats is given, the number of directories and files walked
+    and the time taken are added to it. The time spent by the caller between two results (while the walk is
+    suspended) is not counted, so that nested walks sharing the same stats do not count the same time twice.
+    """
+    top = top.rstrip(os.path.sep)
+    start = time.perf_counter()
+
+    pool = ThreadPoolExecutor(max_workers=threads)
+    pending = {pool.submit(_scan_directory, top): (top, 0)}
+    try:
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                root, depth = pending.pop(future)
+                try:
+                    dirs, files, links = future.result()
+                except OSError:
+                    # os.walk ignores directories that cannot be listed as well
+                    continue
+
+                if stats is not None:
+                    stats.directories += 1
+                    stats.files += len(files)
+                    stats.elapsed += time.perf_counter() - start
+
+                # the clock is stopped while the caller processes the result
+                start = None
+                yield root, dirs, files
+                start = time.perf_counter()
+
+                if max_depth is None or depth < max_depth:
+                    for d in dirs:
+                        if d not in links:
+                            path = os.path.join(root, d)
+                            pending[pool.submit(_scan_directory, path)] = (path, depth + 1)
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+        if stats is not None and start is not None:
+            stats.elapsed += time.perf_counter() - start
+
+
+def walk_directory(
+    top: str,
+    inventory: Optional[CMIPInventory] = None,
+    threads: Optional[int] = None,
+    stats: Optional[WalkStats] = None,
+):
+    """
+    os.walk, or, if an inventory is given, the equivalent walk through the directory tree recorded in the inventory.
+    If threads is given, the directory tree is walked in parallel with scandir_walk. Hidden entries are skipped.
+    """
+    if inventory is not None:
+        yield from inventory.walk(top)
+    elif threads:
+        yield from scandir_walk(top, threads=threads, stats=stats)
+    else:
+        yield from _os_walk(top)
+
+
+def walk_cmip_directory(
+    root_dir: str,
+    level: Optional[int] = None,
+    inventory: Optional[CMIPInventory] = None,
+    threads: Optional[int] = None,
+    stats: Optional[WalkStats] = None,
+) -> list[str]:
     """
     Like a typical os.walk, except the depth of the walk terminates at a specified depth level.
-    If level is not specified then it works like os.walk.
+    If level is not specified then it works like os.walk. If an inventory is given, the directory tree is read
+    from the inventory instead of the filesystem. If threads is given, the directory tree is walked in parallel
+    (see scandir_walk), in which case the directories are not returned in os.walk order.
 
     Modified from https://stackoverflow.com/questions/229186/os-walk-without-digging-into-directories-below
     """
@@ -29,24 +168,32 @@ def walk_cmip_directory(root_dir: str, level: Optional[int] = None) -> list[str]
         )
 
     if level is None:
-        yield from os.walk(root_dir)
+        yield from walk_directory(root_dir, inventory, threads, stats)
         return
 
     sep = os.path.sep
     some_dir = root_dir.rstrip(sep)
     assert os.path.isdir(some_dir)
     num_sep = some_dir.count(sep)
-    for root, dirs, files in os.walk(some_dir):
+    for root, dirs, files in walk_directory(some_dir, inventory, threads, stats):
         yield root, dirs, files
         num_sep_this = root.count(sep)
         if num_sep + level <= num_sep_this:
             del dirs[:]
 
 
-def get_cmip_directories_at_level(root_dir: str, level: int) -> list[str]:
+def get_cmip_directories_at_level(
+    root_dir: str,
+    level: int,
+    inventory: Optional[CMIPInventory] = None,
+    threads: Optional[int] = None,
+    stats: Optional[WalkStats] = None,
+) -> list[str]:
     """
     Walks through a CMIP data directory structure and returns the directories and files at a specific
-    directory level.
+    directory level. If an inventory is given, the directories are looked up in the inventory instead. If threads
+    is given, the directory tree is walked in parallel (see scandir_walk), in which case the directories are
+    returned in the order in which they are found.
 
     Modified from https://stackoverflow.com/questions/229186/os-walk-without-digging-into-directories-below
     """
@@ -56,12 +203,71 @@ def get_cmip_directories_at_level(root_dir: str, level: int) -> list[str]:
             "For get_cmip_directories_at_level to work, the root directory must end in a CMIP6 " "activity ID."
         )
 
+    if inventory is not None:
+        yield from inventory.directories_at_level(root_dir, level)
+        return
+
     sep = os.path.sep
     some_dir = root_dir.rstrip(sep)
     assert os.path.isdir(some_dir)
     num_sep = some_dir.count(sep)
-    for root, dirs, files in os.walk(some_dir):
+    if threads:
+        for root, dirs, files in scandir_walk(some_dir, max_depth=level, threads=threads, stats=stats):
+            if num_sep + level == root.count(sep):
+                yield root, dirs, files
+        return
+
+    for root, dirs, files in _os_walk(some_dir):
         num_sep_this = root.count(sep)
         if num_sep + level <= num_sep_this:
             yield root, dirs, files
             del dirs[:]
+
+
+def _selection_by_level(selection: dict[str, Union[str, list[str], None]]) -> dict[int, list[str]]:
+    """Converts a DRS selection keyed by facet name (see CMIPDirLevels) to lists of patterns keyed by level."""
+    patterns = {}
+    for facet, value in selection.items():
+        if facet.startswith("_") or not hasattr(CMIPDirLevels, facet):
+            raise ValueError(f"Unknown DRS facet: {facet}")
+        if value is None:
+            continue
+        patterns[getattr(CMIPDirLevels, facet)] = [value] if isinstance(value, str) else list(value)
+    return patterns
+
+
+def find_cmip_directories(
+    root_dir: str,
+    level: Optional[int] = CMIPDirLevels.version,
+    inventory: Optional[CMIPInventory] = None,
+    threads: Optional[int] = None,
+    stats: Optional[WalkStats] = None,
+    **selection: Union[str, list[str], None],
+):
+    """
+    Finds the directories at a specific directory level that match a partial DRS selection, e.g.
+
+        find_cmip_directories(root_dir, CMIPDirLevels.version, experiment="historical", variable="tas")
+
+    The selection is given by facet name (the attributes of CMIPDirLevels). Each facet is a shell-style pattern
+    (see fnmatch), a list of patterns, or None; facets that are not given match any directory. Unlike filtering
+    the results of a full walk, only the directories matching the selection are descended into, so a narrow
+    selection only touches a small fraction of the directory tree.
+
+    Yields (root, dirs, files) for the matching directories at the requested level. If an inventory is given, the
+    selection is looked up in the inventory instead.
+    """
+    patterns = _selection_by_level(selection)
+
+    if inventory is not None:
+        yield from inventory.select(root_dir, level, {lvl: pats for lvl, pats in patterns.items() if lvl <= level})
+        return
+
+    sep = os.path.sep
+    num_sep = root_dir.rstrip(sep).count(sep)
+    for root, dirs, files in walk_cmip_directory(root_dir, level, threads=threads, stats=stats):
+        depth = root.count(sep) - num_sep
+        if depth == level:
+            yield root, dirs, files
+        elif depth + 1 in patterns:
+            dirs[:] = [d for d in dirs if any(fnmatchcase(d, pat) for pat in patterns[depth + 1])]
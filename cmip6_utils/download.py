@@ -0,0 +1,335 @@
+"""
+Concurrent download engine.
+
+Download jobs run on a pool of threads that take their next job from a shared queue (see cmip6_utils.scheduler).
+The size of the pool is the global cap on concurrent downloads, and a HostLimiter caps the number of concurrent
+downloads from any single data node, so that one slow node does not hold up the others and no node is sent more
+requests than it can handle. Results are handed back to the calling thread in the order in which the jobs complete,
+so that state shared between jobs (e.g. the esgpull database) is only ever updated from one thread.
+
+Large files can also be downloaded in segments (byte ranges) that are fetched concurrently from several replicas
+of the file, see segmented_download.
+"""
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, Iterator, Optional
+from urllib.parse import urlparse
+
+import requests
+
+from cmip6_utils.checksum import ChecksumCache, file_checksum
+from cmip6_utils.file import (
+    STREAM_ERRORS,
+    DownloadResult,
+    IncompleteDownloadError,
+    RangeMismatchError,
+    discard_partial,
+    download_file,
+    install_partial,
+    parse_content_range,
+    partial_filename,
+)
+from cmip6_utils.misc import BC
+from cmip6_utils.nodes import get_scoreboard, url_host
+from cmip6_utils.retry import CircuitBreaker, get_circuit_breaker
+from cmip6_utils.scheduler import Scheduler
+from cmip6_utils.session import get_session_pool
+
+LOGGER = logging.getLogger("MAIN")
+
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+
+
+class HostLimiter:
+    """Limits the number of concurrent downloads from each host."""
+
+    def __init__(self, per_host: Optional[int] = 2):
+        self.per_host = per_host
+        self._lock = threading.Lock()
+        self._semaphores = defaultdict(lambda: threading.BoundedSemaphore(self.per_host))
+
+    def _semaphore(self, host: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            return self._semaphores[host]
+
+    @contextmanager
+    def slot(self, host: str):
+        """Context manager that waits until a download slot for the host is free and holds it."""
+        semaphore = self._semaphore(host)
+        semaphore.acquire()
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+
+def host_slot(limiter: Optional[HostLimiter], url: str):
+    """Returns the limiter's slot for the host of the url, or a no-op context manager if there is no limiter."""
+    if limiter is None:
+        return nullcontext()
+    return limiter.slot(urlparse(url).hostname)
+
+
+class DownloadEngine:
+    """
+    Runs download jobs concurrently.
+
+    :param workers: maximum number of concurrent jobs (global concurrency cap), defaults to 8
+    :type workers: int, optional
+    :param per_host: maximum number of concurrent downloads from a single data node, defaults to 2
+    :type per_host: int, optional
+    """
+
+    def __init__(self, workers: Optional[int] = 8, per_host: Optional[int] = 2):
+        self.workers = workers
+        self.limiter = HostLimiter(per_host)
+
+    def download(self, url: str, local_filename: str, **kwargs) -> DownloadResult:
+        """download_file, holding a download slot for the host of the url."""
+        with host_slot(self.limiter, url):
+            return download_file(url, local_filename, **kwargs)
+
+    def run(
+        self, func: Callable, items: Iterable[tuple], cost: Optional[Callable[[tuple], float]] = None
+    ) -> Iterator[tuple[tuple, Any]]:
+        """
+        Calls func(*item) for every item on the pool of threads and yields (item, result) in the calling thread as
+        the jobs complete. Items are consumed lazily, at most twice as many jobs as workers are queued at a time.
+        If a job raises an exception, it is re-raised here once the jobs already running have finished.
+        If the cost of the items (e.g. the size of the file) is given, the most expensive items are started first
+        (see cmip6_utils.scheduler.Scheduler).
+        """
+        return Scheduler(self.workers).run(func, items, cost)
+
+
+class SegmentRefusedError(Exception):
+    """The replica did not answer a range request with the requested range (no range support, missing file...)."""
+
+
+@dataclass
+class Segment:
+    start: int
+    end: int  # inclusive, as in the Range header
+    attempts: int = 0
+
+    def __len__(self) -> int:
+        return self.end - self.start + 1
+
+
+def fetch_segment(
+    url: str, fd: int, segment: Segment, timeout: int, limiter: Optional[HostLimiter] = None
+) -> tuple[float, float]:
+    """
+    Downloads one byte range of url and writes it at the same offset of the file open as fd. Returns the time to
+    first byte and the time spent receiving the range, in seconds.
+    """
+    with host_slot(limiter, url):
+        resp = get_session_pool().get(
+            url, stream=True, timeout=timeout, headers={"Range": f"bytes={segment.start}-{segment.end}"}
+        )
+        ttfb = resp.elapsed.total_seconds()
+        start_time = time.perf_counter()
+        try:
+            if resp.status_code != 206:
+                raise SegmentRefusedError(f"Range request answered with status {resp.status_code}")
+            start, _ = parse_content_range(resp.headers.get("Content-Range"))
+            if start != segment.start:
+                raise RangeMismatchError(f"Server sent range starting at {start} instead of {segment.start}")
+
+            offset = segment.start
+            for chunk in resp.iter_content(chunk_size=1024 * 1024):
+                # a server that sends more than the requested range must not overwrite the next segment
+                chunk = chunk[: segment.end + 1 - offset]
+                os.pwrite(fd, chunk, offset)
+                offset += len(chunk)
+                if offset > segment.end:
+                    break
+        finally:
+            resp.close()
+
+    if offset != segment.end + 1:
+        raise IncompleteDownloadError(f"Received {offset - segment.start} of {len(segment)} bytes")
+    return ttfb, time.perf_counter() - start_time
+
+
+def segmented_download(
+    urls: list[str],
+    local_filename: str,
+    size: int,
+    checksum: str,
+    checksum_type: Optional[str] = "SHA256",
+    connections: Optional[int] = 4,
+    segment_size: Optional[int] = DEFAULT_SEGMENT_SIZE,
+    timeout: Optional[int] = 30,
+    limiter: Optional[HostLimiter] = None,
+    breaker: Optional[CircuitBreaker] = None,
+) -> bool:
+    """
+    Downloads a file in segments (byte ranges) over several concurrent connections, spread over the replicas of
+    the file (all urls must point to the same file). The segments are written into a preallocated output file.
+    A segment that fails is fetched again from the next replica; a replica that refuses a range request is not
+    used again, nor is a replica on a host whose circuit is open in the circuit breaker (shared with download_file
+    by default). A single url works too, the segments are then fetched over several connections to the same node.
+    Returns True if all segments were downloaded and the checksum of the file matches.
+
+    :param urls: urls of the replicas of the file
+    :type urls: list[str]
+    :param size: size of the file in bytes
+    :type size: int
+    :param connections: number of concurrent connections, defaults to 4
+    :type connections: int, optional
+    :param segment_size: size of the segments in bytes, defaults to DEFAULT_SEGMENT_SIZE
+    :type segment_size: int, optional
+    """
+    urls = list(urls)
+    breaker = get_circuit_breaker() if breaker is None else breaker
+    scoreboard = get_scoreboard()
+    segments = [Segment(start, min(start + segment_size, size) - 1) for start in range(0, size, segment_size)]
+    max_attempts = max(3, 2 * len(urls))
+    bad_urls = set()
+
+    fd = os.open(local_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except (AttributeError, OSError):
+            os.ftruncate(fd, size)
+
+        with ThreadPoolExecutor(max_workers=connections) as pool:
+
+            def submit(segment: Segment):
+                candidates = [
+                    url for url in urls if url not in bad_urls and breaker.state(url_host(url)) != breaker.OPEN
+                ] or urls
+                # spread the segments over the replicas, moving on to the next replica on every retry
+                url = candidates[(segment.start // segment_size + segment.attempts) % len(candidates)]
+                pending[pool.submit(fetch_segment, url, fd, segment, timeout, limiter)] = (segment, url)
+
+            pending = {}
+            for segment in segments:
+                submit(segment)
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    segment, url = pending.pop(future)
+                    try:
+                        ttfb, seconds = future.result()
+                        breaker.record_success(url_host(url))
+                        scoreboard.record(url_host(url), True, ttfb, len(segment), seconds)
+                    except (SegmentRefusedError, requests.exceptions.RequestException, *STREAM_ERRORS) as e:
+                        if not isinstance(e, SegmentRefusedError):
+                            breaker.record_failure(url_host(url))
+                        scoreboard.record(url_host(url), False, reason=type(e).__name__)
+                        segment.attempts += 1
+                        LOGGER.warn(f"Segment {segment.start}-{segment.end} from {url_host(url)} failed: {e}")
+                        if isinstance(e, SegmentRefusedError):
+                            bad_urls.add(url)
+                        if segment.attempts >= max_attempts:
+                            for pending_future in pending:
+                                pending_future.cancel()
+                            LOGGER.error(f"Giving up on segment {segment.start}-{segment.end}")
+                            return False
+                        submit(segment)
+    finally:
+        os.close(fd)
+
+    return file_checksum(local_filename, checksum_type) == checksum.strip().lower()
+
+
+def install_file(
+    partial: str,
+    item,
+    local_filename: str,
+    cache: ChecksumCache,
+    log: Optional[Callable[[str], None]] = print,
+) -> bool:
+    """
+    Moves a verified download from its hidden partial file into its place in the local archive (see
+    cmip6_utils.file.install_partial). The checksum of the replica item is recorded in the checksum cache, so that
+    the installed file does not need to be hashed again.
+    """
+    log(f" ---> Moving downloaded file into place: {local_filename}")
+    install_partial(partial, local_filename)
+    cache.store(local_filename, item.checksum, item.checksum_type)
+    return True
+
+
+def fetch_file(
+    file_urls: list,
+    local_filename: str,
+    t: int,
+    cache: ChecksumCache,
+    segments: Optional[int] = 0,
+    segment_size: Optional[int] = DEFAULT_SEGMENT_SIZE,
+    limiter: Optional[HostLimiter] = None,
+    log: Optional[Callable[[str], None]] = print,
+) -> bool:
+    """
+    Downloads a file from the first of its replicas that works, trying the replicas on the fastest and healthiest
+    data nodes first. Files larger than segment_size are first downloaded in segments from all replicas at once
+    (if segments > 0). The download is written next to local_filename and moved into place once it is complete
+    and verified.
+
+    :param file_urls: replicas of the file, with url, checksum, checksum_type, data_node and size attributes
+    :type file_urls: list
+    :param t: timeout (in seconds) of the requests
+    :type t: int
+    :param limiter: per-host limit on concurrent downloads, defaults to None
+    :type limiter: HostLimiter, optional
+    :param log: function that prints the progress messages, defaults to print
+    :type log: Callable[[str], None], optional
+    :return: whether the file was downloaded
+    :rtype: bool
+    """
+    if not file_urls:
+        return False
+    # try the replicas on the fastest and healthiest data nodes first
+    file_urls = get_scoreboard().order(file_urls, host=lambda item: url_host(item.url), size=file_urls[0].size)
+
+    success = False
+    # downloads are written next to their place in the archive and moved into place once complete and verified
+    os.makedirs(os.path.dirname(local_filename), exist_ok=True)
+    partial = partial_filename(local_filename)
+
+    # replicas of the same file can be combined segment by segment
+    replicas = [item for item in file_urls if item.checksum.lower() == file_urls[0].checksum.lower()]
+    if segments and (replicas[0].size or 0) > segment_size:
+        item = replicas[0]
+        log(f" ---> Attempting segmented download from: {', '.join(r.data_node for r in replicas)}")
+        urls = [r.url for r in replicas]
+        if segmented_download(
+            urls, partial, item.size, item.checksum, item.checksum_type, segments, segment_size, t, limiter
+        ):
+            log(f" ---> Segmented download {BC.okgreen('successful')}, checksum {BC.okgreen('PASS')}")
+            success = install_file(partial, item, local_filename, cache, log)
+        else:
+            log(f" ---> Segmented download {BC.fail('unsuccessful')}")
+            discard_partial(partial)
+
+    for item in file_urls:
+        if success:
+            break
+        log(f" ---> Attempting download from: {item.data_node}")
+        with host_slot(limiter, item.url):
+            result = download_file(item.url, partial, timeout=t, size=item.size, checksum_type=item.checksum_type)
+
+        if result.ok:
+            log(f" ---> Download {BC.okgreen('successful')}")
+            # the file was hashed while it was downloaded
+            if result.digest == item.checksum.strip().lower():
+                log(f" ---> Checksum {BC.okgreen('PASS')}")
+                success = install_file(partial, item, local_filename, cache, log)
+            else:
+                log(f" ---> Checksum {BC.fail('FAIL')}")
+                discard_partial(partial)
+        else:
+            log(f" ---> Download {BC.fail('unsuccessful')}")
+
+    return success
@@ -0,0 +1,338 @@
+"""
+Client for the ESGF search API (esg-search).
+
+Looking up the replicas of many files one search request at a time costs one round trip per file before anything
+is downloaded. search_files packs many master_ids into each request (the values of a facet that is given more
+than once are OR'd by the search API), pages through the results with offset/limit and returns the replicas of
+every file in one pass. search_dataset finds all the files of a dataset version with a single (paged) search.
+
+Search responses are parsed as they arrive (see iterparse_file_docs), so that memory use does not grow with the size
+of the response and the first replicas can be downloaded before the whole response has been received (see
+stream_file_replicas).
+"""
+import logging
+import queue
+import threading
+from dataclasses import asdict, dataclass
+from typing import Iterable, Iterator, Optional
+
+import lxml.etree
+import requests
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+
+from cmip6_utils.nodes import url_host
+from cmip6_utils.search_cache import SearchCache, SearchCacheMiss
+from cmip6_utils.session import get_session_pool
+
+LOGGER = logging.getLogger("MAIN")
+
+# Number of master_ids per search request. Requests are sent as GET, so this also bounds the length of the url.
+DEFAULT_BATCH_SIZE = 40
+
+# Number of records per page of results
+DEFAULT_PAGE_SIZE = 500
+
+FILE_FIELDS = "master_id,url,checksum,checksum_type,size,data_node"
+
+# Facets of the directories of the CMIP6 DRS, from the project to the grid label (followed by the version)
+DRS_FACETS = [
+    "project",
+    "activity_id",
+    "institution_id",
+    "source_id",
+    "experiment_id",
+    "variant_label",
+    "table_id",
+    "variable_id",
+    "grid_label",
+]
+
+# Errors with which a search can fail, including while its (streamed) response is being parsed
+SEARCH_ERRORS = (
+    requests.exceptions.RequestException,
+    ProtocolError,
+    ReadTimeoutError,
+    lxml.etree.XMLSyntaxError,
+    SearchCacheMiss,
+)
+
+
+@dataclass
+class Replica:
+    url: str
+    checksum: str
+    checksum_type: str
+    size: Optional[int]
+    data_node: str
+
+
+def search_api(search_node: str) -> str:
+    """URL of the search API of a search node. The node can be given with a scheme (e.g. http://localhost:8080),
+    https is assumed otherwise."""
+    if "://" not in search_node:
+        search_node = f"https://{search_node}"
+    return f"{search_node.rstrip('/')}/esg-search/search"
+
+
+def _text(doc, tag: str, name: str) -> Optional[str]:
+    elem = doc.find(f'{tag}[@name="{name}"]')
+    if elem is None:
+        return None
+    if tag == "arr":
+        elem = elem.find("*")
+        if elem is None:
+            return None
+    return elem.text
+
+
+def parse_file_doc(doc) -> Optional[tuple[str, Replica]]:
+    """Returns (master_id, replica) for a File record of the search results, or None if the record has no HTTP url."""
+    for url in doc.findall('arr[@name="url"]/str'):
+        if url.text.endswith("HTTPServer"):
+            url = url.text.strip().split("|")[0].strip()
+            break
+    else:
+        return None
+
+    size = _text(doc, "long", "size")
+    replica = Replica(
+        url=url,
+        checksum=_text(doc, "arr", "checksum"),
+        checksum_type=_text(doc, "arr", "checksum_type") or "SHA256",
+        size=int(size) if size is not None else None,
+        data_node=_text(doc, "str", "data_node") or url_host(url),
+    )
+    return _text(doc, "str", "master_id"), replica
+
+
+def iterparse_file_docs(source, result: Optional[dict] = None) -> Iterator[tuple[str, Replica]]:
+    """
+    Parses the File records of a search response from a file-like object as it is read and yields (master_id,
+    replica) for every record with an HTTP url. Parsed records are cleared, so only one record is held in memory
+    at a time. If result is given, the attributes of the result element (e.g. numFound) are copied into it.
+    """
+    for event, elem in lxml.etree.iterparse(source, events=("start", "end"), tag=("result", "doc")):
+        if elem.tag == "result":
+            if event == "start" and result is not None:
+                result.update(elem.attrib)
+            continue
+        if event != "end":
+            continue
+
+        parsed = parse_file_doc(elem)
+        elem.clear(keep_tail=True)
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+        if parsed is not None:
+            yield parsed
+
+
+def search_file_pages(
+    search_node: str,
+    master_ids: list[str],
+    distrib: Optional[bool] = True,
+    page_size: Optional[int] = DEFAULT_PAGE_SIZE,
+    timeout: Optional[int] = 60,
+    facets: Optional[dict[str, str]] = None,
+) -> Iterator[tuple[str, Replica]]:
+    """
+    Searches for the File records of master_ids (and/or the records matching the given facets) in as many requests
+    as there are pages of results and yields (master_id, replica) for every record with an HTTP url, as the
+    responses arrive. Raises requests.HTTPError if a request fails.
+    """
+    api = search_api(search_node)
+    params = [
+        ("type", "File"),
+        ("distrib", str(distrib).lower()),
+        ("fields", FILE_FIELDS),
+        ("limit", page_size),
+    ] + [("master_id", master_id) for master_id in master_ids]
+    if facets is not None:
+        params += list(facets.items())
+
+    offset = 0
+    while True:
+        resp = get_session_pool().get(api, params=params + [("offset", offset)], timeout=timeout, stream=True)
+        try:
+            resp.raise_for_status()
+            # undo any transfer compression, the parser reads the raw stream
+            resp.raw.decode_content = True
+
+            result = {}
+            yield from iterparse_file_docs(resp.raw, result)
+        finally:
+            resp.close()
+
+        offset += page_size
+        if offset >= int(result.get("numFound", 0)):
+            break
+
+
+def search_files(
+    search_node: str,
+    master_ids: Iterable[str],
+    batch_size: Optional[int] = DEFAULT_BATCH_SIZE,
+    distrib: Optional[bool] = True,
+    page_size: Optional[int] = DEFAULT_PAGE_SIZE,
+    timeout: Optional[int] = 60,
+    cache: Optional[SearchCache] = None,
+    facets: Optional[dict[str, str]] = None,
+) -> dict[str, list[Replica]]:
+    """Searches for the replicas of many files, batch_size master_ids per request.
+
+    :param search_node: search node, with or without scheme
+    :type search_node: str
+    :param master_ids: master_ids of the files
+    :type master_ids: Iterable[str]
+    :param batch_size: number of master_ids per request, defaults to DEFAULT_BATCH_SIZE
+    :type batch_size: int, optional
+    :param cache: cache of search results to consult and fill, one entry per batch, defaults to None
+    :type cache: SearchCache, optional
+    :param facets: facets that the records must match as well, e.g. {"version": "20181212"}, defaults to None. A
+        master_id does not include the version of the dataset, so this selects the replicas of a dataset version.
+    :type facets: dict[str, str], optional
+    :return: master_id -> replicas of the file. master_ids without any replica are left out.
+    :rtype: dict[str, list[Replica]]
+    """
+    master_ids = list(dict.fromkeys(master_ids))
+    replicas = {}
+    for i in range(0, len(master_ids), batch_size):
+        batch = master_ids[i : i + batch_size]
+
+        def search():
+            return [
+                [master_id, asdict(replica)]
+                for master_id, replica in search_file_pages(search_node, batch, distrib, page_size, timeout, facets)
+            ]
+
+        if cache is not None:
+            key = {"search_node": search_node, "master_ids": batch, "distrib": distrib}
+            if facets:
+                key["facets"] = facets
+            records = cache.lookup("esgf.files", key, search)
+        else:
+            records = search()
+
+        for master_id, replica in records:
+            replicas.setdefault(master_id, []).append(Replica(**replica))
+    return replicas
+
+
+def stream_file_replicas(
+    search_node: str,
+    master_id: str,
+    errors: list,
+    distrib: Optional[bool] = True,
+    timeout: Optional[int] = 60,
+) -> Iterator[Replica]:
+    """
+    Searches for the replicas of a file and yields them as they are parsed from the search response, so that the
+    file can be downloaded from the first replica before the whole response has arrived. The response is read on a
+    background thread as fast as it arrives, so it is not held open while the consumer downloads the file.
+
+    A failed search ends the iteration early, and its error is appended to errors rather than raised, so that the
+    caller can tell it apart from errors raised while using the replicas (e.g. downloading the file).
+    """
+    replicas = queue.Queue()
+    done = object()
+
+    def read():
+        try:
+            for _, replica in search_file_pages(search_node, [master_id], distrib, timeout=timeout):
+                replicas.put(replica)
+        except SEARCH_ERRORS as e:
+            errors.append(e)
+        finally:
+            replicas.put(done)
+
+    threading.Thread(target=read, daemon=True).start()
+    while (replica := replicas.get()) is not done:
+        yield replica
+
+
+def dataset_facets(dataset: str) -> dict[str, str]:
+    """Search facets of a dataset version given by its DRS path (CMIP6/<activity_id>/.../<grid_label>/v<version>)."""
+    parts = dataset.strip("/").split("/")
+    if len(parts) != len(DRS_FACETS) + 1 or not parts[-1].startswith("v"):
+        raise ValueError(f"Not the DRS path of a dataset version: {dataset}")
+    facets = dict(zip(DRS_FACETS, parts))
+    facets["version"] = parts[-1][1:]
+    return facets
+
+
+def search_dataset(
+    search_node: str,
+    dataset: str,
+    distrib: Optional[bool] = True,
+    page_size: Optional[int] = DEFAULT_PAGE_SIZE,
+    timeout: Optional[int] = 60,
+    cache: Optional[SearchCache] = None,
+) -> dict[str, list[Replica]]:
+    """Searches for the replicas of all the files of a dataset version.
+
+    :param search_node: search node, with or without scheme
+    :type search_node: str
+    :param dataset: DRS path of the dataset version (CMIP6/<activity_id>/.../<grid_label>/v<version>)
+    :type dataset: str
+    :param cache: cache of search results to consult and fill, defaults to None
+    :type cache: SearchCache, optional
+    :return: filename -> replicas of the file
+    :rtype: dict[str, list[Replica]]
+    """
+    facets = dataset_facets(dataset)
+    # the master_id of a file is the DRS path of its dataset without the version (the facets pin the version) joined
+    # with dots, followed by the filename
+    prefix = dataset.strip("/").rpartition("/")[0].replace("/", ".") + "."
+
+    def search():
+        return [
+            [master_id, asdict(replica)]
+            for master_id, replica in search_file_pages(search_node, [], distrib, page_size, timeout, facets)
+        ]
+
+    if cache is not None:
+        key = {"search_node": search_node, "dataset": facets, "distrib": distrib}
+        records = cache.lookup("esgf.dataset", key, search)
+    else:
+        records = search()
+
+    replicas = {}
+    for master_id, replica in records:
+        if master_id.startswith(prefix):
+            replicas.setdefault(master_id[len(prefix) :], []).append(Replica(**replica))
+    return replicas
+
+
+def search_files_batched(
+    search_node: str,
+    items: Iterable[tuple],
+    batch_size: Optional[int] = DEFAULT_BATCH_SIZE,
+    **kwargs,
+) -> Iterator[tuple[tuple, list[Replica]]]:
+    """
+    Like search_files, but for a stream of items whose first element is a master_id: yields (item, replicas) one
+    batch at a time, so that the files of the first batch can be downloaded while the next batches are searched
+    for. Items without any replica are yielded with an empty list, and the items of a batch for which the search
+    failed with None.
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield from _search_batch(search_node, batch, **kwargs)
+            batch = []
+    if batch:
+        yield from _search_batch(search_node, batch, **kwargs)
+
+
+def _search_batch(search_node: str, batch: list[tuple], **kwargs) -> Iterator[tuple[tuple, list[Replica]]]:
+    try:
+        replicas = search_files(search_node, [item[0] for item in batch], batch_size=len(batch), **kwargs)
+    except SEARCH_ERRORS as e:
+        LOGGER.error(f"Search for {len(batch)} files failed: {e}")
+        for item in batch:
+            yield item, None
+        return
+
+    for item in batch:
+        yield item, replicas.get(item[0], [])
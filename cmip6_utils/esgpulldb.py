@@ -0,0 +1,112 @@
+"""
+Access to the SQLite database of an esgpull installation.
+
+The database is opened in WAL mode, so that other processes (e.g. esgpull itself, or other workers) can keep
+reading while this one commits. Files are streamed from their own read connection rather than loaded into memory,
+and status updates are batched: they are written with executemany in a single transaction every commit_every
+updates or commit_interval seconds, whichever comes first, instead of one transaction per file.
+"""
+import sqlite3
+import time
+from typing import Iterator, Optional
+
+DEFAULT_COMMIT_EVERY = 100
+
+DEFAULT_COMMIT_INTERVAL = 30.0  # s
+
+# Number of rows fetched at a time when streaming files
+FETCH_SIZE = 1000
+
+DONE = "Done"
+
+
+class EsgpullDB:
+    """
+    :param dbname: path of the esgpull database
+    :type dbname: str
+    :param commit_every: number of status updates after which they are committed, defaults to DEFAULT_COMMIT_EVERY
+    :type commit_every: int, optional
+    :param commit_interval: time in seconds after which pending updates are committed, defaults to
+        DEFAULT_COMMIT_INTERVAL
+    :type commit_interval: float, optional
+    """
+
+    def __init__(
+        self,
+        dbname: str,
+        commit_every: Optional[int] = DEFAULT_COMMIT_EVERY,
+        commit_interval: Optional[float] = DEFAULT_COMMIT_INTERVAL,
+    ):
+        self.dbname = dbname
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.con = sqlite3.connect(dbname, timeout=60)
+        self.con.row_factory = sqlite3.Row
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self._pending = []
+        self._last_commit = time.monotonic()
+
+    def __enter__(self) -> "EsgpullDB":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def count_files(self, exclude_status: Optional[str] = DONE) -> int:
+        """Number of files whose status is not exclude_status."""
+        return self.con.execute("SELECT COUNT(*) FROM file WHERE status!=?", (exclude_status,)).fetchone()[0]
+
+    def files(
+        self, exclude_status: Optional[str] = DONE, largest_first: Optional[bool] = False
+    ) -> Iterator[sqlite3.Row]:
+        """
+        Streams the files whose status is not exclude_status (all the files if it is None), the largest files first
+        if largest_first is True (so that they can be dispatched first, see cmip6_utils.scheduler). The rows are read
+        on a connection of their own, so status updates can be committed while the files are being iterated over (the
+        iteration sees the database as it was when it started).
+        """
+        sql, params = "SELECT * FROM file", ()
+        if exclude_status is not None:
+            sql, params = sql + " WHERE status!=?", (exclude_status,)
+        if largest_first:
+            sql += " ORDER BY size DESC"
+        con = sqlite3.connect(self.dbname, timeout=60)
+        con.row_factory = sqlite3.Row
+        try:
+            cur = con.execute(sql, params)
+            while True:
+                rows = cur.fetchmany(FETCH_SIZE)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            con.close()
+
+    def set_status(self, master_id: str, status: Optional[str] = DONE) -> None:
+        """Queues a status update, committing the pending updates if there are enough of them or they are old
+        enough."""
+        self._pending.append((status, master_id))
+        if len(self._pending) >= self.commit_every or time.monotonic() - self._last_commit >= self.commit_interval:
+            self.commit()
+
+    def commit(self) -> None:
+        """Writes the pending status updates in a single transaction."""
+        if self._pending:
+            with self.con:
+                self.con.executemany("UPDATE file SET status=? WHERE master_id=?", self._pending)
+            self._pending = []
+        self._last_commit = time.monotonic()
+
+    def backup(self, target: str) -> None:
+        """Copies the database to target with SQLite's online backup API, which gives a consistent copy even
+        while other connections write to the database."""
+        dst = sqlite3.connect(target)
+        try:
+            self.con.backup(dst)
+        finally:
+            dst.close()
+
+    def close(self) -> None:
+        """Commits the pending updates and closes the database."""
+        self.commit()
+        self.con.close()
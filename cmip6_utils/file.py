@@ -1,11 +1,19 @@
+import json
 import logging
+import os
 import shutil
 import time
+from dataclasses import dataclass
 from typing import Optional
 
 import requests
 from colorlog import ColoredFormatter
-from urllib3.exceptions import ReadTimeoutError
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+
+from cmip6_utils.checksum import DEFAULT_BLOCKSIZE, file_checksum, new_hasher
+from cmip6_utils.nodes import get_scoreboard, url_host
+from cmip6_utils.retry import DEFAULT_RETRY_POLICY, CircuitBreaker, RetryPolicy, get_circuit_breaker
+from cmip6_utils.session import get_session_pool
 
 LOGGER = logging.getLogger("MAIN")
 # formatter = ColoredFormatter("  %(log_color)s%(levelname)s:%(reset)s %(message)s")
@@ -15,17 +23,335 @@ LOGGER = logging.getLogger("MAIN")
 LOGGER.setLevel(logging.INFO)
 
 
-def download_file(url: str, local_filename: str, timeout: Optional[int] = 5) -> int:
+class IncompleteDownloadError(Exception):
+    """The stream ended before the number of bytes announced by the server was received."""
+
+
+class RangeMismatchError(Exception):
+    """The server answered a range request with a range that does not continue the partial file."""
+
+
+class TransferTimeoutError(Exception):
+    """The transfer took longer than the retry policy allows for the size of the file."""
+
+
+# ioctl request that makes a file share the data of another file (see linux/fs.h)
+FICLONE = 0x40049409
+
+# Errors while reading the response body after which the download is retried (and resumed if possible)
+STREAM_ERRORS = (
+    ReadTimeoutError,
+    ProtocolError,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError,
+    IncompleteDownloadError,
+    RangeMismatchError,
+    TransferTimeoutError,
+)
+
+# Status returned by download_file when no request was sent because the circuit of the host is open
+STATUS_CIRCUIT_OPEN = 492
+
+COPY_BUFSIZE = 1024 * 1024
+
+
+@dataclass
+class DownloadResult:
+    """Outcome of download_file."""
+
+    status: int  # HTTP status code of the last attempt, 200 on success
+    digest: Optional[str] = None  # hex digest of the file, if it was hashed and downloaded
+    size: int = 0  # size of the downloaded file in bytes
+
+    @property
+    def ok(self) -> bool:
+        return self.status == 200
+
+
+def state_filename(local_filename: str) -> str:
+    """Name of the sidecar file that records the state of a partial download."""
+    return local_filename + ".state"
+
+
+def partial_filename(local_filename: str) -> str:
+    """Name of the hidden file, next to local_filename, that a download is written to before it is moved into place.
+    Being on the same file system as local_filename, it can be moved into place with an atomic rename."""
+    dirname, basename = os.path.split(local_filename)
+    return os.path.join(dirname, f".{basename}.part")
+
+
+def install_partial(partial: str, local_filename: str) -> None:
+    """
+    Moves a completed (and verified) download into place: the partial file is flushed to disk and renamed to
+    local_filename, so that local_filename either does not exist or is complete, even if the machine crashes.
+    """
+    fd = os.open(partial, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(partial, local_filename)
+    clear_download_state(partial)
+
+    # make the rename itself durable
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(local_filename)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def discard_partial(partial: str) -> None:
+    """Removes a partial download that can not be used (e.g. because its checksum does not match)."""
+    for fname in (partial, state_filename(partial)):
+        try:
+            os.remove(fname)
+        except FileNotFoundError:
+            pass
+
+
+def clone_file(src: str, dst: str) -> bool:
+    """
+    Copies src to dst as a reflink where the file system supports it (e.g. Btrfs or XFS): dst then shares the data
+    of src, which is only copied as either file is modified, so cloning a file of any size is immediate. Elsewhere
+    the data is copied once.
+
+    :param src: name of the file to copy
+    :type src: str
+    :param dst: name of the copy
+    :type dst: str
+    :return: True if dst is a reflink of src, False if the data was copied
+    :rtype: bool
+    """
+    try:
+        import fcntl
+    except ImportError:  # not on a POSIX system
+        fcntl = None
+
+    if fcntl is not None:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return True
+            except OSError:
+                pass
+    shutil.copyfile(src, dst)
+    return False
+
+
+def load_download_state(local_filename: str, url: str) -> Optional[dict]:
+    """Returns the state of a partial download of url into local_filename, or None if there is nothing to resume."""
+    try:
+        with open(state_filename(local_filename), "r") as f:
+            state = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    if state.get("url") != url or not os.path.exists(local_filename):
+        return None
+    return state
+
+
+def save_download_state(local_filename: str, state: dict) -> None:
+    with open(state_filename(local_filename), "w") as f:
+        json.dump(state, f)
+
+
+def clear_download_state(local_filename: str) -> None:
+    try:
+        os.remove(state_filename(local_filename))
+    except FileNotFoundError:
+        pass
+
+
+def range_headers(local_filename: str, state: Optional[dict]) -> dict:
+    """Request headers that ask for the remainder of a partial download."""
+    if state is None:
+        return {}
+
+    offset = os.path.getsize(local_filename)
+    if offset == 0:
+        return {}
+
+    headers = {"Range": f"bytes={offset}-"}
+    # Only send the remainder if the file has not changed on the server, otherwise the server sends the whole file
+    validator = state.get("etag") or state.get("last_modified")
+    if validator:
+        headers["If-Range"] = validator
+    return headers
+
+
+def parse_content_range(content_range: Optional[str]) -> tuple[int, Optional[int]]:
+    """Parses a 'bytes start-end/total' Content-Range header into (start, total)."""
+    if not content_range or not content_range.startswith("bytes "):
+        raise RangeMismatchError(f"Invalid Content-Range: {content_range}")
+    byte_range, _, total = content_range[6:].partition("/")
+    start = int(byte_range.split("-")[0])
+    return start, None if total == "*" else int(total)
+
+
+def write_response(
+    resp: requests.Response,
+    url: str,
+    local_filename: str,
+    state: Optional[dict],
+    resume: bool,
+    policy: Optional[RetryPolicy] = None,
+    size: Optional[int] = None,
+    hasher=None,
+) -> None:
+    """
+    Writes the body of a 200 or 206 response to local_filename, appending to the partial file for a 206 response.
+    Raises IncompleteDownloadError if fewer bytes than announced by the server were received, and
+    TransferTimeoutError if the transfer takes longer than the policy allows for the size of the file (the length
+    announced by the server, or size if the server does not announce it).
+
+    If a hashlib object is given, every chunk is fed to it as it is written. For a 206 response, it must already
+    have been fed the partial file.
+    """
+    if resp.status_code == 206:
+        start, total = parse_content_range(resp.headers.get("Content-Range"))
+        if state is None or start != os.path.getsize(local_filename) or total != state.get("length"):
+            # the partial file can not be trusted anymore, start over on the next attempt
+            os.remove(local_filename)
+            clear_download_state(local_filename)
+            raise RangeMismatchError(f"Server sent range starting at {start} for a different partial file")
+        mode = "ab"
+        expected = total
+        LOGGER.info(f"Resuming download at byte {start}")
+    else:
+        mode = "wb"
+        expected = resp.headers.get("Content-Length")
+        # the length of an encoded response is not the length of the file
+        if expected is not None and "Content-Encoding" not in resp.headers:
+            expected = int(expected)
+        else:
+            expected = None
+
+        if resume:
+            state = {
+                "url": url,
+                "etag": resp.headers.get("ETag"),
+                "last_modified": resp.headers.get("Last-Modified"),
+                "length": expected,
+            }
+            save_download_state(local_filename, state)
+
+    offset = os.path.getsize(local_filename) if mode == "ab" else 0
+    length = expected if expected is not None else size
+    remaining = length - offset if length is not None else None
+    transfer_time = policy.transfer_time(remaining) if policy is not None else None
+    deadline = time.monotonic() + transfer_time if transfer_time is not None else None
+
+    with open(local_filename, mode) as f:
+        while True:
+            chunk = resp.raw.read(COPY_BUFSIZE)
+            if not chunk:
+                break
+            f.write(chunk)
+            if hasher is not None:
+                hasher.update(chunk)
+            if deadline is not None and time.monotonic() > deadline:
+                raise TransferTimeoutError(f"Transfer took longer than {transfer_time:.0f} s")
+
+    if expected is not None and os.path.getsize(local_filename) != expected:
+        raise IncompleteDownloadError(f"Received {os.path.getsize(local_filename)} of {expected} bytes")
+
+
+def hash_prefix(hasher, fname: str, length: int, blocksize: Optional[int] = DEFAULT_BLOCKSIZE) -> None:
+    """Feeds the first length bytes of a file to a hashlib object."""
+    with open(fname, "rb") as f:
+        while length > 0:
+            block = f.read(min(blocksize, length))
+            if not block:
+                break
+            hasher.update(block)
+            length -= len(block)
+
+
+def download_file(
+    url: str,
+    local_filename: str,
+    timeout: Optional[int] = 5,
+    resume: Optional[bool] = True,
+    size: Optional[int] = None,
+    policy: Optional[RetryPolicy] = None,
+    breaker: Optional[CircuitBreaker] = None,
+    checksum_type: Optional[str] = None,
+) -> DownloadResult:
+    """
+    Downloads url to local_filename, retrying when the connection fails or the stream breaks. Returns the HTTP
+    status code of the last attempt (i.e. 200 on success) and the size of the file in a DownloadResult.
+
+    If checksum_type is given (e.g. SHA256), the file is hashed as it is written and the hex digest is returned as
+    well, so that the file can be verified without reading it again. The digest is None unless the download
+    succeeded. When a partial download is resumed, the part that is already on disk is read once to hash it.
+
+    If resume is True, a partially downloaded file is kept together with a sidecar state file (see state_filename)
+    that records the url, ETag/Last-Modified and length of the file. The next attempt, whether in this call or in
+    a later one, only requests the missing bytes with a Range request. The partial file is discarded if the server
+    does not support ranges or if the file has changed on the server.
+
+    The number of attempts, the delays between them (exponential backoff with jitter) and the time a transfer may
+    take given the size of the file come from the retry policy. Failures are reported to the shared circuit
+    breaker; while the circuit of the host is open no request is sent and STATUS_CIRCUIT_OPEN is returned, so that
+    the caller can move on to another replica.
+
+    The outcome, time to first byte and throughput of the download are recorded in the data node scoreboard
+    (see cmip6_utils.nodes.get_scoreboard).
+
+    :param timeout: socket read timeout in seconds, i.e. how long the server may stall, defaults to 5
+    :type timeout: int, optional
+    :param size: expected size of the file in bytes, if the server does not announce it, defaults to None
+    :type size: int, optional
+    :param policy: retry policy, defaults to DEFAULT_RETRY_POLICY
+    :type policy: RetryPolicy, optional
+    :param breaker: circuit breaker, defaults to the one shared by all downloads (see get_circuit_breaker)
+    :type breaker: CircuitBreaker, optional
+    :param checksum_type: ESGF checksum type to hash the file with while it is written, defaults to None
+    :type checksum_type: str, optional
+    """
+    policy = DEFAULT_RETRY_POLICY if policy is None else policy
+    breaker = get_circuit_breaker() if breaker is None else breaker
+    host = url_host(url)
+
+    ttfb = None
+    nbytes = 0
+    seconds = 0.0
+    count = 0
     read_counter = 0
-    break_read_error_loop = False
+    status_code = STATUS_CIRCUIT_OPEN
+    digest = None
+    # whether this call took the probe of the host in the half-open state (see CircuitBreaker.allow)
+    probing = False
 
-    while (not break_read_error_loop) and (read_counter < 5):
-        count = 0
-        break_connection_error_loop = False
-        while (not break_connection_error_loop) and (count < 5):
+    try:
+        while count < policy.max_attempts and read_counter < policy.max_read_attempts:
+            allowed = breaker.allow(host)
+            if allowed == breaker.OPEN:
+                LOGGER.warn(f"Too many failures from {host}, not sending it any requests for now")
+                status_code = STATUS_CIRCUIT_OPEN
+                break
+            probing = probing or allowed == breaker.HALF_OPEN
+
+            state = load_download_state(local_filename, url) if resume else None
             try:
-                resp = requests.get(url, stream=True, timeout=timeout)
+                resp = get_session_pool().get(
+                    url,
+                    stream=True,
+                    timeout=(policy.connect_timeout, timeout),
+                    headers=range_headers(local_filename, state),
+                )
                 status_code = resp.status_code
+                ttfb = resp.elapsed.total_seconds()
+                if status_code not in (200, 206):
+                    # hand the connection back to the pool
+                    resp.close()
             except requests.exceptions.ReadTimeout:
                 LOGGER.warn("ReadTimeout from cmip6_utils.file.download_file")
                 status_code = 408
@@ -39,25 +365,64 @@ def download_file(url: str, local_filename: str, timeout: Optional[int] = 5) ->
                 LOGGER.warn("Unknown error from cmip6_utils.file.download_file")
                 status_code = 499
 
-            if status_code != 200:
-                count += 1
-                LOGGER.warn(f"Failed opening URL.... Retrying {count}")
-                time.sleep(timeout)
-            else:
-                break_connection_error_loop = True
+            if status_code == 416 and state is not None and os.path.getsize(local_filename) == state.get("length"):
+                # the partial file is already complete
+                clear_download_state(local_filename)
+                breaker.record_success(host)
+                get_scoreboard().record(host, True, ttfb, nbytes, seconds)
+                digest = file_checksum(local_filename, checksum_type) if checksum_type is not None else None
+                return DownloadResult(200, digest, os.path.getsize(local_filename))
 
-        if count == 5:
-            break_read_error_loop = True
+            if status_code not in (200, 206):
+                if policy.is_transient(status_code):
+                    breaker.record_failure(host)
+                else:
+                    breaker.record_success(host)
 
-        if status_code == 200:
+                count += 1
+                if not policy.is_transient(status_code) or count == policy.max_attempts:
+                    LOGGER.warn(f"Failed opening URL ({status_code}), giving up")
+                    break
+                delay = policy.delay(count)
+                LOGGER.warn(f"Failed opening URL ({status_code}).... Retrying {count} in {delay:.1f} s")
+                time.sleep(delay)
+                continue
+
+            # the server answered, start counting the attempts at opening the url afresh for the next read attempt
+            count = 0
+            offset = os.path.getsize(local_filename) if status_code == 206 else 0
+            hasher = None
+            if checksum_type is not None:
+                hasher = new_hasher(checksum_type)
+                if offset:
+                    hash_prefix(hasher, local_filename, offset)
+            start = time.perf_counter()
             try:
-                with open(local_filename, "wb") as f:
-                    shutil.copyfileobj(resp.raw, f)
-                break_read_error_loop = True
-            except ReadTimeoutError:
+                write_response(resp, url, local_filename, state, resume, policy, size, hasher)
+                if hasher is not None:
+                    digest = hasher.hexdigest()
+                clear_download_state(local_filename)
+                breaker.record_success(host)
+                status_code = 200
+                break
+            except STREAM_ERRORS as e:
                 read_counter += 1
-                LOGGER.warn(f"Reading from stream failed.... Retrying {read_counter}")
+                resp.close()
+                breaker.record_failure(host)
                 status_code = -1
-                time.sleep(timeout)
+                LOGGER.warn(f"Reading from stream failed ({e.__class__.__name__}).... Retrying {read_counter}")
+            finally:
+                seconds += time.perf_counter() - start
+                if os.path.exists(local_filename):
+                    nbytes += max(os.path.getsize(local_filename) - offset, 0)
+
+            if read_counter < policy.max_read_attempts:
+                time.sleep(policy.delay(read_counter))
+    finally:
+        # an unexpected exception must not leave the host probing, its circuit would never close again
+        if probing:
+            breaker.release(host)
 
-    return status_code
+    if status_code != STATUS_CIRCUIT_OPEN:
+        get_scoreboard().record(host, status_code == 200, ttfb, nbytes, seconds, reason=str(status_code))
+    return DownloadResult(status_code, digest, os.path.getsize(local_filename) if status_code == 200 else 0)
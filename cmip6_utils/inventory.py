@@ -0,0 +1,247 @@
+"""
+A persistent, on-disk SQLite index of a CMIP6 activity directory tree.
+
+Walking the CMIP6 tree on a shared filesystem is slow, and every script used to do its own full walk. The
+inventory records every directory (with its DRS facets) and every file (with its size, mtime and inode) so that
+the scripts can query the index instead of walking the filesystem.
+
+Rescans are incremental. The mtime of a directory only changes when entries are added to, removed from, or
+renamed inside it, so a directory whose mtime has not changed since the last scan is not listed again; its
+children are taken from the index instead. Note that modifying a file in place does not change the mtime of its
+directory, use a full rescan if files may have been rewritten in place.
+"""
+import os
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import Iterator, Optional
+
+from cmip6_utils.cmip6 import cmip6_activities
+
+DEFAULT_INVENTORY = os.path.expanduser("~/.cmip6_utils/inventory.sqlite")
+
+# DRS facets for each directory level below the activity directory, i.e. FACETS[CMIPDirLevels.source - 1] is
+# the facet for the source level.
+FACETS = ["institution", "source", "experiment", "variant", "table_id", "variable", "grid", "version"]
+
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS directory (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    activity TEXT NOT NULL,
+    level INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    {", ".join(f"{facet} TEXT" for facet in FACETS)}
+);
+CREATE INDEX IF NOT EXISTS directory_parent ON directory (parent);
+CREATE INDEX IF NOT EXISTS directory_level ON directory (activity, level);
+CREATE TABLE IF NOT EXISTS file (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS file_directory ON file (directory);
+"""
+
+
+@dataclass
+class ScanStats:
+    directories_visited: int = 0
+    directories_listed: int = 0
+    directories_removed: int = 0
+    files_indexed: int = 0
+    elapsed: float = 0.0
+
+
+def _like_prefix(path: str) -> str:
+    """Returns a LIKE pattern (with '\\' as the escape character) matching everything below path."""
+    return path.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "/%"
+
+
+def _activity_root(root_dir: str) -> str:
+    root_dir = os.path.abspath(root_dir).rstrip(os.path.sep)
+    if root_dir.split(os.path.sep)[-1] not in cmip6_activities:
+        raise RuntimeError("For the inventory to work, the root directory must end in a CMIP6 activity ID.")
+    return root_dir
+
+
+class CMIPInventory:
+    """
+    SQLite index of one or more CMIP6 activity directories.
+
+    Paths are stored as absolute paths and directory levels are counted the same way as in
+    :class:`cmip6_utils.dir.CMIPDirLevels`, i.e. relative to the activity directory.
+    """
+
+    def __init__(self, dbname: Optional[str] = DEFAULT_INVENTORY):
+        dirname = os.path.dirname(dbname)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.dbname = dbname
+        self.con = sqlite3.connect(dbname)
+        self.con.executescript(_SCHEMA)
+
+    def close(self):
+        self.con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _children(self, path: str) -> list[str]:
+        res = self.con.execute("SELECT path FROM directory WHERE parent=?", (path,))
+        return [row[0] for row in res]
+
+    def _files(self, path: str) -> list[str]:
+        res = self.con.execute("SELECT name FROM file WHERE directory=?", (path,))
+        return [row[0] for row in res]
+
+    def _remove_tree(self, path: str) -> None:
+        pattern = _like_prefix(path)
+        self.con.execute("DELETE FROM directory WHERE path=? OR path LIKE ? ESCAPE '\\'", (path, pattern))
+        self.con.execute("DELETE FROM file WHERE directory=? OR directory LIKE ? ESCAPE '\\'", (path, pattern))
+
+    def scan(self, root_dir: str, full: Optional[bool] = False) -> ScanStats:
+        """
+        Scans (or rescans) an activity directory and updates the index.
+
+        :param root_dir: path to the CMIP6 activity directory (e.g. /data/Datasets/CMIP6/CMIP)
+        :type root_dir: str
+        :param full: list every directory even if its mtime has not changed, defaults to False
+        :type full: bool, optional
+        :return: statistics of the scan
+        :rtype: ScanStats
+        """
+        root_dir = _activity_root(root_dir)
+        activity = os.path.basename(root_dir)
+        num_sep = root_dir.count(os.path.sep)
+        stats = ScanStats()
+        start = time.perf_counter()
+
+        with self.con:
+            stack = [(root_dir, None)]
+            while stack:
+                path, parent = stack.pop()
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    self._remove_tree(path)
+                    stats.directories_removed += 1
+                    continue
+                stats.directories_visited += 1
+
+                row = self.con.execute("SELECT mtime_ns, inode FROM directory WHERE path=?", (path,)).fetchone()
+                if not full and row == (st.st_mtime_ns, st.st_ino):
+                    stack.extend((child, path) for child in self._children(path))
+                    continue
+
+                subdirs = []
+                files = []
+                try:
+                    it = os.scandir(path)
+                except OSError:
+                    # as os.walk, skip the directories that cannot be listed (e.g. without read permission)
+                    continue
+                stats.directories_listed += 1
+                with it:
+                    for entry in it:
+                        # hidden entries, e.g. the partial files of downloads in progress, are not indexed
+                        if entry.name.startswith("."):
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                        elif entry.is_dir():
+                            # symbolic links to directories are not descended into, as with os.walk (they can form
+                            # cycles)
+                            continue
+                        else:
+                            try:
+                                fst = entry.stat()
+                            except OSError:  # e.g. a broken symbolic link
+                                continue
+                            files.append((entry.path, path, entry.name, fst.st_size, fst.st_mtime_ns, fst.st_ino))
+
+                level = path.count(os.path.sep) - num_sep
+                facets = path[len(root_dir) :].strip(os.path.sep).split(os.path.sep) if level > 0 else []
+                facets = facets + [None] * (len(FACETS) - len(facets))
+                self.con.execute(
+                    f"INSERT OR REPLACE INTO directory VALUES ({', '.join(['?'] * (6 + len(FACETS)))})",
+                    (path, parent, activity, level, st.st_mtime_ns, st.st_ino, *facets[: len(FACETS)]),
+                )
+
+                for child in set(self._children(path)) - set(subdirs):
+                    self._remove_tree(child)
+                    stats.directories_removed += 1
+
+                self.con.execute("DELETE FROM file WHERE directory=?", (path,))
+                self.con.executemany("INSERT INTO file VALUES (?, ?, ?, ?, ?, ?)", files)
+                stats.files_indexed += len(files)
+
+                stack.extend((child, path) for child in subdirs)
+
+        stats.elapsed = time.perf_counter() - start
+        return stats
+
+    def _check_indexed(self, path: str) -> None:
+        if self.con.execute("SELECT 1 FROM directory WHERE path=?", (path,)).fetchone() is None:
+            raise RuntimeError(f"{path} is not in the inventory {self.dbname}. Run 'cmip6_inventory' first.")
+
+    def walk(self, top: str) -> Iterator[tuple[str, list[str], list[str]]]:
+        """
+        Like os.walk (top-down), except that the directory tree is read from the index. As with os.walk, the
+        caller can prune the walk by removing entries from the returned list of directories.
+        """
+        top = os.path.abspath(top).rstrip(os.path.sep)
+        self._check_indexed(top)
+
+        stack = [top]
+        while stack:
+            root = stack.pop()
+            dirs = sorted(os.path.basename(child) for child in self._children(root))
+            files = sorted(self._files(root))
+            yield root, dirs, files
+            stack.extend(os.path.join(root, d) for d in reversed(dirs))
+
+    def select(
+        self, root_dir: str, level: int, patterns: dict[int, list[str]]
+    ) -> Iterator[tuple[str, list[str], list[str]]]:
+        """
+        Index backed equivalent of :func:`cmip6_utils.dir.find_cmip_directories`. The patterns are shell-style
+        patterns for the directory names, keyed by directory level.
+        """
+        root_dir = _activity_root(root_dir)
+        self._check_indexed(root_dir)
+
+        sql = "SELECT path FROM directory WHERE activity=? AND level=? AND path LIKE ? ESCAPE '\\'"
+        params = [os.path.basename(root_dir), level, _like_prefix(root_dir)]
+        for lvl, pats in patterns.items():
+            sql += " AND (" + " OR ".join([f"{FACETS[lvl - 1]} GLOB ?"] * len(pats)) + ")"
+            params.extend(pats)
+
+        res = self.con.execute(sql + " ORDER BY path", params)
+        for (root,) in res.fetchall():
+            dirs = sorted(os.path.basename(child) for child in self._children(root))
+            files = sorted(self._files(root))
+            yield root, dirs, files
+
+    def directories_at_level(self, root_dir: str, level: int) -> Iterator[tuple[str, list[str], list[str]]]:
+        """
+        Index backed equivalent of :func:`cmip6_utils.dir.get_cmip_directories_at_level`.
+        """
+        root_dir = _activity_root(root_dir)
+        self._check_indexed(root_dir)
+
+        res = self.con.execute(
+            "SELECT path FROM directory WHERE activity=? AND level=? AND path LIKE ? ESCAPE '\\' ORDER BY path",
+            (os.path.basename(root_dir), level, _like_prefix(root_dir)),
+        )
+        for (root,) in res.fetchall():
+            dirs = sorted(os.path.basename(child) for child in self._children(root))
+            files = sorted(self._files(root))
+            yield root, dirs, files
@@ -1,7 +1,9 @@
-import hashlib
+from typing import Optional
 
 import requests
 
+from cmip6_utils.checksum import DEFAULT_BLOCKSIZE, ChecksumCache, file_checksum
+
 
 class BC:
     HEADER = "\033[95m"
@@ -35,9 +37,20 @@ class BC:
         return cls.HEADER + s + cls.ENDC
 
 
-def verify_checksum(fname: str, refchecksum: str) -> bool:
-    checksum = hashlib.sha256(open(fname, "rb").read()).hexdigest()
-    return checksum == refchecksum
+def verify_checksum(
+    fname: str,
+    refchecksum: str,
+    checksum_type: Optional[str] = "SHA256",
+    blocksize: Optional[int] = DEFAULT_BLOCKSIZE,
+    cache: Optional[ChecksumCache] = None,
+) -> bool:
+    """Verifies the checksum of a file. If a checksum cache is given and the file has not changed since it was last
+    hashed, the cached checksum is used instead of reading the file."""
+    if cache is not None:
+        checksum = cache.checksum(fname, checksum_type, blocksize)
+    else:
+        checksum = file_checksum(fname, checksum_type, blocksize)
+    return checksum == refchecksum.strip().lower()
 
 
 def ESGF_offline_nodes() -> list[str]:
@@ -1,8 +1,29 @@
-from typing import Optional
+import itertools
+import math
+from typing import Iterator, Optional
 
 from netCDF4 import Dataset, Variable
 
-__all__ = ["copy_dimension_definitions", "copy_variable_definitions", "copy_file_metadata", "bulk_copy_variable_data"]
+__all__ = [
+    "copy_dimension_definitions",
+    "copy_variable_definitions",
+    "copy_file_metadata",
+    "bulk_copy_variable_data",
+    "copy_blocks",
+    "copy_variable_data",
+    "raw_chunk_layouts",
+    "copy_raw_chunks",
+    "DEFAULT_COPY_BUDGET",
+]
+
+# Maximum size (in bytes) of the blocks in which variable data is copied
+DEFAULT_COPY_BUDGET = 64 * 2**20
+
+# HDF5 filters that do not compress the data
+_NON_COMPRESSING_FILTERS = {2, 3}  # shuffle, fletcher32
+
+# Attributes that netCDF4 uses to decode the stored values
+_DECODING_ATTRIBUTES = ["missing_value", "scale_factor", "add_offset"]
 
 
 def make_chunks(ncf: Dataset, var: Variable, user_chunks: Optional[dict[str, int]] = None) -> tuple:
@@ -35,6 +56,7 @@ def copy_variable_definitions(
     exclude: Optional[list] = [],
     user_chunks: Optional[dict[str, int]] = None,
     deflate: Optional[int] = 4,
+    keep_layout: Optional[list] = [],
 ) -> None:
     for var_name in ncf.variables:
         if var_name in exclude:
@@ -42,6 +64,24 @@ def copy_variable_definitions(
 
         var = ncf[var_name]
         chunking = var.chunking()
+
+        if var_name in keep_layout:
+            # same chunks, filters and byte order as in ncf, so that the stored chunks can be copied as they are
+            filters = var.filters()
+            ovar = oncf.createVariable(
+                var_name,
+                var.datatype,
+                dimensions=var.dimensions,
+                chunksizes=chunking,
+                zlib=filters["zlib"],
+                complevel=filters["complevel"],
+                shuffle=filters["shuffle"],
+                fletcher32=filters["fletcher32"],
+                endian=var.endian(),
+                fill_value=var._FillValue if hasattr(var, "_FillValue") else None,
+            )
+            ovar.setncatts(var.__dict__)
+            continue
         try:
             filters = var.filters()
             complevel = filters["complevel"]
@@ -50,7 +90,8 @@ def copy_variable_definitions(
 
         fill_value = var._FillValue if hasattr(var, "_FillValue") else None
 
-        if chunking == "contiguous":
+        # time is unlimited in oncf (see copy_dimension_definitions), and variables along it must be chunked
+        if chunking == "contiguous" and "time" not in var.dimensions:
             chunks = None
             contiguous = True
         else:
@@ -91,7 +132,110 @@ def copy_file_metadata(oncf: Dataset, metadata: dict):
     oncf.setncatts(metadata)
 
 
-def bulk_copy_variable_data(ncf: Dataset, oncf: Dataset, exclude: Optional[list] = [], time_offset: Optional[int] = 0):
+def copy_blocks(
+    shape: tuple[int, ...],
+    itemsize: int,
+    chunks: Optional[list[int]] = None,
+    budget: Optional[int] = DEFAULT_COPY_BUDGET,
+    axes: Optional[list[int]] = None,
+) -> Iterator[tuple[slice, ...]]:
+    """
+    Splits an array into blocks of at most budget bytes, so that it can be copied one block at a time.
+
+    The array is split along the axes in the order given by axes, and only along as many of them as needed to fit
+    the budget: first along axes[0], in whole chunks if at least one chunk fits, then along axes[1] if a single
+    element along axes[0] is still too large, and so on. A single element is never split.
+
+    :param shape: shape of the array
+    :type shape: tuple[int, ...]
+    :param itemsize: size in bytes of an element of the array
+    :type itemsize: int
+    :param chunks: chunk shape of the array, defaults to None (contiguous)
+    :type chunks: list[int], optional
+    :param budget: maximum size of a block in bytes, defaults to DEFAULT_COPY_BUDGET
+    :type budget: int, optional
+    :param axes: axes along which the array may be split, in order, defaults to None (all axes, in order)
+    :type axes: list[int], optional
+    :return: the blocks, as tuples of slices
+    :rtype: Iterator[tuple[slice, ...]]
+    """
+    if 0 in shape:
+        return
+    chunks = chunks or [1] * len(shape)
+    axes = range(len(shape)) if axes is None else axes
+
+    block = list(shape)
+    size = itemsize * math.prod(shape)
+    for axis in axes:
+        if size <= budget:
+            break
+        slab = size // shape[axis]
+        length = budget // slab
+        if length >= chunks[axis]:
+            length = length // chunks[axis] * chunks[axis]
+        block[axis] = max(length, 1)
+        size = slab * block[axis]
+
+    starts = [range(0, length, step) for length, step in zip(shape, block)]
+    for start in itertools.product(*starts):
+        yield tuple(slice(i, min(i + step, length)) for i, step, length in zip(start, block, shape))
+
+
+def copy_variable_data(
+    ivar: Variable,
+    ovar: Variable,
+    src: Optional[int] = 0,
+    dst: Optional[int] = 0,
+    count: Optional[int] = None,
+    axis: Optional[int] = 0,
+    budget: Optional[int] = DEFAULT_COPY_BUDGET,
+) -> None:
+    """
+    Copies count elements along axis of ivar, starting at index src, into ovar starting at index dst, in blocks of
+    at most budget bytes (see copy_blocks) that are aligned to the chunks of ivar. Only one block is held in memory at
+    a time, so the memory used does not depend on the size of the variable.
+
+    :param ivar: variable to copy from
+    :type ivar: Variable
+    :param ovar: variable to copy to
+    :type ovar: Variable
+    :param src: start index in ivar along axis, defaults to 0
+    :type src: int, optional
+    :param dst: start index in ovar along axis, defaults to 0
+    :type dst: int, optional
+    :param count: number of elements to copy along axis, defaults to None (up to the end of ivar)
+    :type count: int, optional
+    :param axis: axis along which src, dst and count apply, usually the time axis. The blocks are split along this
+        axis first, defaults to 0
+    :type axis: int, optional
+    :param budget: maximum size of a block in bytes, defaults to DEFAULT_COPY_BUDGET
+    :type budget: int, optional
+    """
+    if ivar.ndim == 0:
+        ovar[:] = ivar[:]
+        return
+
+    shape = list(ivar.shape)
+    shape[axis] = shape[axis] - src if count is None else count
+    chunking = ivar.chunking()
+    chunks = None if chunking == "contiguous" else chunking
+    axes = [axis] + [i for i in range(ivar.ndim) if i != axis]
+
+    for block in copy_blocks(tuple(shape), getattr(ivar.dtype, "itemsize", 8), chunks, budget, axes):
+        isel = list(block)
+        osel = list(block)
+        isel[axis] = slice(block[axis].start + src, block[axis].stop + src)
+        osel[axis] = slice(block[axis].start + dst, block[axis].stop + dst)
+        ovar[tuple(osel)] = ivar[tuple(isel)]
+
+
+def bulk_copy_variable_data(
+    ncf: Dataset,
+    oncf: Dataset,
+    exclude: Optional[list] = [],
+    time_offset: Optional[int] = 0,
+    budget: Optional[int] = DEFAULT_COPY_BUDGET,
+):
     for var_name in oncf.variables:
         if var_name in exclude:
             continue
@@ -100,6 +244,92 @@ def bulk_copy_variable_data(ncf: Dataset, oncf: Dataset, exclude: Optional[list]
         ivar = ncf.variables[var_name]
 
         if "time" in ivar.dimensions:
-            ovar[time_offset : time_offset + len(ivar)] = ivar[:]
+            copy_variable_data(ivar, ovar, dst=time_offset, axis=ivar.dimensions.index("time"), budget=budget)
         else:
-            ovar[:] = ivar[:]
+            copy_variable_data(ivar, ovar, budget=budget)
+
+
+def raw_chunk_layouts(fname: str, axes: dict[str, int]) -> dict[str, tuple]:
+    """
+    Storage layouts of variables in an HDF5 based netCDF file: their dtype, their shape except along their axis in
+    axes, their chunk shape, their filters, and the attributes used to decode their values. The stored chunks of a
+    variable can be copied as they are (see copy_raw_chunks) between files in which it has the same layout.
+
+    Only the variables that are chunked and compressed are returned. Nothing is returned if the file is not an HDF5
+    file, or if h5py is not installed.
+
+    :param fname: name of the file
+    :type fname: str
+    :param axes: names of the variables, and the axis of each along which the files are to be combined
+    :type axes: dict[str, int]
+    :return: the layouts of the variables, by name
+    :rtype: dict[str, tuple]
+    """
+    try:
+        import h5py
+    except ImportError:
+        return {}
+
+    try:
+        f = h5py.File(fname, "r")
+    except OSError:  # e.g. a netCDF3 file
+        return {}
+
+    layouts = {}
+    with f:
+        for var_name, axis in axes.items():
+            dset = f.get(var_name)
+            if not isinstance(dset, h5py.Dataset) or dset.chunks is None:
+                continue
+            plist = dset.id.get_create_plist()
+            filters = tuple(plist.get_filter(i)[:3] for i in range(plist.get_nfilters()))
+            if all(code in _NON_COMPRESSING_FILTERS for code, _, _ in filters):
+                continue
+            shape = dset.shape[:axis] + dset.shape[axis + 1 :]
+            # repr, because nan fill values do not compare equal
+            attrs = tuple((key, repr(dset.attrs[key])) for key in _DECODING_ATTRIBUTES if key in dset.attrs)
+            layouts[var_name] = (dset.dtype.str, shape, dset.chunks, filters, repr(dset.fillvalue), attrs)
+    return layouts
+
+
+def copy_raw_chunks(ifname: str, ofname: str, axes: dict[str, int], offset: int, length: int) -> None:
+    """
+    Copies the stored chunks of variables from one HDF5 based netCDF file to another byte for byte, without
+    decompressing and recompressing them, shifted by offset along the axis of each variable. The variables must have
+    the same layout in both files (see raw_chunk_layouts), and offset must be a multiple of their chunk length along
+    their axis. The variables in ofname are first extended to length along their axis. ofname must not be open.
+
+    :param ifname: name of the file to copy from
+    :type ifname: str
+    :param ofname: name of the file to copy to
+    :type ofname: str
+    :param axes: names of the variables, and the axis of each along which the chunks are shifted
+    :type axes: dict[str, int]
+    :param offset: index in ofname along the axis at which the chunks of ifname start
+    :type offset: int
+    :param length: length of the variables in ofname along their axis
+    :type length: int
+    """
+    import h5py
+
+    with h5py.File(ifname, "r") as f, h5py.File(ofname, "r+") as of:
+        for var_name, axis in axes.items():
+            dsid = f[var_name].id
+            odset = of[var_name]
+            if odset.shape[axis] < length:
+                shape = list(odset.shape)
+                shape[axis] = length
+                odset.resize(shape)
+
+            # only the chunks that are stored, chunks that were never written read as the fill value anyway
+            chunks = []
+            if hasattr(dsid, "chunk_iter"):
+                dsid.chunk_iter(chunks.append)
+            else:
+                chunks = [dsid.get_chunk_info(i) for i in range(dsid.get_num_chunks())]
+
+            for chunk in chunks:
+                filter_mask, data = dsid.read_direct_chunk(chunk.chunk_offset)
+                ooffset = list(chunk.chunk_offset)
+                ooffset[axis] += offset
+                odset.id.write_direct_chunk(tuple(ooffset), data, filter_mask)
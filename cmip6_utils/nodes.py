@@ -0,0 +1,234 @@
+"""
+Performance scoreboard of ESGF data nodes.
+
+Every download_file call records its outcome for the data node it downloaded from: whether it succeeded, the time
+to first byte and the number of bytes received and the time it took. The statistics are kept in a local SQLite
+database so that they build up across runs, and are used to try the replicas of a file on the fastest and
+healthiest nodes first.
+"""
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Iterable, Iterator, Optional, TypeVar
+from urllib.parse import urlparse
+
+DEFAULT_SCOREBOARD = os.path.expanduser("~/.cmip6_utils/nodes.sqlite")
+
+# Assumed for nodes that have not been downloaded from yet, so that new nodes get tried
+PRIOR_THROUGHPUT = 5e6  # bytes/s
+PRIOR_TTFB = 1.0  # s
+
+# Size of the file for which the expected download time of the nodes is compared when the size is not known
+REFERENCE_SIZE = 100e6
+
+# Nodes that failed more recently than this (and have not succeeded since) are tried last
+FAILURE_COOLDOWN = 15 * 60  # s
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS node (
+    host TEXT PRIMARY KEY,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    successes INTEGER NOT NULL DEFAULT 0,
+    ttfb_total REAL NOT NULL DEFAULT 0,
+    ttfb_count INTEGER NOT NULL DEFAULT 0,
+    nbytes INTEGER NOT NULL DEFAULT 0,
+    seconds REAL NOT NULL DEFAULT 0,
+    last_success REAL,
+    last_failure REAL,
+    last_failure_reason TEXT
+);
+"""
+
+T = TypeVar("T")
+
+
+@dataclass
+class NodeStats:
+    host: str
+    attempts: int = 0
+    successes: int = 0
+    ttfb_total: float = 0.0
+    ttfb_count: int = 0
+    nbytes: int = 0
+    seconds: float = 0.0
+    last_success: Optional[float] = None
+    last_failure: Optional[float] = None
+    last_failure_reason: Optional[str] = None
+
+    @property
+    def success_rate(self) -> float:
+        """Fraction of successful downloads, smoothed so that a node with few attempts is not judged too harshly."""
+        return (self.successes + 1) / (self.attempts + 2)
+
+    @property
+    def ttfb(self) -> float:
+        """Average time to first byte in seconds."""
+        return self.ttfb_total / self.ttfb_count if self.ttfb_count else PRIOR_TTFB
+
+    @property
+    def throughput(self) -> float:
+        """Sustained throughput in bytes/s."""
+        return self.nbytes / self.seconds if self.seconds > 0 else PRIOR_THROUGHPUT
+
+    @property
+    def recently_failed(self) -> bool:
+        if self.last_failure is None:
+            return False
+        if self.last_success is not None and self.last_success > self.last_failure:
+            return False
+        return time.time() - self.last_failure < FAILURE_COOLDOWN
+
+    def expected_time(self, size: Optional[int] = None) -> float:
+        """Expected time (in seconds) to download a file of the given size, including the retries on failures."""
+        size = REFERENCE_SIZE if not size else size
+        return (self.ttfb + size / self.throughput) / self.success_rate
+
+    def report(self) -> str:
+        return (
+            f"{self.host}: {self.successes}/{self.attempts} successful, TTFB {self.ttfb:.2f} s, "
+            f"{self.throughput / 1e6:.1f} MB/s, last failure: {self.last_failure_reason or '-'}"
+        )
+
+
+class NodeScoreboard:
+    """
+    SQLite store of per-node download statistics. The scoreboard can be shared between threads (each thread uses
+    its own connection).
+    """
+
+    def __init__(self, dbname: Optional[str] = DEFAULT_SCOREBOARD):
+        dirname = os.path.dirname(dbname)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.dbname = dbname
+        self._local = threading.local()
+        with self._connection() as con:
+            con.executescript(_SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = sqlite3.connect(self.dbname, timeout=60)
+            con.row_factory = sqlite3.Row
+            self._local.con = con
+        return con
+
+    def record(
+        self,
+        host: str,
+        success: bool,
+        ttfb: Optional[float] = None,
+        nbytes: Optional[int] = 0,
+        seconds: Optional[float] = 0.0,
+        reason: Optional[str] = None,
+    ) -> None:
+        """Records the outcome of a download from host.
+
+        :param success: whether the file was downloaded
+        :type success: bool
+        :param ttfb: time to first byte (response headers) in seconds, if a response was received
+        :type ttfb: float, optional
+        :param nbytes: number of bytes of the file received
+        :type nbytes: int, optional
+        :param seconds: time spent receiving these bytes
+        :type seconds: float, optional
+        :param reason: why the download failed (e.g. the HTTP status code)
+        :type reason: str, optional
+        """
+        now = time.time()
+        with self._connection() as con:
+            con.execute("INSERT OR IGNORE INTO node (host) VALUES (?)", (host,))
+            con.execute(
+                """
+                UPDATE node SET
+                    attempts = attempts + 1,
+                    successes = successes + ?,
+                    ttfb_total = ttfb_total + ?,
+                    ttfb_count = ttfb_count + ?,
+                    nbytes = nbytes + ?,
+                    seconds = seconds + ?,
+                    last_success = CASE WHEN ? THEN ? ELSE last_success END,
+                    last_failure = CASE WHEN ? THEN last_failure ELSE ? END,
+                    last_failure_reason = CASE WHEN ? THEN last_failure_reason ELSE ? END
+                WHERE host = ?
+                """,
+                (
+                    int(success),
+                    ttfb or 0.0,
+                    int(ttfb is not None),
+                    nbytes,
+                    seconds,
+                    success,
+                    now,
+                    success,
+                    now,
+                    success,
+                    reason,
+                    host,
+                ),
+            )
+
+    def stats(self, host: str) -> NodeStats:
+        row = self._connection().execute("SELECT * FROM node WHERE host=?", (host,)).fetchone()
+        return NodeStats(**row) if row is not None else NodeStats(host)
+
+    def all_stats(self) -> list[NodeStats]:
+        return [NodeStats(**row) for row in self._connection().execute("SELECT * FROM node ORDER BY host")]
+
+    def order(self, items: Iterable[T], host: Callable[[T], str], size: Optional[int] = None) -> list[T]:
+        """
+        Sorts items (e.g. the replicas of a file) so that the ones on the healthiest and fastest nodes come first:
+        nodes that failed recently go last, the others are sorted by the expected time to download a file of the
+        given size. The sort is stable, so replicas on unknown nodes keep the order of the search results.
+
+        :param host: function that returns the host (data node) of an item
+        :type host: Callable
+        """
+        items = list(items)
+        stats = {h: self.stats(h) for h in {host(item) for item in items}}
+        return sorted(
+            items, key=lambda item: (stats[host(item)].recently_failed, stats[host(item)].expected_time(size))
+        )
+
+    def order_stream(self, items: Iterable[T], host: Callable[[T], str], size: Optional[int] = None) -> Iterator[T]:
+        """
+        Like order, for items that arrive one at a time (e.g. parsed from a search response as it is received):
+        items are passed on as they come, except the ones on nodes that failed recently, which are held back and
+        passed on last, in the order given by order.
+        """
+        deferred = []
+        for item in items:
+            if self.stats(host(item)).recently_failed:
+                deferred.append(item)
+            else:
+                yield item
+        yield from self.order(deferred, host, size)
+
+    def report(self) -> list[str]:
+        return [stats.report() for stats in self.all_stats()]
+
+
+_SCOREBOARD = None
+_SCOREBOARD_LOCK = threading.Lock()
+
+
+def get_scoreboard() -> NodeScoreboard:
+    """Returns the scoreboard updated by download_file, opening the default one on first use."""
+    global _SCOREBOARD
+    with _SCOREBOARD_LOCK:
+        if _SCOREBOARD is None:
+            _SCOREBOARD = NodeScoreboard()
+        return _SCOREBOARD
+
+
+def set_scoreboard(scoreboard: NodeScoreboard) -> None:
+    """Replaces the scoreboard updated by download_file (e.g. to use another database)."""
+    global _SCOREBOARD
+    with _SCOREBOARD_LOCK:
+        _SCOREBOARD = scoreboard
+
+
+def url_host(url: str) -> str:
+    return urlparse(url).hostname
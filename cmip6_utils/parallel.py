@@ -1,7 +1,8 @@
 class MPPartition(object):
     """
     Helps partition a range of values into ranges to be worked on by
-    various processors.
+    various processors. For work items of different sizes, see
+    cmip6_utils.scheduler (dynamic dispatch and cost-weighted partitioning).
     """
 
     def __init__(self, start, end, nprocs):
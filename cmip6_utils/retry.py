@@ -0,0 +1,150 @@
+"""
+Retry policy and circuit breaker for downloads.
+
+A RetryPolicy decides how long to wait between the attempts of a download (exponential backoff with jitter, so
+that many downloads failing at the same time do not all retry at the same time) and how long a transfer may take
+given the size of the file. A CircuitBreaker is shared by all downloads: after repeated failures it stops sending
+requests to a host, and after a while lets a single request through to probe whether the host is back.
+"""
+import random
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+
+@dataclass
+class RetryPolicy:
+    """
+    :param max_attempts: maximum number of attempts at opening the url (per attempt at reading the stream)
+    :type max_attempts: int
+    :param max_read_attempts: maximum number of attempts at reading the stream
+    :type max_read_attempts: int
+    :param base_delay: delay before the first retry in seconds, doubled for every further retry
+    :type base_delay: float
+    :param max_delay: upper bound of the delay between retries in seconds
+    :type max_delay: float
+    :param jitter: fraction of the delay that is randomized
+    :type jitter: float
+    :param connect_timeout: timeout for establishing a connection in seconds
+    :type connect_timeout: float
+    :param min_throughput: slowest acceptable throughput in bytes/s, determines how long a transfer may take
+    :type min_throughput: float
+    :param min_transfer_time: a transfer is never abandoned before this many seconds
+    :type min_transfer_time: float
+    """
+
+    max_attempts: int = 5
+    max_read_attempts: int = 5
+    base_delay: float = 1.0
+    max_delay: float = 60.0
+    jitter: float = 0.5
+    connect_timeout: float = 10.0
+    min_throughput: float = 50e3
+    min_transfer_time: float = 60.0
+
+    def delay(self, attempt: int) -> float:
+        """Time to wait (in seconds) before retry number attempt (starting at 1)."""
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay * (1 - self.jitter + self.jitter * random.random())
+
+    def transfer_time(self, nbytes: Optional[int]) -> Optional[float]:
+        """Time (in seconds) after which a transfer of nbytes is abandoned, or None if the size is not known."""
+        if nbytes is None:
+            return None
+        return self.min_transfer_time + nbytes / self.min_throughput
+
+    @staticmethod
+    def is_transient(status_code: int) -> bool:
+        """Whether a failed attempt may succeed when retried, i.e. the host could not be reached or can not serve
+        the request right now (as opposed to e.g. 404 Not Found). Transient failures count against the host in the
+        circuit breaker. Besides HTTP status codes, this covers the codes download_file uses for timeouts (408),
+        connection errors (491), other errors (499) and broken streams (-1)."""
+        return status_code >= 500 or status_code in (-1, 408, 429, 491, 499)
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
+class CircuitBreaker:
+    """
+    Per-host circuit breaker. A host's circuit opens after failure_threshold consecutive failures, and requests to
+    the host are refused while it is open. Once reset_timeout seconds have passed, the circuit is half-open: a
+    single request is let through as a probe. If it succeeds the circuit closes, otherwise it opens again.
+    The breaker can be shared between threads.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold: Optional[int] = 5, reset_timeout: Optional[float] = 300.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = {}
+        self._opened_at = {}
+        self._probing = {}  # host -> thread that holds its probe
+
+    def state(self, host: str) -> str:
+        with self._lock:
+            return self._state(host)
+
+    def _state(self, host: str) -> str:
+        if host not in self._opened_at:
+            return self.CLOSED
+        if host in self._probing or time.monotonic() - self._opened_at[host] >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow(self, host: str) -> str:
+        """Whether a request may be sent to the host: CLOSED if it may, HALF_OPEN if it may as the probe of the host,
+        and OPEN if it may not. In the half-open state only the first caller gets to probe; it must then record the
+        outcome of its request, or release the probe."""
+        with self._lock:
+            state = self._state(host)
+            if state == self.CLOSED:
+                return self.CLOSED
+            if state == self.HALF_OPEN and host not in self._probing:
+                self._probing[host] = threading.get_ident()
+                return self.HALF_OPEN
+            return self.OPEN
+
+    def record_success(self, host: str) -> None:
+        with self._lock:
+            self._failures.pop(host, None)
+            self._opened_at.pop(host, None)
+            self._probing.pop(host, None)
+
+    def record_failure(self, host: str) -> None:
+        with self._lock:
+            self._failures[host] = self._failures.get(host, 0) + 1
+            if host in self._probing or self._failures[host] >= self.failure_threshold:
+                self._opened_at[host] = time.monotonic()
+                self._probing.pop(host, None)
+
+    def release(self, host: str) -> None:
+        """Ends the probe of a half-open host without recording an outcome, e.g. when the request raised an
+        unexpected exception, so that the next caller can probe the host again. Only the thread that holds the probe
+        (see allow) can release it."""
+        with self._lock:
+            if self._probing.get(host) == threading.get_ident():
+                del self._probing[host]
+
+    def open_hosts(self) -> list[str]:
+        with self._lock:
+            return [host for host in self._opened_at if self._state(host) == self.OPEN]
+
+
+_CIRCUIT_BREAKER = CircuitBreaker()
+
+
+def get_circuit_breaker() -> CircuitBreaker:
+    """Returns the circuit breaker shared by all download_file calls."""
+    return _CIRCUIT_BREAKER
+
+
+def set_circuit_breaker(breaker: CircuitBreaker) -> None:
+    """Replaces the circuit breaker shared by all download_file calls."""
+    global _CIRCUIT_BREAKER
+    _CIRCUIT_BREAKER = breaker
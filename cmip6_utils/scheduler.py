@@ -0,0 +1,149 @@
+"""
+Scheduling of jobs with very different costs (file sizes, data node speeds) over a number of workers.
+
+Splitting the jobs into equal contiguous ranges up front (as MPPartition does) leaves most workers idle while the
+one that got the largest or slowest jobs finishes. The Scheduler instead keeps the jobs in a queue shared by all
+workers, and a worker takes the next job as soon as it is done with the previous one (dynamic dispatch; with a
+shared queue there is nothing left to steal). If the cost of the jobs is known, the most expensive jobs are
+dispatched first, so that no large job is started last (longest processing time first).
+
+The number of jobs in flight can also be limited by a budget (e.g. of memory): every job has a weight, and a job is
+only dispatched while the weights of the jobs in flight fit in the budget.
+
+Where the jobs do have to be split up front, e.g. between separate batch jobs, lpt_partition splits them into parts
+of about equal total cost (see the --part option of cmip6_download_unsuccessful_files).
+"""
+import heapq
+import os
+from concurrent.futures import FIRST_COMPLETED, Executor, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import Any, Callable, Iterable, Iterator, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class Scheduler:
+    """
+    Runs jobs on a pool of worker threads or processes fed from a shared queue.
+
+    :param workers: number of workers, defaults to 4
+    :type workers: int, optional
+    :param processes: run the jobs in worker processes instead of threads, defaults to False. The function and the
+        items must then be picklable.
+    :type processes: bool, optional
+    :param max_pending: maximum number of jobs submitted to the pool at a time, defaults to twice the number of
+        workers. Items are consumed lazily, so this also bounds how far ahead of the workers the items are read.
+    :type max_pending: int, optional
+    :param budget: maximum total weight of the jobs in flight (see run), defaults to None (no limit). A job that
+        does not fit in the budget on its own is still run, but only when no other job is in flight.
+    :type budget: float, optional
+    """
+
+    def __init__(
+        self,
+        workers: Optional[int] = 4,
+        processes: Optional[bool] = False,
+        max_pending: Optional[int] = None,
+        budget: Optional[float] = None,
+    ):
+        self.workers = workers
+        self.processes = processes
+        self.max_pending = 2 * workers if max_pending is None else max_pending
+        self.budget = budget
+
+    def executor(self) -> Executor:
+        if self.processes:
+            return ProcessPoolExecutor(max_workers=self.workers)
+        return ThreadPoolExecutor(max_workers=self.workers)
+
+    def run(
+        self,
+        func: Callable,
+        items: Iterable[tuple],
+        cost: Optional[Callable[[tuple], float]] = None,
+        weight: Optional[Callable[[tuple], float]] = None,
+    ) -> Iterator[tuple[tuple, Any]]:
+        """
+        Calls func(*item) for every item on the pool of workers and yields (item, result) in the calling thread as
+        the jobs complete. If a job raises an exception, it is re-raised here once the jobs already running have
+        finished.
+
+        :param cost: estimated cost of an item (e.g. the size of a file). If given, all items are read up front and
+            dispatched in order of decreasing cost, defaults to None (items are dispatched in the order they come)
+        :type cost: Callable[[tuple], float], optional
+        :param weight: weight of an item against the budget of the scheduler (e.g. the memory the job needs),
+            evaluated once per item in the calling thread, defaults to None (no weight)
+        :type weight: Callable[[tuple], float], optional
+        """
+        if cost is not None:
+            items = sorted(items, key=cost, reverse=True)
+        items = iter(items)
+
+        with self.executor() as pool:
+            pending = {}
+            in_flight = 0.0
+            # the next item and its weight, held back while it does not fit in the budget
+            waiting = None
+            try:
+                while True:
+                    while len(pending) < self.max_pending:
+                        if waiting is None:
+                            try:
+                                item = next(items)
+                            except StopIteration:
+                                break
+                            waiting = (item, weight(item) if weight is not None else 0.0)
+                        item, item_weight = waiting
+                        if pending and self.budget is not None and in_flight + item_weight > self.budget:
+                            break
+                        pending[pool.submit(func, *item)] = waiting
+                        in_flight += item_weight
+                        waiting = None
+
+                    if not pending:
+                        break
+
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        item, item_weight = pending.pop(future)
+                        in_flight -= item_weight
+                        yield item, future.result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+
+def available_memory() -> int:
+    """Memory (in bytes) available to new processes without swapping: MemAvailable on Linux, the free physical
+    memory elsewhere."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def lpt_partition(items: Iterable[T], nparts: int, cost: Callable[[T], float]) -> list[list[T]]:
+    """
+    Splits items into nparts parts of about equal total cost: the items are assigned in order of decreasing cost,
+    each to the part with the lowest total cost so far (longest processing time first). The total cost of the most
+    expensive part is at most 4/3 of the optimum.
+
+    :param items: items to split
+    :type items: Iterable[T]
+    :param nparts: number of parts
+    :type nparts: int
+    :param cost: cost of an item, e.g. the size of a file
+    :type cost: Callable[[T], float]
+    :return: the parts, each in order of decreasing cost
+    :rtype: list[list[T]]
+    """
+    parts = [[] for _ in range(nparts)]
+    loads = [(0.0, i) for i in range(nparts)]
+    for item in sorted(items, key=cost, reverse=True):
+        load, i = heapq.heappop(loads)
+        parts[i].append(item)
+        heapq.heappush(loads, (load + cost(item), i))
+    return parts
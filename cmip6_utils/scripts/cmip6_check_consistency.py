@@ -5,8 +5,8 @@ import shutil
 import sys
 from typing import Tuple
 
-from cmip6_utils.cli import add_common_parser_args, set_default_activitydir
-from cmip6_utils.dir import CMIPDirLevels, get_cmip_directories_at_level
+from cmip6_utils.cli import add_common_parser_args, open_inventory, set_default_activitydir
+from cmip6_utils.dir import CMIPDirLevels, WalkStats, find_cmip_directories
 from cmip6_utils.historical.rule_exceptions import EC_Earth3_historical_start_year_1970
 from cmip6_utils.misc import BC
 from cmip6_utils.scripts.find_download_missing_files import find_download_missing_files
@@ -91,7 +91,7 @@ def cli():
         ),
         epilog="Note: This program can be used at any stage of the CMIP6 post-processing work.",
     )
-    add_common_parser_args(parser, exp=True)
+    add_common_parser_args(parser, exp=True, inventory=True, walk=True)
 
     parser.add_argument("--interactive", "-i", action="store_true")
     args = parser.parse_args(args=None if sys.argv[1:] else ["--help"])
@@ -144,31 +144,40 @@ def main():
         for item in tmplist:
             ok_datasets.append(item.strip())
 
-    for exp_root, dirs, _ in get_cmip_directories_at_level(args.activitydir, CMIPDirLevels.source):
-        if args.experiment in dirs:
-            for root, dirs, files in os.walk(os.path.join(exp_root, args.experiment)):
-                if files:  # we have reached the bottom level
-                    if f"/{args.variable}/" in root:
-                        if root in ok_datasets:
-                            continue
-                        err = check_continuity_of_intervals(
-                            files, root, args.experiment, experiment_start_year, experiment_end_year
-                        )
-                        errcode = err[0]
-                        if errcode != 0:
-                            print(root)
-                            for error in err[1]:
-                                if error != 0:
-                                    if error[0] == -1:
-                                        print(
-                                            f"   {BC.fail('Discontinuity')} at year {error[1]}. Previous year was {error[2]}"
-                                        )
-                                    elif error[0] == -2:
-                                        print(f"   {BC.warn('Start year')} is {error[1]}")
-                                    elif error[0] == -3:
-                                        print(f"   {BC.warn('End year')} is {error[1]}")
-                            if args.interactive:
-                                shell(root, cache_fname)
+    inventory = open_inventory(args)
+    threads = args.walk_threads
+    walk_stats = WalkStats()
+    for root, dirs, files in find_cmip_directories(
+        args.activitydir,
+        CMIPDirLevels.version,
+        inventory,
+        threads,
+        walk_stats,
+        experiment=args.experiment,
+        variable=args.variable,
+    ):
+        if files:  # we have reached the bottom level
+            if root in ok_datasets:
+                continue
+            err = check_continuity_of_intervals(
+                files, root, args.experiment, experiment_start_year, experiment_end_year
+            )
+            errcode = err[0]
+            if errcode != 0:
+                print(root)
+                for error in err[1]:
+                    if error != 0:
+                        if error[0] == -1:
+                            print(f"   {BC.fail('Discontinuity')} at year {error[1]}. Previous year was {error[2]}")
+                        elif error[0] == -2:
+                            print(f"   {BC.warn('Start year')} is {error[1]}")
+                        elif error[0] == -3:
+                            print(f"   {BC.warn('End year')} is {error[1]}")
+                if args.interactive:
+                    shell(root, cache_fname)
+
+    if threads:
+        print(walk_stats.report())
 
 
 if __name__ == "__main__":
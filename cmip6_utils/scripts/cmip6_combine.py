@@ -1,25 +1,52 @@
 import argparse
+import contextlib
 import datetime
+import io
 import os
 import os.path as osp
 import shutil
 import sys
 import tempfile
+import time
+import traceback
+from dataclasses import dataclass
+from typing import Optional
 
-from netCDF4 import Dataset
+import lxml.etree
+from netCDF4 import Dataset, get_chunk_cache
 
-from cmip6_utils.cli import add_common_parser_args, set_default_activitydir
-from cmip6_utils.dir import CMIPDirLevels, get_cmip_directories_at_level
+from cmip6_utils.cli import add_common_parser_args, open_inventory, set_default_activitydir
+from cmip6_utils.dir import CMIPDirLevels, WalkStats, find_cmip_directories
+from cmip6_utils.file import clone_file
 from cmip6_utils.historical.rule_exceptions import EC_Earth3_historical_start_year_1970
 from cmip6_utils.misc import BC
 from cmip6_utils.nchelpers import (
+    DEFAULT_COPY_BUDGET,
     bulk_copy_variable_data,
     copy_dimension_definitions,
     copy_file_metadata,
+    copy_variable_data,
+    copy_raw_chunks,
     copy_variable_definitions,
+    raw_chunk_layouts,
 )
+from cmip6_utils.scheduler import Scheduler, available_memory
 from cmip6_utils.time import count_months, dates_range_from_file
 
+# Memory needed to combine a dataset, relative to the size of the blocks in which the data is copied (masked arrays
+# and the conversions of netCDF4 hold a few copies of a block at a time)
+MEMORY_OVERHEAD = 2
+
+NCML_NAMESPACE = "http://www.unidata.ucar.edu/namespaces/netcdf/ncml-2.2"
+
+
+@dataclass
+class CombineResult:
+    root: str
+    status: int  # 0: combined, 1: combined with discontinuities, -1: failed
+    log: str
+    seconds: float
+
 
 def make_output_file_name(first_file: str, last_file: str) -> str:
     """Make the output filename based on the names of the first and last files in the collection.
@@ -38,39 +65,88 @@ def make_output_file_name(first_file: str, last_file: str) -> str:
     return f"{base}{sty}-{edy}.nc"
 
 
-def copy_reference_file(reffile: str, ofile: str, offset: int):
+def copy_reference_file(
+    reffile: str,
+    ofile: str,
+    offset: int,
+    budget: Optional[int] = DEFAULT_COPY_BUDGET,
+    keep_layout: Optional[list] = [],
+):
     """Copies the input netcdf file (with modifications) to a new file.
 
     :param reffile: name of file to be copied
     :type reffile: str
     :param ofile: name of the new duplicate file
     :type ofile: str
+    :param budget: maximum size in bytes of the blocks in which the data is copied, defaults to DEFAULT_COPY_BUDGET
+    :type budget: int, optional
+    :param keep_layout: variables that are defined with the same chunks and filters as in reffile, and whose data is
+        not copied (it is copied chunk by chunk later), defaults to []
+    :type keep_layout: list, optional
     """
     print(f"        ---> Copying first file: {osp.basename(reffile)}")
     refnc = Dataset(reffile, "r")
     oncf = Dataset(ofile, "w", format="NETCDF4")
 
     copy_dimension_definitions(refnc, oncf)
-    copy_variable_definitions(refnc, oncf)
+    copy_variable_definitions(refnc, oncf, keep_layout=keep_layout)
     metadata = refnc.__dict__
 
     for key in ["tracking_id", "history"]:
         if key in metadata.keys():
             _ = metadata.pop(key)
 
-    date = datetime.datetime.ctime(datetime.datetime.now())
-    metadata[
-        "history"
-    ] = f"This file was generated on {date} by combining two or more individual files for this dataset."
+    metadata["history"] = combined_history()
 
     copy_file_metadata(oncf, metadata)
 
-    bulk_copy_variable_data(refnc, oncf, time_offset=offset)
+    bulk_copy_variable_data(refnc, oncf, exclude=keep_layout, time_offset=offset, budget=budget)
 
     refnc.close()
     oncf.close()
 
 
+def combined_history() -> str:
+    date = datetime.datetime.ctime(datetime.datetime.now())
+    return f"This file was generated on {date} by combining two or more individual files for this dataset."
+
+
+def can_append_in_place(reffile: str, offset: int) -> bool:
+    """Checks if the other files can be appended to a clone of the first file: the first file must start the time
+    series (offset 0) and be an HDF5 based netCDF file with an unlimited time dimension.
+
+    :param reffile: name of the first file
+    :type reffile: str
+    :param offset: index at which the first file starts in the combined file
+    :type offset: int
+    :rtype: bool
+    """
+    if offset != 0:
+        return False
+    with Dataset(reffile, "r") as ncf:
+        return ncf.data_model.startswith("NETCDF4") and ncf.dimensions["time"].isunlimited()
+
+
+def clone_reference_file(reffile: str, ofile: str):
+    """Clones the first file (as a reflink where the file system supports it, see clone_file) so that the other
+    files can be appended to it in place, and updates its metadata as copy_reference_file does. The combined file
+    keeps the chunks and compression of the first file.
+
+    :param reffile: name of file to be cloned
+    :type reffile: str
+    :param ofile: name of the new file
+    :type ofile: str
+    """
+    reflinked = clone_file(reffile, ofile)
+    print(f"        ---> {'Cloned' if reflinked else 'Copied'} first file: {osp.basename(reffile)}")
+
+    with Dataset(ofile, "a") as oncf:
+        for key in ["tracking_id", "history"]:
+            if key in oncf.ncattrs():
+                oncf.delncattr(key)
+        oncf.setncattr("history", combined_history())
+
+
 def get_time_vars(oncf: Dataset) -> list[str]:
     """Get names of variables that have time in their dimension.
 
@@ -87,6 +163,42 @@ def get_time_vars(oncf: Dataset) -> list[str]:
     return time_vars
 
 
+def get_time_axes(fname: str) -> dict[str, int]:
+    """Get the time axis of the multidimensional variables that have time in their dimensions.
+
+    :param fname: name of the netcdf file
+    :type fname: str
+    :return: index of the time dimension of each variable, by variable name
+    :rtype: dict[str, int]
+    """
+    with Dataset(fname, "r") as ncf:
+        return {
+            name: var.dimensions.index("time")
+            for name, var in ncf.variables.items()
+            if "time" in var.dimensions and var.ndim > 1
+        }
+
+
+def passthrough_layouts(files: list[str], axes: dict[str, int]) -> dict[str, tuple]:
+    """Get the layouts (see raw_chunk_layouts) of the variables that are compressed and stored with the same chunks,
+    filters and dtype in all the files, so that their compressed chunks can be copied from one file to another.
+
+    :param files: names of the files
+    :type files: list[str]
+    :param axes: names of the variables to check, and their time axis
+    :type axes: dict[str, int]
+    :return: the layouts of these variables, by name
+    :rtype: dict[str, tuple]
+    """
+    layouts = raw_chunk_layouts(files[0], axes)
+    for file in files[1:]:
+        if not layouts:
+            break
+        other = raw_chunk_layouts(file, axes)
+        layouts = {name: layout for name, layout in layouts.items() if other.get(name) == layout}
+    return layouts
+
+
 def check_linearity(fname: str) -> bool:
     ncf = Dataset(fname, "r")
     time = ncf.variables["time"][:]
@@ -103,7 +215,18 @@ def get_start_month(fname):
     return "184912"
 
 
-def combine_files(files: list[str], ofname: str, dry_run: bool):
+def plan_combine(files: list[str], aggregate: Optional[bool] = False) -> tuple[list[tuple[str, int]], int]:
+    """Places files along the time axis according to their dates, and reports the discontinuities.
+
+    :param files: names of the files, in order
+    :type files: list[str]
+    :param aggregate: report the discontinuities as for an NcML aggregation (see write_ncml), which does not fill
+        them, defaults to False
+    :type aggregate: bool, optional
+    :return: every file with the number of months missing before it (for the first file, since the expected start of
+        the time series), and 0, or 1 if there are discontinuities between the files
+    :rtype: tuple[list[tuple[str, int]], int]
+    """
     reffile = files[0]
 
     # Will use it to track the running end date of the newly created file
@@ -119,21 +242,14 @@ def combine_files(files: list[str], ofname: str, dry_run: bool):
     if months_offset > 0:
         print(BC.fail(f"Discontinuity of {months_offset} months at the start of time series."))
         print(BC.fail(f"First file is: {osp.basename(reffile)}"))
-        print(BC.fail(f"Appending contents of first file at offset {months_offset}"))
+        if aggregate:
+            print(BC.fail(f"The aggregation starts {months_offset} months late, with the first file"))
+        else:
+            print(BC.fail(f"Appending contents of first file at offset {months_offset}"))
     else:
         print(f"Time series will start at index {months_offset} corresponding to year {start_year}")
+    placements = [(reffile, months_offset)]
 
-    if not dry_run:
-        # first step is to duplicate the first file
-        copy_reference_file(reffile, ofname, months_offset)
-
-        oncf = Dataset(ofname, "a")
-        time_vars = get_time_vars(oncf)
-        ovars = [[varname, oncf[varname]] for varname in time_vars]
-
-        stidx = len(oncf.dimensions["time"])
-
-    # Now going through all the remaining files and appending them to the newly copied file
     for file in files[1:]:
         this_file_sty, this_file_edy = dates_range_from_file(file)
         months_offset = count_months(running_edy, this_file_sty)
@@ -141,30 +257,173 @@ def combine_files(files: list[str], ofname: str, dry_run: bool):
         # offset = count_months(global_edy, sty)
         if months_offset != 0:
             print(BC.fail(f"Discontinuity of {months_offset} months between {running_edy} and {this_file_sty}."))
-            print(BC.fail(f"Incrementing stidx by {months_offset}"))
+            if aggregate:
+                print(BC.fail(f"The time values of the aggregation skip {months_offset} months"))
+            else:
+                print(BC.fail(f"Incrementing stidx by {months_offset}"))
             status = 1
-            if not dry_run:
-                stidx += months_offset
+        placements.append((file, months_offset))
 
-        if not dry_run:
-            ncf = Dataset(file, "r")
-            tlen = len(ncf.dimensions["time"])
-            edidx = stidx + tlen
-            print(f"        ---> Appending file: {osp.basename(file)} from IDX {stidx} to {edidx}")
+        running_edy = this_file_edy
 
-            for varname, ovar in ovars:
-                ovar[stidx:edidx] = ncf[varname][:]
+    return placements, status
+
+
+def combine_files(
+    files: list[str],
+    ofname: str,
+    dry_run: bool,
+    budget: Optional[int] = DEFAULT_COPY_BUDGET,
+    passthrough: Optional[bool] = True,
+    in_place: Optional[bool] = False,
+):
+    """Combines files into a single file, placing each file along the time axis according to its dates.
+
+    If in_place is True and the first file starts the time series, the combined file is a clone of the first file
+    (see clone_reference_file) to which the other files are appended, instead of a copy of it.
+
+    If passthrough is True, the variables that are compressed with the same chunks, filters and dtype in all files
+    are not decompressed and recompressed: their compressed chunks are copied as they are with HDF5 direct chunk
+    reads and writes (see copy_raw_chunks), except for the files that do not start on a chunk boundary in the output.
+    The other variables are copied through netCDF4 and recompressed.
+
+    :param files: names of the files, in order
+    :type files: list[str]
+    :param ofname: name of the output file
+    :type ofname: str
+    :param dry_run: only report how the files would be combined
+    :type dry_run: bool
+    :param budget: maximum size in bytes of the blocks in which data is copied, defaults to DEFAULT_COPY_BUDGET
+    :type budget: int, optional
+    :param passthrough: copy compressed chunks as they are where possible, defaults to True
+    :type passthrough: bool, optional
+    :param in_place: append the files to a clone of the first file where possible, defaults to False
+    :type in_place: bool, optional
+    :return: 0, or 1 if there are discontinuities between the files
+    :rtype: int
+    """
+    placements, status = plan_combine(files)
+    if dry_run:
+        return status
 
-            stidx += tlen
+    reffile, months_offset = placements[0]
+    axes = get_time_axes(reffile)
+    layouts = passthrough_layouts(files, axes) if passthrough else {}
 
-        running_edy = this_file_edy
+    # first step is to duplicate the first file
+    cloned = in_place and can_append_in_place(reffile, months_offset)
+    if cloned:
+        clone_reference_file(reffile, ofname)
+    else:
+        if in_place:
+            print("        ---> The files can not be appended to the first file in place")
+        copy_reference_file(reffile, ofname, months_offset, budget, keep_layout=list(layouts))
+
+    # netCDF4 cannot reproduce every layout (e.g. filters it does not know), the variables whose layout differs in
+    # the output file are copied through netCDF4 after all
+    olayouts = raw_chunk_layouts(ofname, {name: axes[name] for name in layouts})
+    raw = {name: axes[name] for name, layout in layouts.items() if olayouts.get(name) == layout}
+    # files whose chunks are copied once the output file is closed: (file, start index, variables)
+    raw_sources = []
+
+    oncf = Dataset(ofname, "a")
+    time_vars = get_time_vars(oncf)
+    ovars = [[varname, oncf[varname]] for varname in time_vars]
+
+    def append(ncf: Dataset, file: str, stidx: int, varnames: list[str]):
+        tlen = len(ncf.dimensions["time"])
+        # the chunks of a file can only be copied if they land on the chunks of the output file
+        aligned = {
+            name: axis
+            for name, axis in raw.items()
+            if stidx % layouts[name][2][axis] == 0 and (tlen % layouts[name][2][axis] == 0 or file == files[-1])
+        }
+        for varname, ovar in ovars:
+            if varname in varnames and varname not in aligned:
+                copy_variable_data(ncf[varname], ovar, dst=stidx, axis=ovar.dimensions.index("time"), budget=budget)
+        if aligned:
+            raw_sources.append((file, stidx, aligned))
+
+    # the rest of the first file was copied with it
+    if not cloned:
+        with Dataset(reffile, "r") as ncf:
+            append(ncf, reffile, months_offset, list(layouts))
+
+    stidx = len(oncf.dimensions["time"])
+
+    # Now going through all the remaining files and appending them to the newly copied file
+    for file, months_offset in placements[1:]:
+        stidx += months_offset
+
+        ncf = Dataset(file, "r")
+        tlen = len(ncf.dimensions["time"])
+        edidx = stidx + tlen
+        print(f"        ---> Appending file: {osp.basename(file)} from IDX {stidx} to {edidx}")
+
+        append(ncf, file, stidx, time_vars)
+        ncf.close()
+
+        stidx += tlen
+
+    oncf.close()
+    if raw_sources:
+        copied = {name for _, _, var_axes in raw_sources for name in var_axes}
+        print(f"        ---> Copying compressed chunks of: {', '.join(name for name in raw if name in copied)}")
+    for file, offset, var_axes in raw_sources:
+        copy_raw_chunks(file, ofname, var_axes, offset, stidx)
 
-    if not dry_run:
-        oncf.close()
-        linearity = check_linearity(ofname) if status != 1 else True
-        # linearity = check_linearity(ofname)
-        if linearity:
-            print("        ---> Joining files successful")
+    linearity = check_linearity(ofname) if status != 1 else True
+    # linearity = check_linearity(ofname)
+    if linearity:
+        print("        ---> Joining files successful")
+
+    return status
+
+
+def write_ncml(files: list[str], ofname: str, dry_run: bool) -> int:
+    """Writes an NcML aggregation (joinExisting along time) of the files instead of combining them into a single file.
+
+    The files are placed as by combine_files (see plan_combine). Every file is listed with its number of time steps
+    (ncoords) and its time values (coordValue), so that THREDDS does not have to open the files to build the
+    aggregation, and the global attributes are updated as in a combined file. The files are referred to by their
+    absolute path, as the NcML file is kept in a directory tree of its own. Discontinuities are reported but, unlike in
+    a combined file, not filled: the time values of the aggregation simply skip the missing months.
+
+    :param files: names of the files, in order
+    :type files: list[str]
+    :param ofname: name of the NcML file
+    :type ofname: str
+    :param dry_run: only report how the files would be aggregated
+    :type dry_run: bool
+    :return: 0, or 1 if there are discontinuities between the files
+    :rtype: int
+    """
+    placements, status = plan_combine(files, aggregate=True)
+    if dry_run:
+        return status
+
+    root = lxml.etree.Element(f"{{{NCML_NAMESPACE}}}netcdf", nsmap={None: NCML_NAMESPACE})
+    lxml.etree.SubElement(root, f"{{{NCML_NAMESPACE}}}remove", name="tracking_id", type="attribute")
+    lxml.etree.SubElement(root, f"{{{NCML_NAMESPACE}}}attribute", name="history", value=combined_history())
+    aggregation = lxml.etree.SubElement(root, f"{{{NCML_NAMESPACE}}}aggregation", dimName="time", type="joinExisting")
+
+    # the missing months are not filled, the files follow each other in the aggregation
+    stidx = 0
+    for file, _ in placements:
+        with Dataset(file, "r") as ncf:
+            time_values = ncf["time"][:]
+        print(f"        ---> Aggregating file: {osp.basename(file)} at IDX {stidx} to {stidx + len(time_values)}")
+        lxml.etree.SubElement(
+            aggregation,
+            f"{{{NCML_NAMESPACE}}}netcdf",
+            location=osp.abspath(file),
+            ncoords=str(len(time_values)),
+            coordValue=" ".join(repr(float(value)) for value in time_values),
+        )
+        stidx += len(time_values)
+
+    lxml.etree.ElementTree(root).write(ofname, xml_declaration=True, encoding="UTF-8", pretty_print=True)
+    print("        ---> Writing aggregation successful")
 
     return status
 
@@ -188,16 +447,170 @@ def delete_move_files(main_dir: str, tseries_fname: str):
     shutil.move(tseries_fname, main_dir)
 
 
+def memory_estimate(files: list[str], budget: Optional[int] = DEFAULT_COPY_BUDGET) -> int:
+    """Estimate of the memory (in bytes) needed to combine the files of a dataset: the size of the largest block that
+    is copied at a time (the largest variable of the largest file, or budget) times MEMORY_OVERHEAD, plus the HDF5
+    chunk caches of the input and output variables."""
+    largest = max(files, key=osp.getsize)
+    with Dataset(largest, "r") as ncf:
+        sizes = [var.size * getattr(var.dtype, "itemsize", 8) for var in ncf.variables.values()]
+    return min(max(sizes, default=0), budget) * MEMORY_OVERHEAD + 2 * get_chunk_cache()[0]
+
+
+def combine_dataset(
+    root: str,
+    files: list[str],
+    odir: str,
+    dry_run: bool,
+    combine_only: bool,
+    budget: Optional[int] = DEFAULT_COPY_BUDGET,
+    passthrough: Optional[bool] = True,
+    in_place: Optional[bool] = False,
+    ncml_dir: Optional[str] = None,
+    buffered: Optional[bool] = False,
+) -> CombineResult:
+    """Combines the files of a dataset into a single file (see combine_files) and, unless combine_only is True,
+    replaces the files with the combined file. If ncml_dir is given, an NcML aggregation of the files (see write_ncml)
+    is written to it instead, and the files are left as they are.
+
+    :param root: directory of the dataset
+    :type root: str
+    :param files: names of the files of the dataset
+    :type files: list[str]
+    :param odir: directory in which the combined file is created. If in_place is True, it is created in a hidden
+        directory next to the dataset directory instead, so that it is on the same file system as the first file.
+    :type odir: str
+    :param budget: maximum size in bytes of the blocks in which the data is copied, defaults to DEFAULT_COPY_BUDGET
+    :type budget: int, optional
+    :param passthrough: copy compressed chunks as they are where possible (see combine_files), defaults to True
+    :type passthrough: bool, optional
+    :param in_place: append the files to a clone of the first file where possible (see combine_files), defaults to
+        False
+    :type in_place: bool, optional
+    :param ncml_dir: directory in which to write an NcML aggregation of the files instead of combining them, defaults
+        to None
+    :type ncml_dir: str, optional
+    :param buffered: capture what is printed in the log of the result instead of printing it, so that the logs of
+        datasets that are combined in parallel are not interleaved, defaults to False
+    :type buffered: bool, optional
+    """
+    start = time.perf_counter()
+    out = io.StringIO() if buffered else sys.stdout
+    status = -1
+    # directory next to the dataset, on the same file system, that is removed once the dataset is done
+    sibling_dir = None
+    with contextlib.redirect_stdout(out):
+        try:
+            if ncml_dir is not None:
+                odir = ncml_dir
+                if not dry_run:
+                    os.makedirs(odir, exist_ok=True)
+            elif in_place and not combine_only and not dry_run:
+                # the first file can only be cloned (see clone_file), and the combined file moved into the dataset
+                # directory without copying it, within a file system. The directory is hidden from the walks.
+                odir = sibling_dir = tempfile.mkdtemp(prefix=f".{osp.basename(root)}.", dir=osp.dirname(root))
+            else:
+                # every dataset gets its own output directory, different versions of a dataset have the same file names
+                odir = tempfile.mkdtemp(dir=odir)
+            print(f"Processing: {root}")
+            print(f"    ---> Files to combine: {len(files)}")
+            print(f"    ---> Output dir is: {odir}")
+            output_file_name = make_output_file_name(files[0], files[-1])
+            if ncml_dir is not None:
+                output_file_name = osp.splitext(output_file_name)[0] + ".ncml"
+            print(f"    ---> Output filename: {output_file_name}")
+
+            files = [osp.join(root, f) for f in files]
+            output_file_name = osp.join(odir, output_file_name)
+            if ncml_dir is not None:
+                status = write_ncml(files, output_file_name, dry_run)
+            else:
+                status = combine_files(files, output_file_name, dry_run, budget, passthrough, in_place)
+
+                if not dry_run:
+                    if not combine_only:
+                        delete_move_files(root, output_file_name)
+        except Exception:
+            status = -1
+            print(BC.fail("    ---> Combining failed:"))
+            traceback.print_exc(file=sys.stdout)
+        finally:
+            if sibling_dir is not None:
+                shutil.rmtree(sibling_dir, ignore_errors=True)
+    return CombineResult(root, status, out.getvalue() if buffered else "", time.perf_counter() - start)
+
+
 def cli():
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    add_common_parser_args(parser, exp=True, adir=True, dryrun=True)
+    add_common_parser_args(parser, exp=True, adir=True, dryrun=True, inventory=True, walk=True)
     parser.add_argument(
         "--combine-only",
         action="store_true",
         help="Combine files only. Don't move it from the temporary directory to original directory.",
     )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help=(
+            "Number of datasets to combine in parallel, in separate processes. The output of each dataset is "
+            "printed in one piece once it is done, in the order in which the datasets were found."
+        ),
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=float,
+        default=None,
+        help=(
+            "Memory (in GB) that the datasets combined in parallel may need together, as estimated from the size of "
+            "the blocks in which they are copied. Defaults to half of the memory available when the script starts."
+        ),
+    )
+    parser.add_argument(
+        "--copy-budget",
+        type=float,
+        default=DEFAULT_COPY_BUDGET / 2**20,
+        help="Maximum size (in MB) of the blocks in which the data of a variable is copied.",
+    )
+    parser.add_argument(
+        "--recompress",
+        action="store_true",
+        help=(
+            "Decompress and recompress all the data. By default, variables that are compressed with the same chunks "
+            "and filters in all the files of a dataset are combined by copying their compressed chunks as they are."
+        ),
+    )
+    parser.add_argument(
+        "--append-in-place",
+        action="store_true",
+        help=(
+            "Append the other files of a dataset to a clone of its first file (a reflink where the file system "
+            "supports it) instead of copying the first file, if it starts the time series and its time dimension "
+            "is unlimited. The combined file then keeps the chunks and compression of the first file."
+        ),
+    )
+    parser.add_argument(
+        "--ncml",
+        action="store_true",
+        help=(
+            "Instead of combining the files of a dataset, write an NcML aggregation (joinExisting along time) of the "
+            "files to --ncml-dir, for THREDDS to serve them as a single dataset. The files are left as they are."
+        ),
+    )
+    parser.add_argument(
+        "--ncml-dir",
+        type=str,
+        default=None,
+        help=(
+            "Root of the directory tree of NcML aggregations (e.g. the NcML root of THREDDS). The aggregation of a "
+            "dataset is written to its DRS path (CMIP6/<activity>/.../<version>) under this directory."
+        ),
+    )
 
     args = parser.parse_args(args=None if sys.argv[1:] else ["--help"])
+    if args.ncml and args.ncml_dir is None:
+        parser.error("--ncml requires --ncml-dir")
     set_default_activitydir(args)
 
     return args
@@ -207,6 +620,10 @@ def main():
     args = cli()
     dry_run = args.dry_run
     combine_only = args.combine_only
+    copy_budget = int(args.copy_budget * 2**20)
+    inventory = open_inventory(args)
+    threads = args.walk_threads
+    walk_stats = WalkStats()
 
     total_datasets_to_combine = 0
     datasets_not_needing_changes = 0
@@ -214,41 +631,102 @@ def main():
 
     temp_dir = tempfile.TemporaryDirectory(ignore_cleanup_errors=True)
     odir = temp_dir.name
-
-    for exp_root, dirs, files in get_cmip_directories_at_level(args.activitydir, CMIPDirLevels.source):
-        if args.experiment in dirs:
-            for root, dirs, files in os.walk(os.path.join(exp_root, args.experiment)):
-                if files:  # we have reached the bottom level
-                    files = sorted(files)
-                    nfiles = len(files)
-                    if f"/{args.variable}/" in root:  # filter by variable name
-                        if nfiles > 1:
-                            total_datasets_to_combine += 1
-                            print(f"Processing: {root}")
-                            print(f"    ---> Files to combine: {len(files)}")
-                            print(f"    ---> Output dir is: {odir}")
-                            output_file_name = make_output_file_name(files[0], files[-1])
-                            print(f"    ---> Output filename: {output_file_name}")
-
-                            files = [osp.join(root, f) for f in files]
-                            output_file_name = osp.join(odir, output_file_name)
-                            combine_files(files, output_file_name, dry_run)
-
-                            if not dry_run:
-                                if not combine_only:
-                                    delete_move_files(root, output_file_name)
-
-                        else:
-                            list_of_datasets_not_needing_changes.append(osp.join(root, files[0]))
-                            datasets_not_needing_changes += 1
+    # directory that contains the CMIP6 directory, the aggregations are written to the same DRS paths under ncml_dir
+    drs_root = osp.dirname(osp.dirname(args.activitydir.rstrip("/")))
+
+    def datasets():
+        nonlocal total_datasets_to_combine, datasets_not_needing_changes
+        for root, dirs, files in find_cmip_directories(
+            args.activitydir,
+            CMIPDirLevels.version,
+            inventory,
+            threads,
+            walk_stats,
+            experiment=args.experiment,
+            variable=args.variable,
+        ):
+            if files:  # we have reached the bottom level
+                # only the netCDF files of the dataset
+                files = sorted(f for f in files if f.endswith(".nc"))
+                nfiles = len(files)
+                if nfiles > 1:
+                    total_datasets_to_combine += 1
+                    yield (
+                        root,
+                        files,
+                        odir,
+                        dry_run,
+                        combine_only,
+                        copy_budget,
+                        not args.recompress,
+                        args.append_in_place,
+                        osp.join(args.ncml_dir, osp.relpath(root, drs_root)) if args.ncml else None,
+                    )
+                elif nfiles == 1:
+                    list_of_datasets_not_needing_changes.append(osp.join(root, files[0]))
+                    datasets_not_needing_changes += 1
+
+    start = time.perf_counter()
+    results = []
+    if args.jobs > 1:
+        memory_budget = args.max_memory * 1e9 if args.max_memory is not None else available_memory() / 2
+        scheduler = Scheduler(args.jobs, processes=True, budget=memory_budget)
+        order = {}
+
+        def jobs():
+            for root, *rest in datasets():
+                order[root] = len(order)
+                yield root, *rest, True
+
+        # the logs are printed in the order in which the datasets were found, each as soon as it and all the
+        # datasets found before it are done
+        finished = {}
+        for (root, files, *_), result in scheduler.run(
+            combine_dataset,
+            jobs(),
+            weight=lambda item: memory_estimate([osp.join(item[0], f) for f in item[1]], copy_budget),
+        ):
+            finished[order[root]] = result
+            while len(results) in finished:
+                result = finished.pop(len(results))
+                print(result.log, end="")
+                results.append(result)
+    else:
+        for item in datasets():
+            results.append(combine_dataset(*item))
+    elapsed = time.perf_counter() - start
 
     if datasets_not_needing_changes > 0:
         print("Datasets that did not need combining:")
         for item in list_of_datasets_not_needing_changes:
             print(item)
 
+    discontinuous = [result.root for result in results if result.status == 1]
+    if discontinuous:
+        print(BC.warn("Datasets combined with discontinuities in time:"))
+        for root in discontinuous:
+            print(root)
+    failed = [result.root for result in results if result.status == -1]
+    if failed:
+        print(BC.fail("Datasets that failed to combine:"))
+        for root in failed:
+            print(root)
+
     print(f"Total datasets that needed combining  : {total_datasets_to_combine}")
     print(f"Total datasets that were already good : {datasets_not_needing_changes}")
+    print(f"Total datasets that failed to combine : {len(failed)}")
+    if args.ncml:
+        print(
+            f"Wrote NcML aggregations of {len(results) - len(failed)} datasets in {elapsed:.1f} s "
+            f"({sum(result.seconds for result in results):.1f} s of aggregating, {args.jobs} jobs)"
+        )
+    else:
+        print(
+            f"Combined {len(results) - len(failed)} datasets in {elapsed:.1f} s "
+            f"({sum(result.seconds for result in results):.1f} s of combining, {args.jobs} jobs)"
+        )
+    if threads:
+        print(walk_stats.report())
 
     if dry_run:
         print(BC.warn("******************** DRY RUN COMPLETE ********************"))
@@ -5,11 +5,10 @@ in the CMIP6 folder (i.e. each "dataset") only contains a single file (ideally
 after the merging process)
 """
 import argparse
-import os
 import sys
 
-from cmip6_utils.cli import add_common_parser_args, set_default_activitydir
-from cmip6_utils.dir import CMIPDirLevels, get_cmip_directories_at_level
+from cmip6_utils.cli import add_common_parser_args, open_inventory, set_default_activitydir
+from cmip6_utils.dir import CMIPDirLevels, WalkStats, find_cmip_directories
 
 
 def main():
@@ -19,23 +18,33 @@ def main():
             "for the supplied variable only contain single files"
         )
     )
-    add_common_parser_args(parser, exp=True)
+    add_common_parser_args(parser, exp=True, inventory=True, walk=True)
     args = parser.parse_args(args=None if sys.argv[1:] else ["--help"])
     set_default_activitydir(args)
 
     experiment = args.experiment
+    inventory = open_inventory(args)
+    threads = args.walk_threads
+    walk_stats = WalkStats()
 
     num_datasets = 0
-    for exp_root, dirs, _ in get_cmip_directories_at_level(args.activitydir, CMIPDirLevels.source):
-        if experiment in dirs:
-            for root, dirs, files in os.walk(os.path.join(exp_root, experiment)):
-                if files:  # we have reached the bottom level
-                    nfiles = len(files)
-                    if f"/{args.variable}/" in root:
-                        num_datasets += 1
-                        assert nfiles == 1
+    for root, dirs, files in find_cmip_directories(
+        args.activitydir,
+        CMIPDirLevels.version,
+        inventory,
+        threads,
+        walk_stats,
+        experiment=experiment,
+        variable=args.variable,
+    ):
+        if files:  # we have reached the bottom level
+            nfiles = len(files)
+            num_datasets += 1
+            assert nfiles == 1
 
     print(f"Total datasets checked  : {num_datasets}")
+    if threads:
+        print(walk_stats.report())
 
 
 if __name__ == "__main__":
@@ -13,11 +13,10 @@ E.g. Datasets searched: 823
 """
 
 import argparse
-import os
 import sys
-from pathlib import Path
 
-from cmip6_utils.cli import add_common_parser_args, set_default_activitydir
+from cmip6_utils.cli import add_common_parser_args, open_inventory, set_default_activitydir
+from cmip6_utils.dir import CMIPDirLevels, WalkStats, find_cmip_directories
 
 
 def cli():
@@ -31,7 +30,7 @@ def cli():
             "then the number of datasets and files should be the same (assuming no empty dataset direcs.)."
         ),
     )
-    add_common_parser_args(parser, exp=True)
+    add_common_parser_args(parser, exp=True, inventory=True, walk=True)
     args = parser.parse_args(args=None if sys.argv[1:] else ["--help"])
     set_default_activitydir(args)
     return args
@@ -42,19 +41,30 @@ def main():
 
     print(f"Searching for '{args.variable}' files for experiment '{args.experiment}'")
 
-    P = Path(args.activitydir)
+    inventory = open_inventory(args)
+    walk_stats = WalkStats()
     dir_count = 0
     files_count = 0
-    # for dir in P.glob(f"CMIP6/**/{args.experiment}/**/{args.variable}/*/*"):
-    for dir in P.glob(f"**/{args.experiment}/**/{args.variable}/*/*"):
+
+    for root, _, files in find_cmip_directories(
+        args.activitydir,
+        CMIPDirLevels.version,
+        inventory,
+        args.walk_threads,
+        walk_stats,
+        experiment=args.experiment,
+        variable=args.variable,
+    ):
         dir_count += 1
         # Assumption: there are no non-variable related files in these directories
-        files_count += len(os.listdir(dir))
-        if len(os.listdir(dir)) == 0:
-            print(dir)
+        files_count += len(files)
+        if len(files) == 0:
+            print(root)
 
     print(f"Datasets searched: {dir_count}")
     print(f"Files found: {files_count}")
+    if args.walk_threads:
+        print(walk_stats.report())
 
 
 if __name__ == "__main__":
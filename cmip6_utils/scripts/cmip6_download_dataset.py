@@ -2,26 +2,44 @@ import os
 import sys
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser, Namespace
 
-from cmip6_utils.scripts.cmip6_download_file import cmip6_download_file
+from cmip6_utils.checksum import ChecksumCache
+from cmip6_utils.cli import add_search_cache_args, add_segment_args, open_search_cache
+from cmip6_utils.download import DownloadEngine, fetch_file
+from cmip6_utils.misc import BC
+from cmip6_utils.scripts.cmip6_download_file import get_dataset_version, parse_file_path, search_dataset_files
 
 
 def cli() -> Namespace:
     parser = ArgumentParser(
         formatter_class=ArgumentDefaultsHelpFormatter,
         description=(
-            "This script can be used to download all available files in a dataset in which "
-            "all files are 1 year long. "
-            "For example for /the/full/local/path/to/dataset, the script will query all "
-            "all available files and download the missing files to that location."
+            "This script can be used to download all available files in a dataset. "
+            "For example for /the/full/local/path/to/dataset, the script will search once for "
+            "all available files of the dataset and download the missing files to that location."
         ),
     )
-    parser.add_argument("dataset", type=str, help="Full local path to the dataset to download")
+    parser.add_argument("dataset", type=str, help="Full local path to the dataset (version) to download")
     parser.add_argument(
         "-t",
         type=int,
         help=("Timeout (in seconds) for downloading a file (parameter to requests.get())."),
         default=5,
     )
+    parser.add_argument("--jobs", "-j", type=int, default=4, help="Number of files to download concurrently.")
+    parser.add_argument(
+        "--per-node", type=int, default=2, help="Maximum number of concurrent downloads from a single data node."
+    )
+    add_segment_args(parser, segments=0)
+    parser.add_argument(
+        "--search-node",
+        type=str,
+        default=None,
+        help=(
+            "Search for the files on this ESGF search node (e.g. esgf-node.llnl.gov, or http://localhost:8080) "
+            "with the search API directly, instead of with esgpull."
+        ),
+    )
+    add_search_cache_args(parser)
     args = parser.parse_args(args=None if sys.argv[1:] else ["--help"])
 
     if args.dataset.endswith(".nc"):
@@ -29,53 +47,56 @@ def cli() -> Namespace:
     return args
 
 
-def gen_filename_structure(path: str) -> str:
-    """Parses the path of the dataset to compose the base filename structure of files in the dataset.
-    All filenames start with the structure: variableid_tableid_sourceid_experimentid_variantid_grid
-
-    :param path: full path to the dataset
-    :type path: str
-    :raises ValueError: if the path does not contain a directory called CMIP6
-    :return: the base filename structure
-    :rtype: str
-    """
-    parts = path.strip("/").split("/")
-    # print(parts)
-    try:
-        i = parts.index("CMIP6")
-    except ValueError:
-        raise ValueError("There is no CMIP6 directory in the dataset path provided") from None
-
-    sourceid, experimentid, variantid, tableid, variableid, grid = parts[i + 3 : i + 9]
-
-    filename_base = f"{variableid}_{tableid}_{sourceid}_{experimentid}_{variantid}_{grid}"
-    return filename_base
-
-
 def main():
     args = cli()
-    filename_base = gen_filename_structure(args.dataset)
-    print(filename_base)
+    dataset = args.dataset.rstrip("/")
+    path_to_cmip6_data, cmip6_dataset_structure, _ = parse_file_path(dataset + "/")
+    print(f"{BC.bold('Local path to CMIP6 data:')} {path_to_cmip6_data}")
+    print(f"{BC.bold('CMIP6 dataset structure :')} {cmip6_dataset_structure}")
+    print(f"{BC.bold('Dataset version         :')} {get_dataset_version(cmip6_dataset_structure)}")
+    print("\n")
+
+    # all the files of the dataset are found by the same search, which is only sent once
+    dataset_files = search_dataset_files(
+        cmip6_dataset_structure, search_cache=open_search_cache(args), search_node=args.search_node
+    )
+    print(f"{BC.warn('# of unique files: ')}{len(dataset_files)}")
+
+    existing = set(os.listdir(dataset)) if os.path.isdir(dataset) else set()
+    missing = sorted(filename for filename in dataset_files if filename not in existing)
+    cache = ChecksumCache()
+    engine = DownloadEngine(args.jobs, args.per_node)
+
+    def fetch(filename):
+        local_filename = os.path.join(path_to_cmip6_data, dataset_files[filename][0].local_path, filename)
+        return fetch_file(
+            dataset_files[filename],
+            local_filename,
+            args.t,
+            cache,
+            args.segments,
+            args.segment_size,
+            limiter=engine.limiter,
+            log=lambda message: print(f"{filename}:{message}"),
+        )
 
-    count = 0  # counter for total files
     err_count = 0
-    exists_count = 0
-    for year in range(1850, 2015):
-        filename = f"{filename_base}_{year}01-{year}12.nc"
-        filename = os.path.join(args.dataset, filename)
-        if not os.path.exists(filename):
-            err = cmip6_download_file(filename, 5, False)
-            if err == -1:
-                err_count += 1
+    # the largest files are started first, so that they do not hold up the end of the run
+    jobs = engine.run(
+        fetch, ((filename,) for filename in missing), cost=lambda item: dataset_files[item[0]][0].size or 0
+    )
+    for (filename,), success in jobs:
+        if success:
+            print(f"{filename}: {BC.okgreen('downloaded')}")
         else:
-            exists_count += 1
-
-        count += 1
+            print(f"{filename}: {BC.fail('Unable to download this file from any source')}")
+            err_count += 1
 
+    count = len(dataset_files)
     print(f"Total files expected : {count}")
-    print(f"Total files existing : {exists_count}")
+    print(f"Total files existing : {count - len(missing)}")
     print(f"Total files failed downloading: {err_count}")
-    print(f"Total files downloaded: {count - err_count - exists_count}")
+    print(f"Total files downloaded: {len(missing) - err_count}")
 
 
 if __name__ == "__main__":
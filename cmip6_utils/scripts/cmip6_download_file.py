@@ -7,27 +7,30 @@ This script can be used to download a file. For example, if the desired local fi
 
 Then this script can be called to download it.
 """
-import os
 import os.path as osp
-import shutil
 import sys
-import tempfile
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser, Namespace
 from dataclasses import dataclass
 from typing import Optional, Tuple
 
 from esgpull import Esgpull, Query
 
-from cmip6_utils.file import download_file
-from cmip6_utils.misc import BC, verify_checksum
+from cmip6_utils.checksum import ChecksumCache
+from cmip6_utils.cli import add_search_cache_args, add_segment_args, open_search_cache
+from cmip6_utils.download import DEFAULT_SEGMENT_SIZE, fetch_file
+from cmip6_utils.esgf import search_dataset, search_files
+from cmip6_utils.misc import BC
+from cmip6_utils.search_cache import SearchCache
 
 
 @dataclass
 class ESGFFile:
     url: str
     checksum: str
+    checksum_type: str
     local_path: str
     data_node: str
+    size: int
 
 
 def cmip_path_to_query(path: str) -> Query:
@@ -66,6 +69,17 @@ def cli() -> Namespace:
         help=("Timeout (in seconds) for downloading a file " "(parameter to requests.get())."),
         default=5,
     )
+    add_segment_args(parser)
+    parser.add_argument(
+        "--search-node",
+        type=str,
+        default=None,
+        help=(
+            "Search for the file on this ESGF search node (e.g. esgf-node.llnl.gov, or http://localhost:8080) "
+            "with the search API directly, instead of with esgpull."
+        ),
+    )
+    add_search_cache_args(parser)
     args = parser.parse_args(args=None if sys.argv[1:] else ["--help"])
 
     if not args.filename_with_path.endswith(".nc"):
@@ -94,73 +108,109 @@ def print_query(query: Query):
     print("\n")
 
 
+def search_file(
+    search_node: str, cmip6_dataset_structure: str, filename: str, search_cache: Optional[SearchCache] = None
+) -> list[ESGFFile]:
+    """Searches for the replicas of a file of a dataset version on a search node with the ESGF search API. The file
+    is looked up by its master_id, which is the dataset path without the version joined with dots, followed by the
+    filename, and only the replicas of the version in the dataset path are kept."""
+    dataset, _, version = cmip6_dataset_structure.rpartition("/")
+    master_id = f"{dataset.replace('/', '.')}.{filename}"
+    print(f"{BC.bold('Master ID               :')} {master_id}")
+    replicas = search_files(
+        search_node, [master_id], cache=search_cache, facets={"version": version.removeprefix("v")}
+    ).get(master_id, [])
+    return [
+        ESGFFile(r.url, r.checksum, r.checksum_type, cmip6_dataset_structure, r.data_node, r.size) for r in replicas
+    ]
+
+
 def main():
     args = cli()
-    cmip6_download_file(args.filename_with_path, args.t)
-
+    cmip6_download_file(
+        args.filename_with_path,
+        args.t,
+        segments=args.segments,
+        segment_size=args.segment_size,
+        search_cache=open_search_cache(args),
+        search_node=args.search_node,
+    )
 
-def cmip6_download_file(filename_with_path: str, t: int, verbose: Optional[bool] = True):
-    path_to_cmip6_data, cmip6_dataset_structure, filename = parse_file_path(filename_with_path)
-    print(path_to_cmip6_data, cmip6_dataset_structure, filename)
-    version = get_dataset_version(cmip6_dataset_structure)
 
-    print(f"{BC.bold('Local path to CMIP6 data:')} {path_to_cmip6_data}")
-    print(f"{BC.bold('CMIP6 dataset structure :')} {cmip6_dataset_structure}")
-    print(f"{BC.bold('Required filename       :')} {filename}")
-    print(f"{BC.bold('Dataset version         :')} {version}")
-    print("\n")
+def search_dataset_files(
+    cmip6_dataset_structure: str,
+    verbose: Optional[bool] = True,
+    search_cache: Optional[SearchCache] = None,
+    search_node: Optional[str] = None,
+) -> dict[str, list[ESGFFile]]:
+    """Searches for the replicas of all files of a dataset version, with a single search (with esgpull, or with the
+    search API of search_node if given).
+
+    :return: filename -> replicas of the file
+    :rtype: dict[str, list[ESGFFile]]
+    """
+    dataset_files = {}
+    if search_node is not None:
+        for filename, replicas in search_dataset(search_node, cmip6_dataset_structure, cache=search_cache).items():
+            dataset_files[filename] = [
+                ESGFFile(r.url, r.checksum, r.checksum_type, cmip6_dataset_structure, r.data_node, r.size)
+                for r in replicas
+            ]
+        return dataset_files
 
+    version = get_dataset_version(cmip6_dataset_structure)
     query = cmip_path_to_query(cmip6_dataset_structure)
-
     if verbose:
         print_query(query)
-
     query.options.distrib = True  # default=False
     query.options.replica = True
 
     esg = Esgpull(path="/home/dchandan/esgpull_profiles/scratch")
-    search_results = esg.context.files(query, max_hits=None)
-
-    file_urls = []
+    if search_cache is not None:
+        search_results = search_cache.files(esg, query, max_hits=None)
+    else:
+        search_results = esg.context.files(query, max_hits=None)
 
     print(f"{BC.warn('# of files found from search: ')}{len(search_results)}")
 
     for res in search_results:
         if version == res.version:
-            if res.filename == filename:
-                data_ = (res.url, res.checksum, res.local_path, res.data_node)
-                file_urls.append(ESGFFile(*data_))
+            data_ = (res.url, res.checksum, res.checksum_type, res.local_path, res.data_node, res.size)
+            dataset_files.setdefault(res.filename, []).append(ESGFFile(*data_))
+    return dataset_files
+
+
+def cmip6_download_file(
+    filename_with_path: str,
+    t: int,
+    verbose: Optional[bool] = True,
+    segments: Optional[int] = 0,
+    segment_size: Optional[int] = DEFAULT_SEGMENT_SIZE,
+    search_cache: Optional[SearchCache] = None,
+    search_node: Optional[str] = None,
+):
+    path_to_cmip6_data, cmip6_dataset_structure, filename = parse_file_path(filename_with_path)
+    print(path_to_cmip6_data, cmip6_dataset_structure, filename)
+    version = get_dataset_version(cmip6_dataset_structure)
+
+    print(f"{BC.bold('Local path to CMIP6 data:')} {path_to_cmip6_data}")
+    print(f"{BC.bold('CMIP6 dataset structure :')} {cmip6_dataset_structure}")
+    print(f"{BC.bold('Required filename       :')} {filename}")
+    print(f"{BC.bold('Dataset version         :')} {version}")
+    print("\n")
+
+    cache = ChecksumCache()
+    if search_node is not None:
+        file_urls = search_file(search_node, cmip6_dataset_structure, filename, search_cache)
+    else:
+        file_urls = search_dataset_files(cmip6_dataset_structure, verbose, search_cache).get(filename, [])
 
     print(f"{BC.warn('# of entries found for the file: ')}{len(file_urls)}")
 
     success = False
-    for item in file_urls:
-        tf_ = tempfile.NamedTemporaryFile()
-        print(f" ---> Attempting download from: {item.data_node}")
-        err = download_file(item.url, tf_.name, timeout=t)
-
-        if err == 200:
-            print(f" ---> Download {BC.okgreen('successful')}")
-            vrfy = verify_checksum(tf_.name, item.checksum)
-            if vrfy:
-                print(f" ---> Checksum {BC.okgreen('PASS')}")
-                success = True
-                localpath = osp.join(path_to_cmip6_data, item.local_path)
-                print(f" ---> Copying downloaded file to {localpath}")
-                os.makedirs(localpath, exist_ok=True)
-                local_filename = osp.join(localpath, filename)
-                shutil.copy2(tf_.name, local_filename)
-                vrfy2 = verify_checksum(local_filename, item.checksum)
-                if not vrfy2:
-                    print(f" ---> {BC.fail('Checksum of copied file failed')}")
-                    os.remove(local_filename)
-                    success = False
-                else:
-                    break
-            else:
-                print(f" ---> Checksum {BC.fail('FAIL')}")
-        else:
-            print(f" ---> Download {BC.fail('unsuccessful')}")
+    if file_urls:
+        local_filename = osp.join(path_to_cmip6_data, file_urls[0].local_path, filename)
+        success = fetch_file(file_urls, local_filename, t, cache, segments, segment_size)
 
     if not success:
         print(f" ---> {BC.fail('Unable to download this file from any source')}")
@@ -3,21 +3,16 @@
 This script is run after the completion of esgpull download phase. The purpose of this script is to
 download files that were not downloaded by esgpull.
 """
-
 import argparse
-import hashlib
 import logging
 import os
 import re
 import shutil
-import sqlite3
 import sys
 import tempfile
 from datetime import datetime
-from urllib.parse import urlparse
+from typing import Iterable, Optional
 
-import lxml.etree
-import requests
 from colorlog import ColoredFormatter
 
 LOGGER = logging.getLogger("MAIN")
@@ -27,11 +22,34 @@ stream.setFormatter(formatter)
 LOGGER.addHandler(stream)
 LOGGER.setLevel(logging.INFO)
 
+from cmip6_utils.cli import add_search_cache_args, open_search_cache
+from cmip6_utils.download import DownloadEngine, HostLimiter, host_slot
+from cmip6_utils.esgf import (
+    DEFAULT_BATCH_SIZE,
+    SEARCH_ERRORS,
+    Replica,
+    search_files,
+    search_files_batched,
+    stream_file_replicas,
+)
+from cmip6_utils.esgpulldb import DEFAULT_COMMIT_EVERY, EsgpullDB
 from cmip6_utils.file import download_file
-from cmip6_utils.misc import ESGF_offline_nodes, verify_checksum
-
-
-def search_and_download(search_node: str, master_id: str, output_directory: str, timeout: int, ignorehosts=[]) -> tuple:
+from cmip6_utils.misc import ESGF_offline_nodes
+from cmip6_utils.nodes import get_scoreboard, url_host
+from cmip6_utils.scheduler import lpt_partition
+from cmip6_utils.search_cache import SearchCache
+from cmip6_utils.session import get_session_pool, set_pool_size
+
+
+def search_and_download(
+    search_node: str,
+    master_id: str,
+    output_directory: str,
+    timeout: int,
+    ignorehosts=[],
+    limiter: Optional[HostLimiter] = None,
+    cache: Optional[SearchCache] = None,
+) -> tuple:
     """This function queries the ESGF search API to find the files missing for the masterid and downloads them.
 
     :param search_node: _description_
@@ -42,65 +60,115 @@ def search_and_download(search_node: str, master_id: str, output_directory: str,
     :type output_directory: str
     :param ignorehosts: _description_, defaults to []
     :type ignorehosts: list, optional
-    :return: _description_
+    :param limiter: per-host limit on concurrent downloads, defaults to None
+    :type limiter: HostLimiter, optional
+    :param cache: cache of search results, defaults to None
+    :type cache: SearchCache, optional
+    :return: see download_replicas. If the search fails, the number of replicas is the number found before it failed.
+    :rtype: tuple
+    """
+    search_errors = []
+    if cache is not None:
+        try:
+            replicas = search_files(search_node, [master_id], cache=cache).get(master_id, [])
+        except SEARCH_ERRORS as e:
+            LOGGER.error(f"Unable to access search: {e}")
+            return (False,)
+    else:
+        # start downloading from the first replica while the rest of the search response is still arriving
+        replicas = stream_file_replicas(search_node, master_id, search_errors)
+
+    ret_vals = download_replicas(master_id, replicas, output_directory, timeout, ignorehosts, limiter)
+    if search_errors:
+        # the replicas found before the search failed were still tried
+        LOGGER.error(f"Unable to access search: {search_errors[0]}")
+    return ret_vals
+
+
+def download_replicas(
+    master_id: str,
+    replicas: Iterable[Replica],
+    output_directory: str,
+    timeout: int,
+    ignorehosts=[],
+    limiter: Optional[HostLimiter] = None,
+) -> tuple:
+    """Downloads a file from the first of its replicas (found with cmip6_utils.esgf) that works. The replicas
+    can be a list, or an iterator of replicas as they are parsed from a search response.
+
+    :return: (True, number of replicas, local filename) on success, (False, number of replicas) otherwise
     :rtype: tuple
     """
     LOGGER.info(f"Master ID: {master_id}")
     LOGGER.info(f"Download location: {output_directory}")
 
-    api = f"https://{search_node}/esg-search/search?"
-    search = f"{api}type=File&distrib=true&master_id={master_id}"
-
-    resp = requests.get(search)
-
-    if resp.status_code != 200:
-        LOGGER.error(f"Unable to access search. Received code {resp.status_code}")
-        return (False,)
-
-    parser = lxml.etree.XMLParser(encoding="UTF-8")
-    tree = lxml.etree.fromstring(resp.content, parser=parser)
-
-    result = tree.xpath("result")[0]
-
-    num_found = int(result.attrib["numFound"])
-    LOGGER.info(f"Found {num_found} sources of file")
-
-    for i, urlelem in enumerate(result.xpath("doc")):
-        urlelem.findall('arr[@name="checksum"]')
-        cs = urlelem.findall('arr[@name="checksum"]')[0]
-        cs = cs.find("str").text
-        for url in urlelem.find('arr[@name="url"]').findall("str"):
-            if url.text.endswith("HTTPServer"):
-                url = url.text.strip().split("|")[0].strip()
-                # print(url)
-                _p = urlparse(url)
-                host = _p.hostname
-                if host in ignorehosts:
-                    LOGGER.warn(f"Ignoring host {i + 1}: {host}")
-                    break
-                LOGGER.info(f"Attempting retrieval from source {i + 1} [Host: {_p.hostname}]")
-                LOGGER.info(f"URL: {url}")
-
-                local_filename = url.split("/")[-1]
-                local_filename = os.path.join(output_directory, local_filename)
-                status_code = download_file(url, local_filename, timeout=timeout)
-
-                if status_code == 200:
-                    LOGGER.info("Download successful")
-                    vrfy = verify_checksum(local_filename, cs)
-                    if vrfy:
-                        LOGGER.info("Checksum PASS")
-                        return (True, num_found, local_filename)
-                    else:
-                        LOGGER.error("Checksum FAIL")
-                        (False, num_found)
-                else:
-                    LOGGER.error(f"Download unuccessful. Got error code {status_code}")
-                    break
+    scoreboard = get_scoreboard()
+    if isinstance(replicas, list):
+        LOGGER.info(f"Found {len(replicas)} sources of file")
+        # try the sources on the fastest and healthiest data nodes first
+        size = replicas[0].size if replicas else None
+        replicas = scoreboard.order(replicas, host=lambda replica: url_host(replica.url), size=size)
+    else:
+        # try the sources as they arrive, except the ones on data nodes that failed recently
+        replicas = scoreboard.order_stream(replicas, host=lambda replica: url_host(replica.url))
+
+    num_found = 0
+    for i, replica in enumerate(replicas):
+        num_found += 1
+        url = replica.url
+        host = url_host(url)
+        if host in ignorehosts:
+            LOGGER.warn(f"Ignoring host {i + 1}: {host}")
+            continue
+        LOGGER.info(f"Attempting retrieval from source {i + 1} [Host: {host}]")
+        LOGGER.info(f"URL: {url}")
+
+        local_filename = url.split("/")[-1]
+        local_filename = os.path.join(output_directory, local_filename)
+        with host_slot(limiter, url):
+            result = download_file(
+                url, local_filename, timeout=timeout, size=replica.size, checksum_type=replica.checksum_type
+            )
+
+        if result.ok:
+            LOGGER.info("Download successful")
+            # the file was hashed while it was downloaded
+            vrfy = result.digest == replica.checksum.strip().lower()
+            if vrfy:
+                LOGGER.info("Checksum PASS")
+                return (True, num_found, local_filename)
+            else:
+                LOGGER.error("Checksum FAIL")
+        else:
+            LOGGER.error(f"Download unuccessful. Got error code {result.status}")
 
     return (False, num_found)
 
 
+def parse_part(value: str) -> tuple[int, int]:
+    """Parses the --part argument, I/N."""
+    index, _, nparts = value.partition("/")
+    try:
+        index, nparts = int(index), int(nparts)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not of the form I/N")
+    if not 1 <= index <= nparts:
+        raise argparse.ArgumentTypeError(f"{value}: I must be between 1 and N")
+    return index, nparts
+
+
+def partition_files(db: EsgpullDB, index: int, nparts: int) -> set[str]:
+    """
+    Splits all the files of the database (whatever their status, so that every batch job gets the same split,
+    however far the others have got) into nparts parts of about equal total size, and returns the master_ids of
+    the part with the given (1-based) index.
+    """
+    # sorted first, so that files of the same size are split the same way in every batch job
+    files = sorted((item["master_id"], item["size"] or 0) for item in db.files(exclude_status=None))
+    part = lpt_partition(files, nparts, cost=lambda file: file[1])[index - 1]
+    return {master_id for master_id, _ in part}
+
+
 def main():
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -139,6 +207,22 @@ def main():
         default="esgf-node.llnl.gov",
         help="Search node to query. Defaults to LLNL node.",
     )
+    parser.add_argument(
+        "--search-batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="Number of files to search for in a single search request.",
+    )
+    parser.add_argument(
+        "--stream-search",
+        action="store_true",
+        help=(
+            "Search for each file on its own, and start downloading it from the first replica found while the rest "
+            "of the search response is still arriving, instead of searching for the files in batches. Search results "
+            "are not cached."
+        ),
+    )
+    add_search_cache_args(parser)
     parser.add_argument(
         "--timeout",
         "-t",
@@ -147,6 +231,43 @@ def main():
         default=5,
     )
     parser.add_argument("--retry", "-r", type=str)
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="Number of files to download concurrently.")
+    parser.add_argument(
+        "--per-node", type=int, default=2, help="Maximum number of concurrent downloads from a single data node."
+    )
+    parser.add_argument(
+        "--pool-size", type=int, default=10, help="Number of HTTP connections to keep open to each ESGF node."
+    )
+    parser.add_argument(
+        "--largest-first",
+        action="store_true",
+        help=(
+            "Download the largest files first, so that the downloads of the last files do not leave all but one "
+            "worker idle."
+        ),
+    )
+    parser.add_argument(
+        "--part",
+        type=parse_part,
+        default=None,
+        metavar="I/N",
+        help=(
+            "Split the files into N parts of about equal total size and only download the files of part I, so that "
+            "the downloads can be spread over N batch jobs."
+        ),
+    )
+    parser.add_argument(
+        "--backup",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Back up the esgpull database (with SQLite's online backup API) before modifying it.",
+    )
+    parser.add_argument(
+        "--commit-every",
+        type=int,
+        default=DEFAULT_COMMIT_EVERY,
+        help="Number of downloaded files whose status is written to the database in a single transaction.",
+    )
     args = parser.parse_args(args=None if sys.argv[1:] else ["--help"])
 
     # All the localpaths in the database begin with CMIP6. I am checking here if there is such a directory in the
@@ -160,6 +281,7 @@ def main():
     LOGGER.addHandler(fh)
 
     LOGGER.info(f"Start time {datetime.strftime(datetime.now(), '%Y/%m/%d %H:%M:%S')}")
+    set_pool_size(args.pool_size)
 
     if args.retry:
         with open(args.retry, "r") as of:
@@ -183,64 +305,97 @@ def main():
     dbname = args.dbname
     LOGGER.info(f"Using database: {dbname}")
 
-    # This program modifies the databse. So, first backup the database in case there are issues.
-    db_backup_name = f"{dbname}.backup{datetime.strftime(datetime.now(), '%Y%m%d')}"
-    LOGGER.info(f"Backing up database to: {db_backup_name}")
-    shutil.copy(dbname, db_backup_name)
-
-    con = sqlite3.connect(dbname)
-    con.row_factory = sqlite3.Row
-    cur = con.cursor()
-    update_cur = con.cursor()
-    res = cur.execute("SELECT * from file WHERE status!='Done'")
-
-    totalfiles = len(res.fetchall())
-
-    res = cur.execute("SELECT * from file WHERE status!='Done'")
+    db = EsgpullDB(dbname, commit_every=args.commit_every)
+    if args.backup:
+        # This program modifies the databse. So, first backup the database in case there are issues.
+        db_backup_name = f"{dbname}.backup{datetime.strftime(datetime.now(), '%Y%m%d')}"
+        LOGGER.info(f"Backing up database to: {db_backup_name}")
+        db.backup(db_backup_name)
+
+    if args.part is not None:
+        part = partition_files(db, *args.part)
+        totalfiles = sum(1 for item in db.files() if item["master_id"] in part)
+        LOGGER.info(f"Part {args.part[0]} of {args.part[1]}: {len(part)} files")
+    else:
+        part = None
+        totalfiles = db.count_files()
 
     problem_ids = []
     retry_ids = []
 
     temp_dir = tempfile.TemporaryDirectory(ignore_cleanup_errors=True)
-
-    count = 0
-    good = 0
-    bad = 0
-    for item in res:
-        master_id = item["master_id"]
-        localpath = item["local_path"]  # CMIP6/.../....
+    engine = DownloadEngine(workers=args.jobs, per_host=args.per_node)
+    search_cache = open_search_cache(args)
+
+    def fetch(master_id: str, localpath: str, replicas: Optional[list[Replica]]) -> tuple:
+        """Runs in a worker thread: downloads the file and moves it into the archive."""
+        if replicas is None and not args.stream_search:
+            # the search for this file failed
+            return (False,)
         downloadpath = os.path.join(temp_dir.name, localpath)
         os.makedirs(downloadpath, exist_ok=True)
-        if input_retry_ids:
-            if not master_id in input_retry_ids:
-                count += 1
-                problem_ids.append(master_id)
-                continue
-        ret_vals = search_and_download(args.search_node, master_id, downloadpath, args.timeout, ignored_nodes)
-        successful = ret_vals[0]
-        num_found = ret_vals[1]
-        if len(ret_vals) > 2:
-            local_filename = ret_vals[2]
-
-        if not successful:
-            bad += 1
-            problem_ids.append(master_id)
-            if num_found != 0:
-                retry_ids.append(master_id)
+        if args.stream_search:
+            ret_vals = search_and_download(
+                args.search_node, master_id, downloadpath, args.timeout, ignored_nodes, engine.limiter
+            )
         else:
-            good += 1
+            ret_vals = download_replicas(master_id, replicas, downloadpath, args.timeout, ignored_nodes, engine.limiter)
+        if ret_vals[0]:
+            local_filename = ret_vals[2]
             localpath = os.path.join(args.rootdir, localpath)
             LOGGER.info(f"Moving downloaded file to {localpath}")
             os.makedirs(localpath, exist_ok=True)
             shutil.move(local_filename, os.path.join(localpath, local_filename.split("/")[-1]))
+        return ret_vals
+
+    def jobs():
+        nonlocal count
+        for item in db.files(largest_first=args.largest_first):
+            master_id = item["master_id"]
+            if part is not None and master_id not in part:
+                # downloaded by another batch job
+                continue
+            if input_retry_ids:
+                if not master_id in input_retry_ids:
+                    count += 1
+                    problem_ids.append(master_id)
+                    continue
+            yield master_id, item["local_path"]
 
-            _ = update_cur.execute(f"UPDATE file SET status='Done' WHERE master_id='{master_id}'")
-            con.commit()
-
-        count += 1
-        LOGGER.info(f"Completed [{count}/{totalfiles}]")
-
-    con.close()
+    count = 0
+    good = 0
+    bad = 0
+    if args.stream_search:
+        # each file is searched for by the worker that downloads it
+        searched_jobs = ((master_id, localpath, None) for master_id, localpath in jobs())
+    else:
+        # The files are searched for a batch at a time, as the download engine asks for more jobs
+        searched_jobs = (
+            (master_id, localpath, replicas)
+            for (master_id, localpath), replicas in search_files_batched(
+                args.search_node, jobs(), args.search_batch_size, cache=search_cache
+            )
+        )
+    # Results are handed back to this thread, which is the only one that writes to the database
+    try:
+        for (master_id, _, _), ret_vals in engine.run(fetch, searched_jobs):
+            successful = ret_vals[0]
+            num_found = ret_vals[1] if len(ret_vals) > 1 else 0
+
+            if not successful:
+                bad += 1
+                problem_ids.append(master_id)
+                if num_found != 0:
+                    retry_ids.append(master_id)
+            else:
+                good += 1
+                db.set_status(master_id)
+
+            count += 1
+            LOGGER.info(f"Completed [{count}/{totalfiles}]")
+    finally:
+        # writes the status of the last files
+        db.close()
     temp_dir.cleanup()
 
     LOGGER.info("/n/n/n")
@@ -248,6 +403,14 @@ def main():
     LOGGER.info(f"Attempted to fix {totalfiles} files")
     LOGGER.info(f"Successfully fixed {good} files")
     LOGGER.info(f"Error fixing {bad} files")
+    LOGGER.info("HTTP connection reuse:")
+    for line in get_session_pool().report():
+        LOGGER.info(f"    {line}")
+    if search_cache is not None:
+        LOGGER.info(search_cache.report())
+    LOGGER.info("Data node scoreboard:")
+    for line in get_scoreboard().report():
+        LOGGER.info(f"    {line}")
 
     if bad > 0:
         LOGGER.info("Problematic master IDs:")
@@ -4,8 +4,8 @@ import sys
 from os.path import join
 from shutil import move
 
-from cmip6_utils.cli import add_common_parser_args, set_default_activitydir
-from cmip6_utils.dir import get_cmip_directories_at_level
+from cmip6_utils.cli import add_common_parser_args, open_inventory, set_default_activitydir
+from cmip6_utils.dir import CMIPDirLevels, WalkStats, find_cmip_directories
 from cmip6_utils.misc import BC
 
 
@@ -15,7 +15,7 @@ def cli():
         description=(""),
         epilog="Note: This script should be called only after combined timeseries files have been generated.",
     )
-    add_common_parser_args(parser, exp=True, adir=True, dryrun=True)
+    add_common_parser_args(parser, exp=True, adir=True, dryrun=True, inventory=True, walk=True)
     args = parser.parse_args(args=None if sys.argv[1:] else ["--help"])
     set_default_activitydir(args)
     return args
@@ -25,28 +25,38 @@ def main():
     args = cli()
 
     exp = args.experiment
-    varname = f"/{args.variable}/"
-    for root, dirs, _ in get_cmip_directories_at_level(args.activitydir, 7):
-        if exp in root and varname in root:
-            if len(dirs) != 1:
-                print("\n")
-                print(root)
-                # sorting the list of versions
-                dirs = sorted(dirs)
-                # we keep the last version from the sorted list
-                dir_to_keep = dirs[-1]
-                for _dir in dirs:
-                    if _dir == dir_to_keep:
-                        print(BC.okgreen(f"   Keeping version {_dir}"))
-                    else:
-                        print(BC.warn(f"   Removing version {_dir}"))
-                        new_root = root.replace("/CMIP6/", "/CMIP6_duplicate_versions_deleted/")
-                        print(f"   Moving contents to {new_root}")
-                        if not args.dry_run:
-                            os.makedirs(new_root, exist_ok=True)
-                            move(join(root, _dir), join(new_root, _dir))
-                            print("   Move successful")
+    inventory = open_inventory(args)
+    walk_stats = WalkStats()
+    for root, dirs, _ in find_cmip_directories(
+        args.activitydir,
+        CMIPDirLevels.grid,
+        inventory,
+        args.walk_threads,
+        walk_stats,
+        experiment=exp,
+        variable=args.variable,
+    ):
+        if len(dirs) != 1:
+            print("\n")
+            print(root)
+            # sorting the list of versions
+            dirs = sorted(dirs)
+            # we keep the last version from the sorted list
+            dir_to_keep = dirs[-1]
+            for _dir in dirs:
+                if _dir == dir_to_keep:
+                    print(BC.okgreen(f"   Keeping version {_dir}"))
+                else:
+                    print(BC.warn(f"   Removing version {_dir}"))
+                    new_root = root.replace("/CMIP6/", "/CMIP6_duplicate_versions_deleted/")
+                    print(f"   Moving contents to {new_root}")
+                    if not args.dry_run:
+                        os.makedirs(new_root, exist_ok=True)
+                        move(join(root, _dir), join(new_root, _dir))
+                        print("   Move successful")
 
+    if args.walk_threads:
+        print(walk_stats.report())
     if args.dry_run:
         print(BC.warn("******************** DRY RUN COMPLETE ********************"))
 
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+Builds or refreshes the SQLite inventory of the CMIP6 directory tree. Once the inventory exists, the other
+scripts can be run with the --inventory flag to query it instead of walking the directory tree.
+
+Rescans are incremental: only the directories whose mtime changed since the last scan are listed again.
+"""
+import argparse
+import sys
+
+from cmip6_utils.inventory import DEFAULT_INVENTORY, CMIPInventory
+
+
+def cli():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=(
+            "Builds or refreshes the inventory of the CMIP6 directory tree. Only directories whose mtime "
+            "has changed since the last scan are listed again."
+        ),
+    )
+    parser.add_argument(
+        "activitydirs",
+        type=str,
+        nargs="+",
+        help="Root directories for the CMIP6 activities (e.g. /data/Datasets/CMIP6/CMIP).",
+    )
+    parser.add_argument("--inventory-db", type=str, default=DEFAULT_INVENTORY, help="Path to the inventory database.")
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="List every directory, even if its mtime has not changed. Use if files were modified in place.",
+    )
+    return parser.parse_args(args=None if sys.argv[1:] else ["--help"])
+
+
+def main():
+    args = cli()
+
+    with CMIPInventory(args.inventory_db) as inventory:
+        for activitydir in args.activitydirs:
+            print(f"Scanning: {activitydir}")
+            stats = inventory.scan(activitydir, full=args.full)
+            print(f"    ---> Directories visited : {stats.directories_visited}")
+            print(f"    ---> Directories listed  : {stats.directories_listed}")
+            print(f"    ---> Directories removed : {stats.directories_removed}")
+            print(f"    ---> Files indexed       : {stats.files_indexed}")
+            print(f"    ---> Time taken          : {stats.elapsed:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,8 +5,8 @@ import sys
 from os.path import join
 from shutil import move, rmtree
 
-from cmip6_utils.cli import add_common_parser_args, set_default_activitydir
-from cmip6_utils.dir import get_cmip_directories_at_level
+from cmip6_utils.cli import add_common_parser_args, open_inventory, set_default_activitydir
+from cmip6_utils.dir import CMIPDirLevels, WalkStats, find_cmip_directories
 from cmip6_utils.misc import BC
 
 
@@ -22,7 +22,7 @@ def cli():
             "if you are 100% sure that all pre-processing up to this point has completed correctly."
         ),
     )
-    add_common_parser_args(parser, exp=True, adir=True, dryrun=True)
+    add_common_parser_args(parser, exp=True, adir=True, dryrun=True, inventory=True, walk=True)
     parser.add_argument(
         "--threddsdir",
         "-D",
@@ -40,7 +40,6 @@ def main():
     args = cli()
 
     exp_str = args.experiment
-    varname_str = f"/{args.variable}/"
 
     count = 0
 
@@ -48,38 +47,50 @@ def main():
     _i = _tmp.index("CMIP6")
     rootdir = "/" + "/".join(_tmp[:_i])
 
-    for root, dirs, _ in get_cmip_directories_at_level(args.activitydir, 7):  # here 'dirs' are the version directories
-        if exp_str in root and varname_str in root:
-            if len(dirs) > 1:
-                raise RuntimeError(
-                    (
-                        "More than one version of this dataset found. "
-                        "Run 'cmip6_find_duplicate_versions' first to trim to latest version."
-                    )
+    inventory = open_inventory(args)
+    walk_stats = WalkStats()
+    # here 'dirs' are the version directories
+    for root, dirs, _ in find_cmip_directories(
+        args.activitydir,
+        CMIPDirLevels.grid,
+        inventory,
+        args.walk_threads,
+        walk_stats,
+        experiment=exp_str,
+        variable=args.variable,
+    ):
+        if len(dirs) > 1:
+            raise RuntimeError(
+                (
+                    "More than one version of this dataset found. "
+                    "Run 'cmip6_find_duplicate_versions' first to trim to latest version."
                 )
-            else:
-                version = dirs[0]
-                source_dir = join(root, version)
-                print(BC.okgreen(f"Source: {source_dir}"))
-                dest_dir = root.replace(rootdir, args.threddsdir)
-                print(f"Destination : {dest_dir}")
-                if not args.dry_run:
-                    os.makedirs(dest_dir, exist_ok=True)
-                    move(source_dir, dest_dir)
+            )
+        else:
+            version = dirs[0]
+            source_dir = join(root, version)
+            print(BC.okgreen(f"Source: {source_dir}"))
+            dest_dir = root.replace(rootdir, args.threddsdir)
+            print(f"Destination : {dest_dir}")
+            if not args.dry_run:
+                os.makedirs(dest_dir, exist_ok=True)
+                move(source_dir, dest_dir)
 
-                # Now that files have been moves from the staging directory, I remove the directory sub-there
-                # that is empty
-                empty_sub_tree = "/" + "/".join(root.strip("/").split("/")[:-1])
-                print(f"Removing: {empty_sub_tree}")
-                assert empty_sub_tree.endswith(args.variable)
-                if not args.dry_run:
-                    rmtree(empty_sub_tree)
-                # break
+            # Now that files have been moves from the staging directory, I remove the directory sub-there
+            # that is empty
+            empty_sub_tree = "/" + "/".join(root.strip("/").split("/")[:-1])
+            print(f"Removing: {empty_sub_tree}")
+            assert empty_sub_tree.endswith(args.variable)
+            if not args.dry_run:
+                rmtree(empty_sub_tree)
+            # break
 
-            count += 1
+        count += 1
 
     print("\n")
     print(f"Moved {count} datasets")
+    if args.walk_threads:
+        print(walk_stats.report())
     if args.dry_run:
         print(BC.warn("******************** DRY RUN COMPLETE ********************"))
 
@@ -1,18 +1,18 @@
 #!/usr/bin/env python
-import os
 import os.path as osp
-import shutil
 import sys
-import tempfile
 import warnings
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser, Namespace
 from dataclasses import dataclass
-from typing import Tuple
+from typing import Optional, Tuple
 
 from esgpull import Esgpull, Query
 
-from cmip6_utils.file import download_file
-from cmip6_utils.misc import BC, verify_checksum
+from cmip6_utils.checksum import ChecksumCache
+from cmip6_utils.cli import add_search_cache_args, add_segment_args, open_search_cache
+from cmip6_utils.download import DEFAULT_SEGMENT_SIZE, fetch_file
+from cmip6_utils.misc import BC
+from cmip6_utils.search_cache import SearchCache
 
 
 @dataclass
@@ -20,8 +20,10 @@ class ESGFFile:
     filename: str
     url: str
     checksum: str
+    checksum_type: str
     local_path: str
     data_node: str
+    size: int
 
 
 def cmip_path_to_query(path: str) -> Query:
@@ -54,6 +56,14 @@ def cli() -> Namespace:
         ),
     )
     parser.add_argument("dataset", type=str, help="Full local path to the dataset to download")
+    parser.add_argument(
+        "-t",
+        type=int,
+        help=("Timeout (in seconds) for downloading a file (parameter to requests.get())."),
+        default=5,
+    )
+    add_segment_args(parser)
+    add_search_cache_args(parser)
     args = parser.parse_args(args=None if sys.argv[1:] else ["--help"])
     args.dataset = args.dataset.rstrip("/")
 
@@ -83,10 +93,22 @@ def print_query(query: Query):
 
 def main():
     args = cli()
-    find_download_missing_files(args.dataset)
+    find_download_missing_files(
+        args.dataset,
+        t=args.t,
+        segments=args.segments,
+        segment_size=args.segment_size,
+        search_cache=open_search_cache(args),
+    )
 
 
-def find_download_missing_files(dataset: str):
+def find_download_missing_files(
+    dataset: str,
+    t: Optional[int] = 5,
+    segments: Optional[int] = 0,
+    segment_size: Optional[int] = DEFAULT_SEGMENT_SIZE,
+    search_cache: Optional[SearchCache] = None,
+):
     # args = cli()
 
     path_to_cmip6_data, cmip6_dataset_structure = split_dataset_path(dataset)
@@ -106,7 +128,11 @@ def find_download_missing_files(dataset: str):
     query.options.replica = True
 
     esg = Esgpull(path="/home/dchandan/esgpull_profiles/scratch")
-    search_results = esg.context.files(query, max_hits=None)
+    if search_cache is not None:
+        search_results = search_cache.files(esg, query, max_hits=None)
+    else:
+        search_results = esg.context.files(query, max_hits=None)
+    cache = ChecksumCache()
 
     dataset_files = {}
 
@@ -115,7 +141,7 @@ def find_download_missing_files(dataset: str):
     for res in search_results:
         if version == res.version:
             filename = res.filename
-            data_ = (filename, res.url, res.checksum, res.local_path, res.data_node)
+            data_ = (filename, res.url, res.checksum, res.checksum_type, res.local_path, res.data_node, res.size)
             if filename in dataset_files:
                 dataset_files[filename].append(ESGFFile(*data_))
             else:
@@ -126,37 +152,10 @@ def find_download_missing_files(dataset: str):
     changes_made = False
     for filename, entries in dataset_files.items():
         if not osp.exists(osp.join(dataset, filename)):
-            success = False
             print(f"Found missing file: {filename}")
-
-            tf_ = tempfile.NamedTemporaryFile()
-            for item in entries:
-                print(f" ---> Attempting download from: {item.data_node}")
-                err = download_file(item.url, tf_.name)
-
-                if err == 200:
-                    print(f" ---> Download {BC.okgreen('successful')}")
-                    vrfy = verify_checksum(tf_.name, item.checksum)
-                    if vrfy:
-                        print(f" ---> Checksum {BC.okgreen('PASS')}")
-                        success = True
-                        localpath = osp.join(path_to_cmip6_data, item.local_path)
-                        print(f" ---> Copying downloaded file to {localpath}")
-                        os.makedirs(localpath, exist_ok=True)
-                        local_filename = osp.join(localpath, filename)
-                        shutil.copy2(tf_.name, local_filename)
-                        vrfy2 = verify_checksum(local_filename, item.checksum)
-                        if not vrfy2:
-                            print(f" ---> {BC.fail('Checksum of copied file failed')}")
-                            os.remove(local_filename)
-                            continue
-
-                        changes_made = True
-                        break
-                    else:
-                        print(f" ---> Checksum {BC.fail('FAIL')}")
-                else:
-                    print(f" ---> Download {BC.fail('unsuccessful')}")
+            local_filename = osp.join(path_to_cmip6_data, entries[0].local_path, filename)
+            success = fetch_file(entries, local_filename, t, cache, segments, segment_size)
+            changes_made = changes_made or success
 
             if not success:
                 print(f" ---> {BC.fail('Unable to download this file from any source')}")
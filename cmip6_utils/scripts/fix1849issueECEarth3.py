@@ -9,6 +9,7 @@ from cmip6_utils.nchelpers import (
     bulk_copy_variable_data,
     copy_dimension_definitions,
     copy_file_metadata,
+    copy_variable_data,
     copy_variable_definitions,
 )
 
@@ -43,9 +44,8 @@ def main():
     bulk_copy_variable_data(ncf, oncf, exclude=time_vars)
 
     for var_name in time_vars:
-        ovar = oncf[var_name]
         ivar = ncf[var_name]
-        ovar[:, ...] = ivar[1:, ...]
+        copy_variable_data(ivar, oncf[var_name], src=1, axis=ivar.dimensions.index("time"))
 
     oncf.close()
     ncf.close()
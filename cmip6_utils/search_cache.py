@@ -0,0 +1,161 @@
+"""
+On-disk cache of ESGF search results.
+
+Search results are stored in a local SQLite database, keyed by the normalized query, so that repeating a search
+(for another file of the same dataset, or in a later run) is answered locally. Entries expire after a TTL, the
+least recently used entries are evicted when the cache grows beyond its maximum size, and in offline mode the
+cache is only read: entries are used regardless of their age and a miss raises SearchCacheMiss instead of
+searching.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Optional
+
+DEFAULT_SEARCH_CACHE = os.path.expanduser("~/.cmip6_utils/search_cache.sqlite")
+
+DEFAULT_TTL = 24 * 3600  # s
+
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024  # bytes
+
+# Parts of an esgpull query that do not change its results
+_VOLATILE_KEYS = {"added_at", "updated_at", "sha", "tracked", "require"}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entry (
+    key TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL,
+    size INTEGER NOT NULL,
+    value TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entry_accessed ON entry (accessed);
+"""
+
+
+class SearchCacheMiss(LookupError):
+    """The result of a search is not in the cache, and the cache is offline."""
+
+
+def _normalize(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in value.items() if k not in _VOLATILE_KEYS and v not in (None, [], {})}
+    if isinstance(value, (list, tuple, set)):
+        return sorted((_normalize(v) for v in value), key=lambda v: json.dumps(v, sort_keys=True, default=str))
+    return value
+
+
+def query_key(kind: str, query: dict) -> str:
+    """Key of a query: the same search, however its facets and values are ordered, gives the same key."""
+    normalized = json.dumps([kind, _normalize(query)], sort_keys=True, default=str)
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+class SearchCache:
+    """
+    SQLite cache of search results. Values must be serializable to JSON. The cache can be shared between threads
+    (each thread uses its own connection).
+
+    :param ttl: time in seconds after which an entry expires, defaults to DEFAULT_TTL
+    :type ttl: float, optional
+    :param max_size: maximum total size of the entries in bytes, defaults to DEFAULT_MAX_SIZE
+    :type max_size: int, optional
+    :param offline: only read from the cache, defaults to False
+    :type offline: bool, optional
+    """
+
+    def __init__(
+        self,
+        dbname: Optional[str] = DEFAULT_SEARCH_CACHE,
+        ttl: Optional[float] = DEFAULT_TTL,
+        max_size: Optional[int] = DEFAULT_MAX_SIZE,
+        offline: Optional[bool] = False,
+    ):
+        dirname = os.path.dirname(dbname)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.dbname = dbname
+        self.ttl = ttl
+        self.max_size = max_size
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        with self._connection() as con:
+            con.executescript(_SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = sqlite3.connect(self.dbname, timeout=60)
+            self._local.con = con
+        return con
+
+    def get(self, kind: str, query: dict) -> Optional[Any]:
+        """Returns the cached result of a query, or None if there is none or it has expired."""
+        key = query_key(kind, query)
+        now = time.time()
+        with self._connection() as con:
+            row = con.execute("SELECT created, value FROM entry WHERE key=?", (key,)).fetchone()
+            if row is None or (not self.offline and now - row[0] > self.ttl):
+                self.misses += 1
+                return None
+            if not self.offline:
+                con.execute("UPDATE entry SET accessed=? WHERE key=?", (now, key))
+        self.hits += 1
+        return json.loads(row[1])
+
+    def put(self, kind: str, query: dict, value: Any) -> None:
+        """Stores the result of a query, then evicts expired entries and, if the cache is too large, the least
+        recently used ones. Does nothing in offline mode."""
+        if self.offline:
+            return
+        value = json.dumps(value)
+        now = time.time()
+        with self._connection() as con:
+            con.execute(
+                "INSERT OR REPLACE INTO entry VALUES (?, ?, ?, ?, ?, ?)",
+                (query_key(kind, query), kind, now, now, len(value), value),
+            )
+            self._evict(con, now)
+
+    def _evict(self, con: sqlite3.Connection, now: float) -> None:
+        con.execute("DELETE FROM entry WHERE created < ?", (now - self.ttl,))
+        total = con.execute("SELECT COALESCE(SUM(size), 0) FROM entry").fetchone()[0]
+        if total <= self.max_size:
+            return
+
+        evict = []
+        for key, size in con.execute("SELECT key, size FROM entry ORDER BY accessed"):
+            evict.append((key,))
+            total -= size
+            if total <= self.max_size:
+                break
+        con.executemany("DELETE FROM entry WHERE key=?", evict)
+
+    def lookup(self, kind: str, query: dict, search: Callable[[], Any]) -> Any:
+        """Returns the cached result of a query, calling search() (and caching its result) on a miss."""
+        value = self.get(kind, query)
+        if value is None:
+            if self.offline:
+                raise SearchCacheMiss(f"No cached result for the {kind} search, and the search cache is offline")
+            value = search()
+            self.put(kind, query, value)
+        return value
+
+    def files(self, esg, query, max_hits: Optional[int] = None) -> list:
+        """Cached esg.context.files(query, max_hits=max_hits) for an Esgpull instance and an esgpull Query."""
+        from esgpull.models import File
+
+        key = {"query": query.asdict(), "max_hits": max_hits}
+        files = self.lookup(
+            "esgpull.files", key, lambda: [f.asdict() for f in esg.context.files(query, max_hits=max_hits)]
+        )
+        return [File.fromdict(f) for f in files]
+
+    def report(self) -> str:
+        return f"Search cache: {self.hits} hits, {self.misses} misses"
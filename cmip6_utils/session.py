@@ -0,0 +1,99 @@
+"""
+Pooled HTTP sessions.
+
+Downloads and searches go to a handful of ESGF nodes over and over. Using one requests.Session (with keep-alive
+connection pooling) per host avoids paying for a new TCP and TLS handshake for every file and every retry.
+"""
+import threading
+from dataclasses import dataclass
+from typing import Optional
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_POOL_SIZE = 10
+
+
+@dataclass
+class ConnectionStats:
+    requests: int = 0
+    connections: int = 0
+
+    @property
+    def reused(self) -> int:
+        """Number of requests that were sent over an already open connection."""
+        return self.requests - self.connections
+
+
+class SessionPool:
+    """
+    One requests.Session per host (scheme and network location), each with a pool of up to pool_size keep-alive
+    connections. The pool can be shared between threads: sessions are created under a lock and the underlying
+    urllib3 connection pools are thread safe.
+    """
+
+    def __init__(self, pool_size: Optional[int] = DEFAULT_POOL_SIZE):
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+    def session(self, url: str) -> requests.Session:
+        p = urlparse(url)
+        key = f"{p.scheme}://{p.netloc}"
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._sessions[key] = session
+        return session
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.session(url).get(url, **kwargs)
+
+    def stats(self) -> dict[str, ConnectionStats]:
+        """Number of requests sent and connections opened, per host."""
+        stats = {}
+        with self._lock:
+            sessions = list(self._sessions.items())
+
+        for key, session in sessions:
+            stat = ConnectionStats()
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for pool_key in pools.keys():
+                    pool = pools.get(pool_key)
+                    if pool is not None:
+                        stat.requests += pool.num_requests
+                        stat.connections += pool.num_connections
+            stats[key] = stat
+
+        return stats
+
+    def report(self) -> list[str]:
+        return [
+            f"{host}: {stat.requests} requests over {stat.connections} connections ({stat.reused} reused)"
+            for host, stat in self.stats().items()
+        ]
+
+    def close(self) -> None:
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
+
+
+_SESSION_POOL = SessionPool()
+
+
+def get_session_pool() -> SessionPool:
+    """Returns the session pool shared by download_file and the ESGF search functions."""
+    return _SESSION_POOL
+
+
+def set_pool_size(pool_size: int) -> None:
+    """Sets the number of connections kept open per host for sessions created from now on."""
+    _SESSION_POOL.pool_size = pool_size